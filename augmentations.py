@@ -0,0 +1,159 @@
+"""
+Tensor-native TRAIN augmentations of MasksDataset: the same augmentations, order and probabilities as before, but on
+uint8 tensors from the decoded image to the final resize, with no tensor <-> PIL round trips.
+
+The photometric distortions can also be applied to a whole collated batch of 224x224 images at once, either in the
+DataLoader workers (collate_fn=batch_photometric_collate_fn) or in the main process (apply_batch_photometric()).
+In that case they are applied after the geometric augmentations instead of before them, so the filler of expand()
+gets distorted as well and the contrast mean is taken over the augmented image.
+"""
+import random
+import torch
+import torchvision.transforms.functional as FT
+from utils import PHOTOMETRIC_DISTORTIONS, sample_photometric_distortions, photometric_distort, sample_expand, \
+    sample_random_crop, crop_boxes, flip_boxes, expand_crop_resize, resize_box
+
+DISTORTION_NAMES = list(PHOTOMETRIC_DISTORTIONS)
+
+
+def augment(image, box, label, filler, photometric_in_batch=False, dims=(224, 224)):
+    """
+    Augment a training image and resize it (the 80% augmentations branch of MasksDataset.__getitem__).
+
+    The geometric augmentations are first sampled on the boxes only. The pixels are then computed in a single pass:
+    a crop view resized to dims, or, if the image was expanded, expand_crop_resize() which never creates the
+    zoomed-out canvas. Flipping is done on the resized image.
+
+    :param image: image, a uint8 tensor of dimensions (3, h, w)
+    :param box: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
+    :param label: labels of objects, a tensor of dimensions (n_objects)
+    :param filler: RBG values of the expand() filler material, a list like [R, G, B] in [0, 255]
+    :param photometric_in_batch: only sample the photometric distortions, to apply on the batch later
+    :param dims: output (height, width)
+    :return: augmented image (uint8 tensor of dimensions (3, dims[0], dims[1])), non-fractional boxes in it, labels,
+    and the sampled photometric distortions
+    """
+    distortions = []
+
+    # A series of photometric distortions in random order, each with 50% chance of occurrence, as in Caffe repo
+    if random.random() < 0.5:
+        distortions = sample_photometric_distortions()
+        if not photometric_in_batch:
+            image = photometric_distort(image, distortions)
+
+    height, width = image.shape[-2:]
+
+    # Expand image (zoom out) with a 50% chance - helpful for training detection of small objects
+    # Fill surrounding space with the mean
+    position = None
+    if random.random() < 0.5:
+        height, width, left, top = sample_expand(height, width)
+        position = (left, top)
+        box = box + torch.FloatTensor([left, top, left, top]).unsqueeze(0)
+
+    # Randomly crop image (zoom in)
+    region = [0, 0, width, height]
+    if random.random() < 0.5:
+        crop, centers_in_crop = sample_random_crop(height, width, box)
+        if crop is not None:
+            region = [int(c) for c in crop.tolist()]
+            box, label = crop_boxes(box, label, crop, centers_in_crop)
+    region_w, region_h = region[2] - region[0], region[3] - region[1]
+
+    # Flip image with a 50% chance
+    flipped = random.random() < 0.5
+    if flipped:
+        box = flip_boxes(box, region_w)
+
+    # Compute the pixels
+    if position is None:
+        image = FT.resize(image[:, region[1]:region[3], region[0]:region[2]], dims, antialias=True)
+    else:
+        image = expand_crop_resize(image, filler, position, region, dims)
+    if flipped:
+        image = FT.hflip(image)  # flipping commutes with resizing
+
+    # non-fractional for Fast-RCNN
+    box = resize_box(box, torch.FloatTensor([region_w, region_h, region_w, region_h]).unsqueeze(0), dims,
+                     return_percent_coords=False)
+
+    return image, box, label, distortions
+
+
+def encode_distortions(distortions):
+    """
+    :param distortions: list of (distortion name, adjust factor)
+    :return: a tensor of dimensions (4, 2) of [distortion index, adjust factor] rows, padded with -1 indices
+    """
+    encoded = torch.full((len(DISTORTION_NAMES), 2), -1.)
+    for k, (d, adjust_factor) in enumerate(distortions):
+        encoded[k, 0] = DISTORTION_NAMES.index(d)
+        encoded[k, 1] = adjust_factor
+    return encoded
+
+
+def decode_distortions(encoded):
+    return [(DISTORTION_NAMES[int(index)], adjust_factor) for index, adjust_factor in encoded.tolist() if index >= 0]
+
+
+def rgb_to_grayscale(images):
+    r, g, b = images.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)  # same weights as torchvision
+
+
+def photometric_distort_batch(images, distortions):
+    """
+    Apply per-image photometric distortions to a batch, vectorized over the images that share a distortion step.
+
+    :param images: images, a float tensor of dimensions (n_images, 3, h, w) in [0, 1]
+    :param distortions: for every image, a list of (distortion name, adjust factor) to apply in order
+    :return: distorted images
+    """
+    new_images = images.clone()
+    n_steps = max([len(d) for d in distortions], default=0)
+
+    for step in range(n_steps):
+        for name in DISTORTION_NAMES:
+            indices = [k for k, d in enumerate(distortions) if len(d) > step and d[step][0] == name]
+            if not indices:
+                continue
+            indices = torch.tensor(indices)
+            factors = torch.tensor([distortions[k][step][1] for k in indices.tolist()], dtype=images.dtype)
+            factors = factors.view(-1, 1, 1, 1)
+            subset = new_images[indices]
+
+            if name == 'adjust_brightness':
+                subset = subset * factors
+            elif name == 'adjust_contrast':
+                mean = rgb_to_grayscale(subset).mean(dim=(-3, -2, -1), keepdim=True)
+                subset = factors * subset + (1 - factors) * mean
+            elif name == 'adjust_saturation':
+                subset = factors * subset + (1 - factors) * rgb_to_grayscale(subset)
+            else:  # hue needs a per-image RGB -> HSV round trip
+                subset = torch.stack([FT.adjust_hue(image, adjust_factor)
+                                      for image, adjust_factor in zip(subset, factors.flatten().tolist())])
+
+            new_images[indices] = subset.clamp(0., 1.)
+
+    return new_images
+
+
+def apply_batch_photometric(images, targets):
+    """
+    Apply the photometric distortions that MasksDataset(photometric_in_batch=True) sampled to a collated batch.
+
+    :param images: sequence of image tensors of dimensions (3, 224, 224)
+    :param targets: sequence of target dicts, with the sampled distortions under 'photometric'
+    :return: distorted images (a tensor of dimensions (n_images, 3, 224, 224)), targets without 'photometric'
+    """
+    distortions = [decode_distortions(target.pop('photometric')) for target in targets]
+    images = photometric_distort_batch(torch.stack(list(images)), distortions)
+    return images, targets
+
+
+def batch_photometric_collate_fn(batch):
+    """
+    collate_fn that applies the photometric distortions on the whole batch, in the DataLoader workers.
+    """
+    images, targets = tuple(zip(*batch))
+    return apply_batch_photometric(images, targets)
@@ -0,0 +1,131 @@
+"""
+Periodic evaluation off the critical path of training: the checkpoints written by the CheckpointManager (see
+checkpoints.py) are handed to an evaluator process, which loads every one of them and evaluates it on the
+(unshuffled) train images and the test images while the next epochs train. The results are polled by the training
+loop and merged into its metrics as they come, see python train.py --background-eval.
+
+The evaluator process builds its datasets once (packed, see MasksDataset) and runs torch with its own intra-op threads,
+so that it doesn't oversubscribe the cores of the training process. It's a spawned process: it works with CUDA too,
+where it evaluates on the training GPU.
+"""
+import multiprocessing
+import os
+import queue
+import traceback
+import torch
+import torch.utils.data
+from dataset import MasksDataset, collate_fn
+from eval import evaluate
+from model import get_fasterrcnn_resnet50_fpn
+
+
+def evaluator_loop(jobs, results, train_folder, test_folder, train_filenames, batch_size, threads, precision):
+    """
+    Evaluator process: evaluate the checkpoints of the jobs queue, in order, until a None job.
+
+    :param jobs: queue of (epoch, checkpoint path)
+    :param results: queue of (epoch, dict of train_iou, train_accuracy, test_iou and test_accuracy, error traceback)
+    """
+    torch.set_num_threads(threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    train_dataset = MasksDataset(data_folder=train_folder, split='test', packed=True, filenames=train_filenames)
+    test_dataset = MasksDataset(data_folder=test_folder, split='test', packed=True)
+    loaders = [torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+               for dataset in (train_dataset, test_dataset)]
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        epoch, path = job
+        try:
+            model = get_fasterrcnn_resnet50_fpn(weights_path=path)
+            train_accuracy, train_iou = evaluate(loaders[0], model, device=device, precision=precision)
+            test_accuracy, test_iou = evaluate(loaders[1], model, device=device, precision=precision)
+            del model
+            results.put((epoch, dict(train_iou=float(train_iou), train_accuracy=float(train_accuracy),
+                                     test_iou=float(test_iou), test_accuracy=float(test_accuracy)), None))
+        except Exception:
+            results.put((epoch, None, traceback.format_exc()))
+
+
+class BackgroundEvaluator(object):
+    """
+    call example (see train.main()):
+        evaluator = BackgroundEvaluator(train_folder, test_folder)
+        for epoch in range(epochs):
+            ...
+            manager.save(epoch, model, optimizer, metrics, is_best=False, on_written=evaluator.submit)
+            for evaluated_epoch, results in evaluator.poll():
+                ...
+        manager.close()
+        for evaluated_epoch, results in evaluator.close():
+            ...
+    """
+
+    def __init__(self, train_folder, test_folder, train_filenames=None, batch_size=20, threads=None,
+                 precision='fp32'):
+        """
+        :param train_folder: train images folder (or tar archive(s), see image_sources.py)
+        :param test_folder: test images folder
+        :param train_filenames: filenames of the train images to evaluate on (see manifest.stratified_sample()), by
+        default all of them
+        :param threads: intra-op threads of the evaluator process, by default a quarter of the cores
+        :param precision: autocast precision of the forward passes, see precision.py
+        """
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // 4)
+        context = multiprocessing.get_context('spawn')  # no inherited CUDA or thread pool state
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.submitted = 0  # written by submit() only
+        self.received = 0  # written by poll() and close() only
+        self.process = context.Process(target=evaluator_loop, daemon=True,
+                                       args=(self.jobs, self.results, train_folder, test_folder, train_filenames,
+                                             batch_size, threads, precision))
+        self.process.start()
+
+    def submit(self, epoch, path):
+        """
+        Queue the checkpoint of epoch for evaluation (the file must stay until its results are polled).
+        """
+        self.submitted += 1
+        self.jobs.put((epoch, path))
+
+    def collect(self, result):
+        epoch, results, error = result
+        self.received += 1
+        if error is not None:
+            raise RuntimeError(f'evaluation of the checkpoint of epoch {epoch} failed:\n{error}')
+        return epoch, results
+
+    def poll(self):
+        """
+        :return: list of (epoch, results dict) of the evaluations finished since the last call, without waiting
+        """
+        done = []
+        while True:
+            try:
+                done.append(self.collect(self.results.get_nowait()))
+            except queue.Empty:
+                break
+        if self.received < self.submitted and not self.process.is_alive():
+            raise RuntimeError(f'the evaluator process exited with code {self.process.exitcode}')
+        return done
+
+    def close(self):
+        """
+        Wait for the evaluations of the submitted checkpoints and stop the evaluator process.
+
+        :return: list of (epoch, results dict) of the evaluations not polled yet
+        """
+        self.jobs.put(None)
+        done = []
+        while self.received < self.submitted:
+            try:
+                done.append(self.collect(self.results.get(timeout=1)))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(f'the evaluator process exited with code {self.process.exitcode}')
+        self.process.join()
+        return done
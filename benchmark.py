@@ -0,0 +1,848 @@
+"""
+Micro-benchmarks of the data loading and model code paths.
+
+usage: python benchmark.py <benchmark> [options], see python benchmark.py --help
+
+The modules of a benchmark (dataset, serving, export, quantization, ...) are imported by the benchmark only.
+"""
+import argparse
+import base64
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+import numpy as np
+import torch
+import torchvision.transforms.functional as FT
+from utils import find_jaccard_overlap, random_crop, sample_expand, sample_random_crop, expand_crop_resize, resize_box
+from model import get_fasterrcnn_resnet50_fpn, PROPOSAL_PROFILES, apply_proposal_profile, BACKBONES
+from weights import get_weights_path
+from precision import PRECISIONS, to_channels_last
+import constants
+
+
+def make_synthetic_samples(n_samples, seed=42):
+    """
+    :return: list of (image, boxes, labels) with random image sizes and one random face box each, like MasksDataset
+    """
+    rng = np.random.RandomState(seed)
+    samples = []
+    for _ in range(n_samples):
+        h, w = rng.randint(150, 1000, size=2)
+        box_w, box_h = rng.randint(max(2, w // 20), w // 2), rng.randint(max(2, h // 20), h // 2)
+        x, y = rng.randint(0, w - box_w), rng.randint(0, h - box_h)
+        samples.append((torch.zeros((3, h, w), dtype=torch.uint8), torch.FloatTensor([[x, y, x + box_w, y + box_h]]),
+                        torch.LongTensor([1])))
+    return samples
+
+
+def loop_random_crop(image, boxes, labels):
+    """
+    The previous, one trial at a time, implementation of utils.random_crop(), as a baseline.
+    """
+    original_h = image.size(1)
+    original_w = image.size(2)
+    while True:
+        min_overlap = random.choice([.5, .7, .9, None])
+        if min_overlap is None:
+            return image, boxes, labels
+        for _ in range(50):
+            new_h = int(random.uniform(0.3, 1) * original_h)
+            new_w = int(random.uniform(0.3, 1) * original_w)
+            if not 0.5 < new_h / new_w < 2:
+                continue
+            left = random.randint(0, original_w - new_w)
+            right = left + new_w
+            top = random.randint(0, original_h - new_h)
+            bottom = top + new_h
+            crop = torch.FloatTensor([left, top, right, bottom])
+            overlap = find_jaccard_overlap(crop.unsqueeze(0), boxes).squeeze(0)
+            if overlap.max().item() < min_overlap:
+                continue
+            new_image = image[:, top:bottom, left:right]
+            bb_centers = (boxes[:, :2] + boxes[:, 2:]) / 2.
+            centers_in_crop = (bb_centers[:, 0] > left) * (bb_centers[:, 0] < right) * (bb_centers[:, 1] > top) * (
+                    bb_centers[:, 1] < bottom)
+            if not centers_in_crop.any():
+                continue
+            new_boxes = boxes[centers_in_crop, :]
+            new_labels = labels[centers_in_crop]
+            new_boxes[:, :2] = torch.max(new_boxes[:, :2], crop[:2])
+            new_boxes[:, :2] -= crop[:2]
+            new_boxes[:, 2:] = torch.min(new_boxes[:, 2:], crop[2:])
+            new_boxes[:, 2:] -= crop[:2]
+            return new_image, new_boxes, new_labels
+
+
+def crop_statistics(crop_function, samples, repeats):
+    """
+    :return: seconds per sample, and the (repeats * samples, 4) array of the relative crop height, width and box center
+    """
+    outputs = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for image, boxes, labels in samples:
+            new_image, new_boxes, _ = crop_function(image, boxes.clone(), labels)
+            outputs.append((new_image.size(1) / image.size(1), new_image.size(2) / image.size(2),
+                            float(new_boxes[0, 0] + new_boxes[0, 2]) / 2 / new_image.size(2),
+                            float(new_boxes[0, 1] + new_boxes[0, 3]) / 2 / new_image.size(1)))
+    seconds = (time.perf_counter() - start) / (repeats * len(samples))
+    return seconds, np.array(outputs)
+
+
+def ks_statistic(a, b):
+    """
+    :return: two-sample Kolmogorov-Smirnov statistic, the max distance between the empirical CDFs of a and b
+    """
+    a, b = np.sort(a), np.sort(b)
+    values = np.concatenate([a, b])
+    return float(np.abs(np.searchsorted(a, values, side='right') / len(a) -
+                        np.searchsorted(b, values, side='right') / len(b)).max())
+
+
+def ks_critical_value(n, m, alpha):
+    """
+    :return: asymptotic critical value of the two-sample KS statistic for samples of sizes n and m at level alpha
+    (conservative for distributions with atoms, like the uncropped samples)
+    """
+    return np.sqrt(-np.log(alpha / 2) / 2 * (n + m) / (n * m))
+
+
+def compare_crop_distributions(outputs, alpha):
+    """
+    :param outputs: the two crop_statistics() arrays
+    :param alpha: level of the test of each output distribution, Bonferroni-corrected for the 4 of them
+    :return: KS statistic of each output, critical value
+    """
+    a, b = outputs
+    statistics = [ks_statistic(a[:, i], b[:, i]) for i in range(a.shape[1])]
+    return statistics, ks_critical_value(len(a), len(b), alpha / a.shape[1])
+
+
+def benchmark_random_crop(args):
+    torch.set_num_threads(1)  # like a DataLoader worker
+    samples = make_synthetic_samples(args.samples)
+    print(f'random_crop on {args.samples} synthetic samples x {args.repeats} repeats')
+    print(f'{"implementation":<12}{"us/sample":>12}   mean (crop h, crop w, box cx, box cy) +- std')
+    outputs = []
+    for name, crop_function in [('loop', loop_random_crop), ('vectorized', random_crop)]:
+        random.seed(0)
+        torch.manual_seed(0)
+        seconds, output = crop_statistics(crop_function, samples, args.repeats)
+        outputs.append(output)
+        print(f'{name:<12}{seconds * 1e6:>12.1f}   {np.round(output.mean(axis=0), 3)} +- '
+              f'{np.round(output.std(axis=0), 3)}')
+
+    statistics, critical_value = compare_crop_distributions(outputs, args.alpha)
+    passed = max(statistics) <= critical_value
+    print(f'KS statistics loop vs vectorized {np.round(statistics, 4)}, critical value {critical_value:.4f} '
+          f'(alpha {args.alpha}): {"PASS" if passed else "FAIL"}')
+    if not passed:
+        raise SystemExit('the vectorized random_crop() outputs are not distributed like the loop ones')
+
+
+def make_smooth_samples(n_samples, seed=42):
+    """
+    :return: make_synthetic_samples() with smooth uint8 images (random 6x6 pixels, upscaled), closer to photos than
+    noise
+    """
+    generator = torch.Generator().manual_seed(seed)
+    samples = []
+    for image, boxes, labels in make_synthetic_samples(n_samples, seed=seed):
+        pixels = torch.randint(0, 256, (3, 6, 6), dtype=torch.uint8, generator=generator)
+        samples.append((FT.resize(pixels, list(image.shape[1:])), boxes, labels))
+    return samples
+
+
+def sample_expand_crop(samples):
+    """
+    Sample the expand and crop parameters once, so that the unfused and fused paths compute the same output.
+
+    :return: list of ((expanded height, width, left, top), crop region [left, top, right, bottom])
+    """
+    params = []
+    for image, boxes, _ in samples:
+        height, width, left, top = sample_expand(image.size(1), image.size(2))
+        crop, _ = sample_random_crop(height, width, boxes + torch.FloatTensor([left, top, left, top]))
+        params.append(((height, width, left, top), [0, 0, width, height] if crop is None else crop.long().tolist()))
+    return params
+
+
+def unfused_expand_crop_resize(image, filler, expand_params, region):
+    """
+    expand() -> crop -> resize(), the path utils.expand_crop_resize() replaces, as a baseline.
+
+    :return: resized crop, bytes of the expanded canvas
+    """
+    height, width, left, top = expand_params
+    new_image = torch.empty((3, height, width), dtype=image.dtype)  # the zoomed-out canvas of expand()
+    new_image[:] = torch.tensor(filler, dtype=image.dtype).view(3, 1, 1)
+    new_image[:, top:top + image.size(1), left:left + image.size(2)] = image
+    new_image = new_image[:, region[1]:region[3], region[0]:region[2]]
+    return FT.resize(new_image, [224, 224], antialias=True), height * width * 3
+
+
+def fused_expand_crop_resize(image, filler, expand_params, region):
+    """
+    :return: utils.expand_crop_resize(), bytes of its output canvas
+    """
+    _, _, left, top = expand_params
+    return expand_crop_resize(image, filler, (left, top), region), 224 * 224 * 3
+
+
+def expand_crop_resize_differences(unfused_outputs, fused_outputs):
+    """
+    :return: mean absolute pixel difference (out of 255) of each unfused and fused output
+    """
+    return torch.stack([(a.float() - b.float()).abs().mean() for a, b in zip(unfused_outputs, fused_outputs)])
+
+
+def benchmark_expand_crop_resize(args):
+    torch.set_num_threads(1)  # like a DataLoader worker
+    filler = [133, 125, 121]  # MasksDataset mean in [0, 255]
+    samples = make_smooth_samples(args.samples)
+    params = sample_expand_crop(samples)
+
+    outputs = {}
+    print(f'expand -> crop -> resize to 224x224 on {args.samples} smooth synthetic uint8 samples x {args.repeats} '
+          f'repeats')
+    print(f'{"implementation":<12}{"us/sample":>12}{"mean canvas MB":>16}{"max canvas MB":>16}')
+    for name, function in [('unfused', unfused_expand_crop_resize), ('fused', fused_expand_crop_resize)]:
+        canvas_bytes = []
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            outputs[name] = []
+            for (image, _, _), (expand_params, region) in zip(samples, params):
+                output, nbytes = function(image, filler, expand_params, region)
+                outputs[name].append(output)
+                canvas_bytes.append(nbytes)
+        seconds = (time.perf_counter() - start) / (args.repeats * len(samples))
+        print(f'{name:<12}{seconds * 1e6:>12.1f}{np.mean(canvas_bytes) / 2 ** 20:>16.2f}'
+              f'{np.max(canvas_bytes) / 2 ** 20:>16.2f}')
+
+    # the fused path rounds the edges of the resized image to whole output pixels: differences along them only
+    differences = expand_crop_resize_differences(outputs['unfused'], outputs['fused'])
+    passed = differences.mean() <= args.max_mean_difference and differences.max() <= args.max_sample_difference
+    print(f'mean absolute pixel difference fused vs unfused: {differences.mean():.3f} (max {differences.max():.3f})'
+          f' out of 255, tolerance {args.max_mean_difference} (max {args.max_sample_difference}): '
+          f'{"PASS" if passed else "FAIL"}')
+    if not passed:
+        raise SystemExit('the fused expand_crop_resize() outputs differ from the unfused ones')
+
+
+def decode_fidelity(full_image, reduced_image, box):
+    """
+    Compare what MasksDataset feeds the model, the 224x224 image and the box in it, of the full and reduced decodes.
+
+    :param full_image: PIL image, full decode
+    :param reduced_image: PIL image, reduced decode (see dataset.decode_image())
+    :param box: [x, y, w, h] of the face in the full image
+    :return: PSNR (dB), mean absolute pixel difference (out of 255), max box coordinate difference (pixels)
+    """
+    full, reduced = [FT.to_tensor(FT.resize(image, (224, 224))) for image in (full_image, reduced_image)]
+    mse = float(((full - reduced) ** 2).mean())
+    psnr = 10 * np.log10(1. / mse) if mse > 0 else float('inf')
+
+    x, y, w, h = box
+    box = torch.FloatTensor([[x, y, x + w, y + h]])
+    boxes = []
+    for image in (full_image, reduced_image):
+        scale = torch.FloatTensor([image.width / full_image.width, image.height / full_image.height] * 2).unsqueeze(0)
+        dims = torch.FloatTensor([image.width, image.height] * 2).unsqueeze(0)
+        boxes.append(resize_box(box * scale, dims, (224, 224), return_percent_coords=False))
+    return psnr, float((full - reduced).abs().mean()) * 255, float((boxes[0] - boxes[1]).abs().max())
+
+
+def benchmark_reduced_decode(args):
+    from dataset import decode_image
+    from manifest import parse_filename
+    filenames = sorted(os.listdir(args.data_folder))[:args.max_images]
+    decode_seconds = {'full': 0., 'reduced': 0.}
+    decoded_pixels = {'full': 0, 'reduced': 0}
+    mean_abs_differences, psnrs, box_differences = [], [], []
+    for filename in filenames:
+        path = os.path.join(args.data_folder, filename)
+        images = {}
+        for name, draft_size in [('full', None), ('reduced', (224, 224))]:
+            start = time.perf_counter()
+            image = decode_image(path, draft_size=draft_size)
+            decode_seconds[name] += time.perf_counter() - start
+            decoded_pixels[name] += image.width * image.height
+            images[name] = image
+
+        if images['reduced'].size == images['full'].size:  # too small to be reduced
+            continue
+        psnr, mean_abs_difference, box_difference = decode_fidelity(images['full'], images['reduced'],
+                                                                    parse_filename(filename)[1])
+        psnrs.append(psnr)
+        mean_abs_differences.append(mean_abs_difference)
+        box_differences.append(box_difference)
+
+    n = len(filenames)
+    print(f'JPEG decode of {n} images from {args.data_folder}')
+    print(f'{"decode":<10}{"ms/image":>10}{"MB decoded/image":>18}')
+    for name in ('full', 'reduced'):
+        print(f'{name:<10}{decode_seconds[name] / n * 1e3:>10.2f}{decoded_pixels[name] * 3 / n / 2 ** 20:>18.2f}')
+    if not psnrs:
+        print('no image large enough to be reduced, fidelity not checked')
+        return
+    passed = (np.median(psnrs) >= args.min_median_psnr and np.min(psnrs) >= args.min_psnr and
+              np.max(box_differences) <= args.max_box_difference)
+    print(f'224x224 fidelity of reduced vs full decode over the {len(psnrs)} reduced images: mean absolute '
+          f'difference {np.mean(mean_abs_differences):.2f}/255, PSNR {np.median(psnrs):.1f} dB (median), '
+          f'min {np.min(psnrs):.1f} dB, max box difference {np.max(box_differences):.4f} px, tolerance PSNR '
+          f'{args.min_median_psnr} dB (median), min {args.min_psnr} dB, box difference {args.max_box_difference} px: '
+          f'{"PASS" if passed else "FAIL"}')
+    if not passed:
+        raise SystemExit('the reduced decode differs from the full decode beyond the tolerances')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def benchmark_serve_load(args):
+    import serve
+    filenames = sorted(os.listdir(args.data_folder))[:args.max_images]
+    files = []
+    for filename in filenames:
+        with open(os.path.join(args.data_folder, filename), 'rb') as f:
+            files.append(f.read())
+
+    server = None
+    if args.url is None and args.unix_socket is None:
+        # serve in this process, on a free port
+        model = get_fasterrcnn_resnet50_fpn(weights_path=get_weights_path(args.weights, offline=args.offline)).eval()
+        batcher = serve.MicroBatcher(model, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+        server = serve.make_server(batcher, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        args.url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    def connect():
+        if args.unix_socket is not None:
+            return UnixHTTPConnection(args.unix_socket)
+        url = urllib.parse.urlparse(args.url)
+        return http.client.HTTPConnection(url.hostname, url.port)
+
+    def post(connection, k):
+        if args.images_per_request == 1:
+            body, headers = files[k % len(files)], {'Content-Type': 'application/octet-stream'}
+        else:
+            images = [files[(k * args.images_per_request + j) % len(files)] for j in range(args.images_per_request)]
+            body = json.dumps(dict(images=[base64.b64encode(image).decode() for image in images])).encode()
+            headers = {'Content-Type': 'application/json'}
+        connection.request('POST', '/predict', body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200, f'server answered {response.status}'
+
+    def health():
+        connection = connect()
+        connection.request('GET', '/health')
+        return json.loads(connection.getresponse().read())
+
+    warmup = connect()
+    for k in range(args.warmup):
+        post(warmup, k)
+    warmup.close()
+
+    print(f'{args.requests} requests of {args.images_per_request} image(s) from {args.data_folder} to '
+          f'{args.unix_socket or args.url}')
+    print(f'{"concurrency":>12}{"p50 ms":>10}{"p99 ms":>10}{"requests/s":>12}{"images/s":>10}{"mean batch":>12}')
+    for concurrency in args.concurrency:
+        latencies = []
+        before = health()
+
+        def client(worker):
+            connection = connect()
+            for k in range(worker, args.requests, concurrency):
+                start = time.perf_counter()
+                post(connection, k)
+                latencies.append(time.perf_counter() - start)
+            connection.close()
+
+        threads = [threading.Thread(target=client, args=(worker,)) for worker in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+
+        after = health()
+        n_batches = after['batches'] - before['batches']
+        mean_batch = (after['images'] - before['images']) / n_batches if n_batches else 0.
+        print(f'{concurrency:>12}{np.percentile(latencies, 50) * 1e3:>10.1f}{np.percentile(latencies, 99) * 1e3:>10.1f}'
+              f'{len(latencies) / seconds:>12.2f}{len(latencies) * args.images_per_request / seconds:>10.2f}'
+              f'{mean_batch:>12.2f}')
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+def model_latency(model, batch_size, repeats, device=torch.device('cpu')):
+    """
+    :return: seconds per image of the model on random 224x224 images
+    """
+    torch.manual_seed(0)
+    images = [torch.rand(3, 224, 224, device=device) for _ in range(batch_size)]
+    with torch.no_grad():
+        model(images)  # warm up (the first TorchScript calls are profiling runs)
+        model(images)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(images)
+    return (time.perf_counter() - start) / (repeats * batch_size)
+
+
+def state_dict_bytes(model):
+    """
+    :return: bytes of the parameters and buffers of the model (quantized tensors count their int8 bytes)
+    """
+    def nbytes(value):
+        if torch.is_tensor(value):
+            return value.numel() * value.element_size()
+        if isinstance(value, (list, tuple)):  # packed params of dynamically quantized layers
+            return sum(nbytes(v) for v in value)
+        return 0
+    return sum(nbytes(value) for value in model.state_dict().values())
+
+
+def benchmark_torchscript(args):
+    from export import export_torchscript, load_artifact
+    start = time.perf_counter()
+    eager = get_fasterrcnn_resnet50_fpn(weights_path=get_weights_path(args.weights, offline=args.offline)).eval()
+    load_seconds = {'eager': time.perf_counter() - start}
+    device = next(eager.parameters()).device
+
+    artifact = args.artifact
+    if artifact is None:
+        artifact = os.path.join(tempfile.mkdtemp(), 'faster_rcnn.torchscript.pt')
+        export_torchscript(eager, artifact)
+    start = time.perf_counter()
+    scripted = load_artifact(artifact, device)
+    load_seconds['torchscript'] = time.perf_counter() - start
+
+    print(f'eager vs TorchScript ({artifact}) on {device}, {args.repeats} repeats per batch size')
+    print(f'{"model":<13}{"load s":>8}{"batch":>7}{"ms/image":>10}{"images/s":>10}')
+    for name, model in [('eager', eager), ('torchscript', scripted)]:
+        for batch_size in args.batch_sizes:
+            seconds = model_latency(model, batch_size, args.repeats, device)
+            print(f'{name:<13}{load_seconds[name]:>8.2f}{batch_size:>7}{seconds * 1e3:>10.1f}{1 / seconds:>10.2f}')
+
+
+def benchmark_quantization(args):
+    from dataset import MasksDataset, collate_fn
+    from eval import evaluate
+    from export import export_torchscript
+    from quantize import calibration_loader, quantize_model
+    cpu = torch.device('cpu')
+    fp32 = get_fasterrcnn_resnet50_fpn(weights_path=get_weights_path(args.weights, offline=args.offline))
+    fp32 = fp32.cpu().eval()
+    loader = calibration_loader(args.calibration_folder, args.calibration_images)
+    int8 = quantize_model(fp32, loader)
+
+    dataset = MasksDataset(data_folder=args.data_folder, split='test', lazy=True)
+    eval_loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+                                              collate_fn=collate_fn)
+
+    directory = tempfile.mkdtemp()
+    print(f'fp32 vs int8 (backbone + FPN static, box head dynamic, {len(loader.dataset)} calibration images of '
+          f'{args.calibration_folder}), {len(dataset)} images of {args.data_folder}, on the CPU')
+    print(f'{"model":<7}{"IoU":>8}{"accuracy":>10}{"ms/image":>10}{"weights MB":>12}{"artifact MB":>13}')
+    for name, model in [('fp32', fp32), ('int8', int8)]:
+        accuracy, iou = evaluate(eval_loader, model, device=cpu)
+        seconds = model_latency(model, args.batch_size, args.repeats)
+        path = os.path.join(directory, f'{name}.torchscript.pt')
+        export_torchscript(model, path)
+        print(f'{name:<7}{float(iou):>8.4f}{float(accuracy):>10.4f}{seconds * 1e3:>10.1f}'
+              f'{state_dict_bytes(model) / 2 ** 20:>12.1f}{os.path.getsize(path) / 2 ** 20:>13.1f}')
+
+
+def benchmark_proposal_profiles(args):
+    from dataset import MasksDataset, collate_fn
+    from eval import evaluate
+    model = get_fasterrcnn_resnet50_fpn(weights_path=get_weights_path(args.weights, offline=args.offline)).eval()
+    device = next(model.parameters()).device
+    dataset = MasksDataset(data_folder=args.data_folder, split='test', packed=True)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate_fn)
+
+    print(f'Proposal profiles on {len(dataset)} images of {args.data_folder}, batch size {args.batch_size}, {device}')
+    print(f'{"profile":<10}{"pre-NMS":>9}{"post-NMS":>10}{"ms/image":>10}{"IoU":>8}{"accuracy":>10}')
+    for profile in args.profiles:
+        apply_proposal_profile(model, profile)
+        model_latency(model, args.batch_size, 1, device)  # warm up
+        start = time.perf_counter()
+        accuracy, iou = evaluate(loader, model, device=device)
+        seconds = (time.perf_counter() - start) / len(dataset)
+        budgets = PROPOSAL_PROFILES[profile]
+        print(f'{profile:<10}{budgets["rpn_pre_nms_top_n_test"]:>9}{budgets["rpn_post_nms_top_n_test"]:>10}'
+              f'{seconds * 1e3:>10.1f}{float(iou):>8.4f}{float(accuracy):>10.4f}')
+
+
+def count_flops(model, images):
+    """
+    :return: FLOPs (2 x multiply-adds) of the convolutions and linear layers of one forward pass of the model, of
+    which in the backbone (+ FPN)
+    """
+    flops = []
+    backbone_modules = set(model.backbone.modules())
+
+    def conv_hook(module, inputs, output):
+        kernel_ops = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+        flops.append((module in backbone_modules, 2 * output.numel() * kernel_ops))
+
+    def linear_hook(module, inputs, output):
+        flops.append((module in backbone_modules, 2 * output.numel() * module.in_features))
+
+    handles = [module.register_forward_hook(conv_hook) for module in model.modules()
+               if isinstance(module, torch.nn.Conv2d)]
+    handles += [module.register_forward_hook(linear_hook) for module in model.modules()
+                if isinstance(module, torch.nn.Linear)]
+    try:
+        with torch.no_grad():
+            model(images)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return sum(f for _, f in flops), sum(f for in_backbone, f in flops if in_backbone)
+
+
+def benchmark_backbones(args):
+    from dataset import MasksDataset, collate_fn
+    from eval import evaluate
+    checkpoints = dict(checkpoint.split('=', 1) for checkpoint in args.checkpoints)
+    loader = None
+    if checkpoints:
+        dataset = MasksDataset(data_folder=args.data_folder, split='test', packed=True)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=20, shuffle=False, collate_fn=collate_fn)
+
+    # the total FLOPs depend on the number of proposals of the box head, i.e. on the weights and the profile
+    print(f'Backbones at 224x224, {args.profile} proposal profile, CPU latency at batch size {args.batch_size}' +
+          (f', IoU/accuracy on {args.data_folder}' if checkpoints else ''))
+    print(f'{"backbone":<20}{"params M":>10}{"backbone GFLOPs":>17}{"total GFLOPs":>14}{"ms/image":>10}{"IoU":>8}'
+          f'{"accuracy":>10}')
+    for backbone in args.backbones:
+        model = get_fasterrcnn_resnet50_fpn(weights_path=checkpoints.get(backbone), backbone=backbone,
+                                            profile=args.profile)
+        model = model.cpu().eval()
+        params = sum(p.numel() for p in model.parameters())
+        flops, backbone_flops = count_flops(model, [torch.rand(3, 224, 224)])
+        seconds = model_latency(model, args.batch_size, args.repeats)
+        iou, accuracy = '-', '-'
+        if backbone in checkpoints:
+            accuracy, iou = evaluate(loader, model, device=torch.device('cpu'))
+            iou, accuracy = f'{iou:.4f}', f'{accuracy:.4f}'
+        print(f'{backbone:<20}{params / 1e6:>10.1f}{backbone_flops / 1e9:>17.2f}{flops / 1e9:>14.2f}'
+              f'{seconds * 1e3:>10.1f}{iou:>8}{accuracy:>10}')
+
+
+def benchmark_sharded_predict(args):
+    from dataset import MasksDataset
+    from sharded_predict import predict_sharded, default_threads
+    weights_path = get_weights_path(args.weights, offline=args.offline)
+    n_images = len(MasksDataset(data_folder=args.data_folder, split='test', packed=True))  # pack before timing
+    csv_path = os.path.join(tempfile.mkdtemp(), 'prediction.csv')
+
+    print(f'Sharded prediction of {n_images} images of {args.data_folder}, batch size {args.batch_size}, '
+          f'{os.cpu_count()} cores, wall time including the model loading of every worker')
+    print(f'{"workers":<9}{"threads":>8}{"wall s":>8}{"images/s":>10}{"speedup":>9}{"efficiency":>12}'
+          f'{"slowest worker images/s":>25}')
+    baseline = None
+    for processes in args.processes:
+        threads = args.threads or default_threads(processes)
+        start = time.perf_counter()
+        _, _, stats = predict_sharded(args.data_folder, csv_path, processes, threads=threads,
+                                      weights_path=weights_path, profile=args.profile, batch_size=args.batch_size)
+        seconds = time.perf_counter() - start
+        workers = len(stats)  # at most the number of batches
+        baseline = baseline or (workers, n_images / seconds)  # speedups relative to the first configuration
+        speedup = n_images / seconds / baseline[1]
+        slowest = min(s['images'] / s['predict'] for s in stats)
+        print(f'{workers:<9}{threads:>8}{seconds:>8.2f}{n_images / seconds:>10.2f}{speedup:>8.2f}x'
+              f'{speedup * baseline[0] / workers:>12.0%}{slowest:>25.2f}')
+
+
+def peak_memory_bytes(device):
+    """
+    :return: peak GPU memory allocated by torch on CUDA, peak RSS of the process on the CPU
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        import resource
+    except ImportError:  # Windows, the current RSS only
+        from telemetry import rss_bytes
+        return rss_bytes()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on Linux
+
+
+def training_run(job):
+    """
+    Train (one pass over the first train_images images) then evaluate (if test_folder) in one configuration, in a
+    fresh process so that the peak memory is its own.
+
+    :param job: dict of weights_path, profile, train_folder, train_images, test_folder, batch_size, and optionally
+    precision, channels_last, micro_batch_size and checkpoint_stages (see train.main())
+    :return: dict of the training and evaluation images/s, peak memory bytes, mean training loss, IoU and accuracy
+    """
+    import train  # device and learning parameters of the training
+    from dataset import MasksDataset, collate_fn
+    from eval import evaluate
+    torch.manual_seed(0)
+    random.seed(0)
+    device = train.device
+    precision = job.get('precision', 'fp32')
+    model = get_fasterrcnn_resnet50_fpn(weights_path=job['weights_path'], profile=job['profile'],
+                                        checkpoint_stages=job.get('checkpoint_stages', 0))
+    if job.get('channels_last'):
+        to_channels_last(model)
+    optimizer = torch.optim.Adam(model.parameters(), lr=train.lr)
+
+    train_dataset = MasksDataset(data_folder=job['train_folder'], split='train', lazy=True)
+    train_dataset = torch.utils.data.Subset(train_dataset, range(min(job['train_images'], len(train_dataset))))
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=job['batch_size'], shuffle=False,
+                                               collate_fn=collate_fn)
+    start = time.perf_counter()
+    loss = train.train(train_loader, model, optimizer, epoch=0, precision=precision,
+                       micro_batch_size=job.get('micro_batch_size'))
+    result = dict(train=len(train_dataset) / (time.perf_counter() - start), loss=loss)
+
+    if job['test_folder']:
+        test_dataset = MasksDataset(data_folder=job['test_folder'], split='test', packed=True)
+        test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=job['batch_size'], shuffle=False,
+                                                  collate_fn=collate_fn)
+        start = time.perf_counter()
+        result['accuracy'], result['iou'] = evaluate(test_loader, model, device=device, precision=precision)
+        result['eval'] = len(test_dataset) / (time.perf_counter() - start)
+    result['memory'] = peak_memory_bytes(device)
+    return result
+
+
+def run_in_process(function, job):
+    """
+    :return: function(job), called in a fresh (spawned) process
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(function, (job,))
+
+
+def benchmark_precision(args):
+    weights_path = get_weights_path(args.weights, offline=args.offline)
+    print(f'{args.train_images} training images of {args.train_folder} (one pass, starting from {weights_path}), '
+          f'then evaluation on {args.test_folder}, batch size {args.batch_size}, one process per configuration')
+    print(f'{"precision":<11}{"channels_last":>14}{"train images/s":>16}{"eval images/s":>15}{"peak MB":>9}'
+          f'{"IoU":>8}{"accuracy":>10}')
+    for precision in args.precisions:
+        for channels_last in (False, True):
+            job = dict(precision=precision, channels_last=channels_last, weights_path=weights_path,
+                       profile=args.profile, train_folder=args.train_folder, test_folder=args.test_folder,
+                       train_images=args.train_images, batch_size=args.batch_size)
+            result = run_in_process(training_run, job)
+            print(f'{precision:<11}{str(channels_last):>14}{result["train"]:>16.2f}{result["eval"]:>15.2f}'
+                  f'{result["memory"] / 2 ** 20:>9.0f}{float(result["iou"]):>8.4f}{float(result["accuracy"]):>10.4f}')
+
+
+def benchmark_memory_budget(args):
+    weights_path = get_weights_path(args.weights, offline=args.offline)
+    print(f'{args.train_images} training images of {args.train_folder} (one pass, starting from {weights_path}), '
+          f'batch size {args.batch_size}, one process per configuration')
+    print(f'{"micro-batch":<13}{"checkpointed stages":>21}{"peak MB":>9}{"images/s":>10}{"loss":>9}')
+    for config in args.configs:
+        micro_batch_size, _, checkpoint_stages = config.partition(':')
+        job = dict(weights_path=weights_path, profile=args.profile, train_folder=args.train_folder,
+                   train_images=args.train_images, test_folder=None, batch_size=args.batch_size,
+                   micro_batch_size=int(micro_batch_size), checkpoint_stages=int(checkpoint_stages or 0))
+        result = run_in_process(training_run, job)
+        print(f'{job["micro_batch_size"]:<13}{job["checkpoint_stages"]:>21}{result["memory"] / 2 ** 20:>9.0f}'
+              f'{result["train"]:>10.2f}{result["loss"]:>9.4f}')
+
+
+def benchmark_checkpoint(args):
+    from checkpoints import CheckpointManager
+    model = get_fasterrcnn_resnet50_fpn(backbone=args.backbone)
+    optimizer = torch.optim.Adam(model.parameters())
+    for parameter in model.parameters():
+        parameter.grad = torch.zeros_like(parameter)
+    optimizer.step()  # allocate the optimizer state
+    metrics = dict(test_iou=[])
+    directory = tempfile.mkdtemp(dir=args.directory)
+
+    print(f'{args.saves} checkpoints of a {args.backbone} model with its Adam state to {directory}, '
+          f'{args.interval} s of simulated training between saves')
+    print(f'{"save":<34}{"mean stall s":>14}{"max stall s":>13}')
+    try:
+        stalls = []
+        for epoch in range(args.saves):
+            start = time.perf_counter()
+            torch.save({'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict(), 'metrics': metrics},
+                       os.path.join(directory, f'sync_{epoch}.pth.tar'))
+            stalls.append(time.perf_counter() - start)
+            time.sleep(args.interval)
+        print(f'{"synchronous torch.save()":<34}{np.mean(stalls):>14.3f}{max(stalls):>13.3f}')
+
+        manager = CheckpointManager(directory, keep_last=2)
+        for epoch in range(args.saves):
+            metrics['test_iou'].append(random.random())
+            manager.save(epoch, model, optimizer, metrics)
+            time.sleep(args.interval)
+        manager.close()
+        print(f'{"CheckpointManager.save()":<34}{np.mean(manager.stalls):>14.3f}{max(manager.stalls):>13.3f}')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    random_crop_parser = subparsers.add_parser('random-crop', help='loop vs vectorized utils.random_crop()')
+    random_crop_parser.add_argument('--samples', type=int, default=200, help='number of synthetic samples')
+    random_crop_parser.add_argument('--repeats', type=int, default=20, help='passes over the samples')
+    random_crop_parser.add_argument('--alpha', type=float, default=0.01,
+                                    help='level of the KS test of the loop vs vectorized output distributions')
+    random_crop_parser.set_defaults(func=benchmark_random_crop)
+
+    expand_parser = subparsers.add_parser('expand-crop-resize', help='expand() canvas vs fused expand_crop_resize()')
+    expand_parser.add_argument('--samples', type=int, default=100, help='number of synthetic samples')
+    expand_parser.add_argument('--repeats', type=int, default=5, help='passes over the samples')
+    expand_parser.add_argument('--max-mean-difference', type=float, default=1.,
+                               help='tolerance of the mean absolute pixel difference fused vs unfused, out of 255')
+    expand_parser.add_argument('--max-sample-difference', type=float, default=2.,
+                               help='tolerance of the mean absolute pixel difference of each sample, out of 255')
+    expand_parser.set_defaults(func=benchmark_expand_crop_resize)
+
+    decode_parser = subparsers.add_parser('reduced-decode', help='full vs DCT-domain reduced JPEG decoding')
+    decode_parser.add_argument('--data-folder', type=str, default=os.path.join(os.path.dirname(__file__),
+                                                                               'example_images'))
+    decode_parser.add_argument('--max-images', type=int, default=1000)
+    decode_parser.add_argument('--min-median-psnr', type=float, default=27., help='tolerance of the median PSNR (dB) '
+                               'of the 224x224 reduced vs full decoded images')
+    decode_parser.add_argument('--min-psnr', type=float, default=22., help='tolerance of the PSNR of every image (dB)')
+    decode_parser.add_argument('--max-box-difference', type=float, default=.5,
+                               help='tolerance of the 224x224 box coordinates difference (pixels)')
+    decode_parser.set_defaults(func=benchmark_reduced_decode)
+
+    load_parser = subparsers.add_parser('serve-load', help='latency and throughput of serve.py under concurrent load')
+    load_parser.add_argument('--url', type=str, default=None, help='server url, e.g. http://127.0.0.1:8000 '
+                                                                   '(default: serve in this process)')
+    load_parser.add_argument('--unix-socket', type=str, default=None, help='server unix socket')
+    load_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='concurrent clients')
+    load_parser.add_argument('--requests', type=int, default=64, help='requests per concurrency level')
+    load_parser.add_argument('--images-per-request', type=int, default=1)
+    load_parser.add_argument('--warmup', type=int, default=2, help='requests sent before measuring')
+    load_parser.add_argument('--data-folder', type=str, default=os.path.join(os.path.dirname(__file__),
+                                                                             'example_images'))
+    load_parser.add_argument('--max-images', type=int, default=100)
+    load_parser.add_argument('--max-batch-size', type=int, default=16, help='of the in-process server')
+    load_parser.add_argument('--max-wait-ms', type=float, default=10., help='of the in-process server')
+    load_parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH, help='of the in-process server')
+    load_parser.add_argument('--offline', action='store_true', default=constants.OFFLINE)
+    load_parser.set_defaults(func=benchmark_serve_load)
+
+    torchscript_parser = subparsers.add_parser('torchscript', help='eager vs exported TorchScript model (export.py)')
+    torchscript_parser.add_argument('--artifact', type=str, default=None, help='default: export to a temporary file')
+    torchscript_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8])
+    torchscript_parser.add_argument('--repeats', type=int, default=5)
+    torchscript_parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH)
+    torchscript_parser.add_argument('--offline', action='store_true', default=constants.OFFLINE)
+    torchscript_parser.set_defaults(func=benchmark_torchscript)
+
+    quantization_parser = subparsers.add_parser('quantization', help='fp32 vs int8 model (quantize.py)')
+    quantization_parser.add_argument('--data-folder', type=str, default=constants.TEST_IMG_PATH,
+                                     help='images of the IoU and accuracy evaluation')
+    quantization_parser.add_argument('--calibration-folder', type=str, default=constants.TRAIN_IMG_PATH)
+    quantization_parser.add_argument('--calibration-images', type=int, default=200)
+    quantization_parser.add_argument('--batch-size', type=int, default=8)
+    quantization_parser.add_argument('--repeats', type=int, default=5)
+    quantization_parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH)
+    quantization_parser.add_argument('--offline', action='store_true', default=constants.OFFLINE)
+    quantization_parser.set_defaults(func=benchmark_quantization)
+
+    profiles_parser = subparsers.add_parser('proposal-profiles',
+                                            help='latency vs IoU/accuracy of model.PROPOSAL_PROFILES')
+    profiles_parser.add_argument('--data-folder', type=str, default=constants.TEST_IMG_PATH)
+    profiles_parser.add_argument('--profiles', type=str, nargs='+', default=list(PROPOSAL_PROFILES),
+                                 choices=list(PROPOSAL_PROFILES))
+    profiles_parser.add_argument('--batch-size', type=int, default=20)
+    profiles_parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH)
+    profiles_parser.add_argument('--offline', action='store_true', default=constants.OFFLINE)
+    profiles_parser.set_defaults(func=benchmark_proposal_profiles)
+
+    backbones_parser = subparsers.add_parser('backbones', help='params, FLOPs, latency and IoU of model.BACKBONES')
+    backbones_parser.add_argument('--backbones', type=str, nargs='+', default=list(BACKBONES), choices=list(BACKBONES))
+    backbones_parser.add_argument('--checkpoints', type=str, nargs='*', default=[],
+                                  help='trained checkpoints to evaluate, as backbone=path')
+    backbones_parser.add_argument('--data-folder', type=str, default=constants.TEST_IMG_PATH)
+    backbones_parser.add_argument('--profile', type=str, default='default', choices=list(PROPOSAL_PROFILES))
+    backbones_parser.add_argument('--batch-size', type=int, default=8)
+    backbones_parser.add_argument('--repeats', type=int, default=3)
+    backbones_parser.set_defaults(func=benchmark_backbones)
+
+    sharded_parser = subparsers.add_parser('sharded-predict',
+                                           help='images/s of sharded_predict.py against the number of workers')
+    sharded_parser.add_argument('--data-folder', type=str, default=constants.TEST_IMG_PATH)
+    sharded_parser.add_argument('--processes', type=int, nargs='+',
+                                default=sorted({1, 2, 4, 8, os.cpu_count() or 1}))
+    sharded_parser.add_argument('--threads', type=int, default=None,
+                                help='torch threads per worker, by default the cores split between the workers')
+    sharded_parser.add_argument('--profile', type=str, default='default', choices=list(PROPOSAL_PROFILES))
+    sharded_parser.add_argument('--batch-size', type=int, default=20)
+    sharded_parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH)
+    sharded_parser.add_argument('--offline', action='store_true', default=constants.OFFLINE)
+    sharded_parser.set_defaults(func=benchmark_sharded_predict)
+
+    precision_parser = subparsers.add_parser('precision', help='fp32 vs bf16/fp16 autocast and channels_last, '
+                                                               'training and evaluation (precision.py)')
+    precision_parser.add_argument('--precisions', type=str, nargs='+', default=['fp32', 'bf16'],
+                                  choices=PRECISIONS)
+    precision_parser.add_argument('--train-folder', type=str, default=constants.TRAIN_IMG_PATH)
+    precision_parser.add_argument('--train-images', type=int, default=200)
+    precision_parser.add_argument('--test-folder', type=str, default=constants.TEST_IMG_PATH)
+    precision_parser.add_argument('--profile', type=str, default='default', choices=list(PROPOSAL_PROFILES))
+    precision_parser.add_argument('--batch-size', type=int, default=8)
+    precision_parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH)
+    precision_parser.add_argument('--offline', action='store_true', default=constants.OFFLINE)
+    precision_parser.set_defaults(func=benchmark_precision)
+
+    budget_parser = subparsers.add_parser('memory-budget', help='peak memory of gradient accumulation and activation '
+                                                                'checkpointing configurations of the training')
+    budget_parser.add_argument('--configs', type=str, nargs='+', default=['42', '21', '7', '7:2', '7:4'],
+                               help='micro-batch size[:number of checkpointed ResNet stages]')
+    budget_parser.add_argument('--train-folder', type=str, default=constants.TRAIN_IMG_PATH)
+    budget_parser.add_argument('--train-images', type=int, default=84)
+    budget_parser.add_argument('--profile', type=str, default='default', choices=list(PROPOSAL_PROFILES))
+    budget_parser.add_argument('--batch-size', type=int, default=42)
+    budget_parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH)
+    budget_parser.add_argument('--offline', action='store_true', default=constants.OFFLINE)
+    budget_parser.set_defaults(func=benchmark_memory_budget)
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help='training loop stall of synchronous vs background '
+                                                                 'checkpointing (checkpoints.py)')
+    checkpoint_parser.add_argument('--backbone', type=str, default='resnet50', choices=list(BACKBONES))
+    checkpoint_parser.add_argument('--directory', type=str, default='.', help='disk to write the checkpoints to')
+    checkpoint_parser.add_argument('--saves', type=int, default=5)
+    checkpoint_parser.add_argument('--interval', type=float, default=5., help='seconds of simulated training')
+    checkpoint_parser.set_defaults(func=benchmark_checkpoint)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+Training checkpoints that don't stall the training loop: save() only snapshots the model, optimizer, loss scaler,
+RNG and metrics states to CPU memory, the snapshot is serialized by a background thread (atomically, through a
+temporary file) while the next epoch trains. At most one snapshot waits for the writer, save() blocks (back-pressure)
+if the previous one is still being written.
+
+Only the checkpoints of the last keep_last epochs are kept, plus checkpoint_fasterrcnn_best.pth.tar, the one with
+the best test IoU so far (a hard link when possible). Only the checkpoints of this run are rotated, the ones the
+manager wrote and the ones up to the resumed epoch: the epoch checkpoints of another run in the directory are left
+alone. The last written snapshot is kept as a spare, the next snapshot is copied into its tensors. The checkpoints are
+loaded by model.load_checkpoint() like the ones of utils.save_checkpoint() (same 'state_dict' and 'backbone' keys),
+and by CheckpointManager.resume() to continue a killed run, see python train.py --resume.
+
+With a background evaluator (see background_eval.py) the test IoU of a checkpoint is only known after it's written:
+save(on_written=...) then keeps the checkpoint out of the rotation, and mark_best() makes it the best one once
+evaluated. After release() it's only rotated once the next checkpoint, which holds its evaluation in its metrics, is
+written: the checkpoints whose evaluation is missing from the metrics of a resumed checkpoint are still there and can
+be evaluated again (see train.main()).
+"""
+import glob
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+import time
+import numpy as np
+import torch
+from model import load_checkpoint
+
+CHECKPOINT_PATTERN = re.compile(r'checkpoint_fasterrcnn_epoch=(\d+)\.pth\.tar$')
+
+
+def cpu_copy(value, out=None):
+    """
+    :param value: tensors, and dicts, lists and tuples of them
+    :param out: a previous copy of a value of the same structure, its tensors of the same shape and dtype are copied
+    into (no allocation and page faults of new memory)
+    :return: copy of value with every tensor copied to the CPU
+    """
+    if torch.is_tensor(value):
+        if torch.is_tensor(out) and out.shape == value.shape and out.dtype == value.dtype:
+            return out.copy_(value.detach())
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        out = out if isinstance(out, dict) else {}
+        return type(value)((k, cpu_copy(v, out.get(k))) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        out = out if isinstance(out, (list, tuple)) and len(out) == len(value) else [None] * len(value)
+        return type(value)(cpu_copy(v, o) for v, o in zip(value, out))
+    return value
+
+
+def get_rng_state():
+    """
+    :return: states of the torch, random and numpy generators, of tensors and python types only (loadable with
+    torch.load(weights_only=True))
+    """
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    state = dict(torch=torch.get_rng_state(), random=random.getstate(),
+                 numpy=[name, torch.from_numpy(keys.copy()), position, has_gauss, cached_gaussian])
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['random'])
+    name, keys, position, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy(), position, has_gauss, cached_gaussian))
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager(object):
+    """
+    call example:
+        manager = CheckpointManager(keep_last=3)
+        start_epoch, metrics = manager.resume(model, optimizer)  # (0, None) without a checkpoint
+        for epoch in range(start_epoch, epochs):
+            ...
+            manager.save(epoch, model, optimizer, metrics)
+        manager.close()
+    """
+
+    def __init__(self, directory='.', keep_last=3, metric='test_iou'):
+        """
+        :param directory: directory of the checkpoints
+        :param keep_last: number of epoch checkpoints to keep (the best one is kept besides), at least 1
+        :param metric: metrics key (list of per-epoch values, higher is better) of the best checkpoint
+        """
+        if keep_last < 1:
+            raise ValueError(f'keep_last should be at least 1 (the checkpoint to resume from), got {keep_last}')
+        self.directory = directory
+        self.keep_last = keep_last
+        self.metric = metric
+        self.best_path = os.path.join(directory, 'checkpoint_fasterrcnn_best.pth.tar')
+        self.stalls = []  # seconds save() blocked the training loop, per call
+        self.owned = set()  # epochs of the checkpoints of this run, the only ones rotated
+        self.protected = set()  # epochs of the checkpoints kept out of the rotation
+        self.released = set()  # protected epochs released by the next written checkpoint
+        self.lock = threading.Lock()
+        self.errors = []
+        self.pending = queue.Queue(maxsize=1)
+        self.spare = queue.Queue(maxsize=1)  # a written snapshot, its tensors are reused by the next one
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def epoch_path(self, epoch):
+        return os.path.join(self.directory, f'checkpoint_fasterrcnn_epoch={epoch + 1}.pth.tar')
+
+    def epoch_paths(self):
+        """
+        :return: {epoch: path} of the epoch checkpoints in the directory
+        """
+        paths = {}
+        for path in glob.glob(os.path.join(glob.escape(self.directory), 'checkpoint_fasterrcnn_epoch=*.pth.tar')):
+            match = CHECKPOINT_PATTERN.search(os.path.basename(path))
+            if match:
+                paths[int(match.group(1)) - 1] = path
+        return paths
+
+    def latest(self):
+        """
+        :return: path of the checkpoint of the last epoch, None if there's none
+        """
+        paths = self.epoch_paths()
+        return paths[max(paths)] if paths else None
+
+    def save(self, epoch, model, optimizer=None, metrics=None, scaler=None, is_best=None, on_written=None):
+        """
+        Snapshot the training state to CPU memory and hand it to the background writer.
+
+        :param epoch: epoch number (from 0)
+        :param metrics: dict of per-epoch metric lists (see train.main())
+        :param scaler: GradScaler (see precision.py)
+        :param is_best: whether the checkpoint is the best one, by default if the last self.metric value of metrics is
+        the highest so far
+        :param on_written: function called with the epoch and the path of the checkpoint once written (in the writer
+        thread), the checkpoint is then kept until release(epoch) (see protect())
+        :return: seconds the call blocked
+        """
+        start = time.perf_counter()
+        self.raise_errors()
+        try:
+            spare = self.spare.get_nowait()
+        except queue.Empty:
+            spare = {}
+        checkpoint = {'state_dict': cpu_copy(model.state_dict(), spare.get('state_dict')),
+                      'backbone': getattr(model, 'backbone_name', 'resnet50'),
+                      'epoch': epoch,
+                      'rng': get_rng_state()}
+        if optimizer is not None:
+            checkpoint['optimizer'] = cpu_copy(optimizer.state_dict(), spare.get('optimizer'))
+        if scaler is not None:
+            checkpoint['scaler'] = scaler.state_dict()
+        if metrics is not None:
+            checkpoint['metrics'] = cpu_copy(metrics)
+        if is_best is None:
+            values = (metrics or {}).get(self.metric) or []
+            is_best = bool(values) and values[-1] >= max(values)
+        if on_written is not None:
+            self.protect(epoch)
+        with self.lock:
+            released, self.released = self.released, set()
+        # (waits for the previous snapshot to be written)
+        self.pending.put((epoch, checkpoint, is_best, on_written, released))
+        self.stalls.append(time.perf_counter() - start)
+        return self.stalls[-1]
+
+    def write_loop(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+                try:
+                    self.spare.put_nowait(item[1])
+                except queue.Full:  # one spare is enough
+                    pass
+            except Exception as e:  # raised by the next save() or close()
+                self.errors.append(e)
+            finally:
+                self.pending.task_done()
+
+    def write(self, epoch, checkpoint, is_best, on_written, released):
+        path = self.epoch_path(epoch)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)  # atomic, a killed run leaves either no checkpoint or a complete one
+
+        with self.lock:
+            self.owned.add(epoch)
+            self.protected -= released  # their evaluations are in the metrics of this checkpoint
+        if is_best:
+            self.mark_best(epoch)
+        self.rotate()
+        if on_written is not None:
+            on_written(epoch, path)
+
+    def mark_best(self, epoch):
+        """
+        Make the (written, not yet rotated) checkpoint of epoch the best one.
+        """
+        path = self.epoch_path(epoch)
+        tmp_best_path = f'{self.best_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.link(path, tmp_best_path)  # no copy, survives the rotation of path
+        except OSError:
+            shutil.copyfile(path, tmp_best_path)
+        os.replace(tmp_best_path, self.best_path)
+
+    def protect(self, epoch):
+        """
+        Keep the checkpoint of epoch out of the rotation until release(epoch).
+        """
+        with self.lock:
+            self.protected.add(epoch)
+
+    def release(self, epoch):
+        """
+        Let the checkpoint of epoch (see protect()) be rotated once the next checkpoint is written (or on close()).
+        """
+        with self.lock:
+            self.released.add(epoch)
+
+    def rotate(self):
+        """
+        Delete the checkpoints of this run before its last keep_last ones, except the protected ones.
+        """
+        paths = self.epoch_paths()
+        with self.lock:
+            epochs = sorted(epoch for epoch in paths if epoch in self.owned)
+            old_epochs = [epoch for epoch in epochs[:-self.keep_last] if epoch not in self.protected]
+        for epoch in old_epochs:
+            os.remove(paths[epoch])
+
+    def wait(self):
+        """
+        Block until the pending snapshot is written.
+        """
+        self.pending.join()
+        self.raise_errors()
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def close(self):
+        self.wait()
+        self.pending.put(None)
+        self.thread.join()
+        with self.lock:
+            self.protected -= self.released
+            self.released = set()
+        self.rotate()  # the released checkpoints
+
+    def resume(self, model, optimizer=None, scaler=None, path='latest'):
+        """
+        Restore the training state of a checkpoint (model, optimizer, scaler, RNG).
+
+        :param path: checkpoint path, 'latest' for the one of the last epoch in the directory
+        :return: epoch to continue from and the metrics of the checkpoint, (0, None) if there's no checkpoint
+        """
+        if path == 'latest':
+            path = self.latest()
+            if path is None:
+                return 0, None
+        checkpoint = load_checkpoint(path)
+        model.load_state_dict(checkpoint['state_dict'])
+        if optimizer is not None and 'optimizer' in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+        if scaler is not None and 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
+        if 'rng' in checkpoint:
+            set_rng_state(checkpoint['rng'])
+        epoch = checkpoint.get('epoch', -1)
+        with self.lock:
+            self.owned.update(e for e in self.epoch_paths() if e <= epoch)  # the run continued here
+        print(f'Resumed from {path}')
+        return epoch + 1, checkpoint.get('metrics')
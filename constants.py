@@ -1,2 +1,22 @@
+import os
+
 TRAIN_IMG_PATH = '/home/student/train'
 TEST_IMG_PATH = '/home/student/test'
+IMG_CACHE_BYTES = 2 * 1024 ** 3  # decoded images budget of a lazy MasksDataset (per process)
+CACHE_DIR = os.environ.get('FACEMASK_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'facemask_obj_detect'))
+WEIGHTS_PATH = os.environ.get('FACEMASK_WEIGHTS')  # model weights file to use instead of the cached download
+WEIGHTS_SHA256 = os.environ.get('FACEMASK_WEIGHTS_SHA256')  # expected sha256 of the model weights, if pinned
+OFFLINE = os.environ.get('FACEMASK_OFFLINE', '0').lower() in {'1', 'true', 'yes'}  # never download model weights
+
+# Inference proposal budgets (FasterRCNN arguments). torchvision's defaults are sized for COCO scenes, our images have
+# one face and the model keeps one detection (box_detections_per_img=1). rpn_pre_nms_top_n_test is per FPN level.
+# The training budgets stay torchvision's. See python benchmark.py proposal-profiles for the latency/accuracy sweep.
+PROPOSAL_PROFILES = {
+    'default': dict(rpn_pre_nms_top_n_test=1000, rpn_post_nms_top_n_test=1000),
+    'balanced': dict(rpn_pre_nms_top_n_test=300, rpn_post_nms_top_n_test=100),
+    'fast': dict(rpn_pre_nms_top_n_test=100, rpn_post_nms_top_n_test=30),
+    'fastest': dict(rpn_pre_nms_top_n_test=50, rpn_post_nms_top_n_test=10),
+}
+
+# Autocast precisions, see precision.py
+PRECISIONS = ('fp32', 'bf16', 'fp16')
@@ -1,9 +1,14 @@
 from torch.utils.data import Dataset
-import json
-import os
+import collections
+import threading
 from PIL import Image
 from utils import *
 import constants
+from image_sources import open_image_source
+from manifest import load_manifest, subset_manifest, shard_slice
+from image_pack import load_pack, open_pack_images
+from augmentations import augment, encode_distortions
+import numpy as np
 import concurrent.futures
 import torchvision.transforms.functional as FT
 import random
@@ -13,87 +18,369 @@ def collate_fn(batch):
     return tuple(zip(*batch))
 
 
+def decode_image(path, draft_size=None):
+    """
+    Decode an image to RGB.
+
+    :param path: image path or binary file object (left open: PIL only closes the files it opens)
+    :param draft_size: if given, let the JPEG decoder downscale in the DCT domain (by 1/2, 1/4 or 1/8) to the
+    smallest size that is still at least draft_size (width, height)
+    :return: PIL image
+    """
+    image = Image.open(path, mode='r')
+    if draft_size is not None:
+        image.draft('RGB', draft_size)  # no-op for formats other than JPEG
+    return image.convert('RGB')
+
+
+class LRUImageCache(object):
+    """
+    Least-recently-used cache of decoded PIL images, bounded by the total number of decoded bytes.
+    Keeps hit, miss and eviction counters.
+
+    Note: every DataLoader worker process holds its own copy of the cache, so the budget is per process.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.images = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # locks can't be pickled (DataLoader workers started with spawn)
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_nbytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self.images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        nbytes = self.image_nbytes(image)
+        if nbytes > self.max_bytes:  # never cache an image that is bigger than the whole budget
+            return
+        with self.lock:
+            if key in self.images:
+                self.current_bytes -= self.image_nbytes(self.images.pop(key))
+            self.images[key] = image
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.current_bytes -= self.image_nbytes(evicted)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.images:
+                self.current_bytes -= self.image_nbytes(self.images.pop(key))
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    images=len(self.images), bytes=self.current_bytes, max_bytes=self.max_bytes)
+
+
+class ImageStore(object):
+    """
+    The decoded images of a data folder, shared by the MasksDataset views of that folder (e.g. the TRAIN view and the
+    unshuffled TEST-split view of the training images in train.py), so that every image is decoded and held only once.
+
+    call example:
+        store = ImageStore(data_folder=constants.TRAIN_IMG_PATH)
+        train_dataset = MasksDataset(data_folder=constants.TRAIN_IMG_PATH, split='train', store=store)
+        unshuffled_train_dataset = MasksDataset(data_folder=constants.TRAIN_IMG_PATH, split='test', store=store)
+
+    With lazy=True images are not loaded to RAM up front, but decoded on demand behind an LRU cache of at most
+    cache_bytes decoded bytes (see self.cache.stats()). With reduced_decode=True see decode_image() and MasksDataset.
+
+    Images are addressed by filename, DataLoader workers forked from the process that loaded them share the decoded
+    pixels copy-on-write.
+    """
+
+    def __init__(self, data_folder, lazy=False, cache_bytes=constants.IMG_CACHE_BYTES, reduced_decode=False):
+        self.data_folder = data_folder
+        self.source = open_image_source(data_folder)  # a folder or tar archives, see image_sources.py
+        self.lazy = lazy
+        self.decode_size = (224, 224) if reduced_decode else None
+
+        self.manifest = None
+        self.loaded = {}  # filename -> decoded image, when not lazy
+        self.cache = LRUImageCache(max_bytes=cache_bytes) if self.lazy else None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Bring the store up to date with data_folder: only the images of new or changed files are loaded (when not
+        lazy), the images of deleted or changed files are dropped.
+
+        :return: filenames of the new or changed files, filenames of the deleted or changed files
+        """
+        # Read data file names, annotations and images sizes (see manifest.py)
+        self.source = open_image_source(self.data_folder)  # re-indexes tar archives that changed
+        manifest = load_manifest(self.source)
+
+        # Match the files to the current images by filename, mtime and size
+        previous_keys = set()
+        if self.manifest is not None:
+            previous_keys = set(zip(self.manifest['filename'].tolist(), self.manifest['mtime'].tolist(),
+                                    self.manifest['size'].tolist()))
+        keys = list(zip(manifest['filename'].tolist(), manifest['mtime'].tolist(), manifest['size'].tolist()))
+        new_images = [filename for filename, mtime, size in keys if (filename, mtime, size) not in previous_keys]
+        keys = set(keys)
+        stale_images = [filename for filename, mtime, size in previous_keys if (filename, mtime, size) not in keys]
+        self.manifest = manifest
+
+        if self.lazy:
+            # Images are decoded on demand, forget the cached images of stale files
+            for filename in stale_images:
+                self.cache.discard(filename)
+        else:
+            # Load the new or changed data to RAM using multiprocess
+            for filename in stale_images:
+                self.loaded.pop(filename, None)
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                self.loaded.update(zip(new_images, executor.map(self.read_image, new_images)))
+
+        return new_images, stale_images
+
+    def read_image(self, filename):
+        with self.source.open(filename) as f:  # PIL doesn't close the file objects it's given
+            return decode_image(f, draft_size=self.decode_size)
+
+    def get_image(self, filename):
+        """
+        :return: decoded image of filename (PIL)
+        """
+        if not self.lazy:
+            return self.loaded[filename]
+        image = self.cache.get(filename)
+        if image is None:
+            image = self.read_image(filename)
+            self.cache.put(filename, image)
+        return image
+
+
 class MasksDataset(Dataset):
     """
     call example: MasksDataset(data_folder=constants.TRAIN_IMG_PATH, split='train')
+
+    data_folder can also be the path of an uncompressed tar archive of the images (e.g. train.tar), or a list of
+    such archives (shards), which are then read in place without extracting them (see image_sources.py).
+
+    The images are held by an ImageStore. Pass store= to share the decoded images of data_folder between several
+    datasets (splits), otherwise the dataset creates its own store with the lazy, cache_bytes and reduced_decode
+    arguments.
+
+    With lazy=True images are not loaded to RAM up front, but decoded on demand in __getitem__
+    behind an LRU cache of at most cache_bytes decoded bytes (see self.cache.stats()).
+
+    With packed=True (TEST split only) images are served from a pre-resized 224x224 memmap (see image_pack.py),
+    which is built on the first use and updated when the folder changes. Images missing from the pack are then taken
+    from a shared in-memory store instead of being decoded again.
+
+    refresh() brings the dataset up to date with a folder that changed, loading only new or changed images.
+
+    With photometric_in_batch=True (TRAIN split) the photometric distortions are only sampled in __getitem__ and
+    applied on the collated batch, see augmentations.batch_photometric_collate_fn.
+
+    With reduced_decode=True JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 scale that is still at least 224x224
+    (see decode_image()) and the boxes are rescaled accordingly, self.sizes stay the original sizes. Note that TRAIN
+    crops are then upsampled to 224x224 from fewer pixels than before.
+
+    With filenames=[...] the dataset only holds the images of these files (see manifest.stratified_sample()). With
+    shard=(index, count) or (index, count, align) it only holds the index-th of count contiguous slices of the (sorted)
+    images, see manifest.shard_slice() and sharded_predict.py.
     """
 
-    def __init__(self, data_folder, split):
+    def __init__(self, data_folder, split, lazy=False, cache_bytes=constants.IMG_CACHE_BYTES, packed=False,
+                 photometric_in_batch=False, reduced_decode=False, store=None, shard=None, filenames=None):
         self.split = split.upper()
         assert self.split in {'TRAIN', 'TEST'}
-
+        assert not (packed and self.split == 'TRAIN'), 'packed images are already resized, no augmentations possible'
+
+        if store is None:
+            # a packed dataset only reads the images that are missing from the pack, don't load them all up front
+            store = ImageStore(data_folder, lazy=lazy or packed, cache_bytes=0 if packed else cache_bytes,
+                               reduced_decode=reduced_decode)
+        assert store.source.key == open_image_source(data_folder).key, 'the store holds the images of another folder'
+        self.store = store
         self.data_folder = data_folder
-
-        # Read data file names
-        self.images = sorted(os.listdir(data_folder))
+        self.packed = packed
+        self.photometric_in_batch = photometric_in_batch
+        self.shard = shard
+        self.filenames = None if filenames is None else np.asarray(sorted(filenames))
+        self.pack = None  # opened on first use, once per DataLoader worker
+
+        self.manifest = None
+        self.images = []
+        self.loaded_imgs = None
+        self.refresh(refresh_store=False)
+
+    @property
+    def source(self):
+        return self.store.source
+
+    @property
+    def lazy(self):
+        return self.store.lazy
+
+    @property
+    def cache(self):
+        return self.store.cache
+
+    @property
+    def decode_size(self):
+        return self.store.decode_size
+
+    def refresh(self, refresh_store=True):
+        """
+        Bring the dataset up to date with data_folder: only the images of new or changed files are loaded, deleted
+        files are dropped, and the other images keep their relative order (the images are sorted by filename).
+
+        :param refresh_store: refresh the image store first, pass False if it was already refreshed (when shared)
+        :return: number of loaded (new or changed) images, number of dropped images
+        """
+        if refresh_store:
+            self.store.refresh()
+        manifest = self.store.manifest
+        self.paths_to_exclude = []
         if self.split == 'TRAIN':
             # exclude problematic images with width or heigh equal to 0
-            self.paths_to_exclude = []
-            for path in self.images:
-                image_id, bbox, proper_mask = path.strip(".jpg").split("__")
-                x_min, y_min, w, h = json.loads(bbox)  # convert string bbox to list of integers
-                if w <= 0 or h <= 0:
-                    self.paths_to_exclude.append(path)
-            self.images = [path for path in self.images if path not in self.paths_to_exclude]
-
-        # Load data to RAM using multiprocess
-        self.loaded_imgs = []
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self.load_single_img, path) for path in self.images]
-            self.loaded_imgs = [fut.result() for fut in futures]
-        self.loaded_imgs = sorted(self.loaded_imgs, key=lambda x: x[0])  # sort the images to reproduce results
-        print(f"Finished loading {self.split} set to memory - total of {len(self.loaded_imgs)} images")
+            w, h = manifest['bbox'][:, 2], manifest['bbox'][:, 3]
+            self.paths_to_exclude = manifest['filename'][(w <= 0) | (h <= 0)].tolist()
+            manifest = subset_manifest(manifest, (w > 0) & (h > 0))
+        split_manifest = manifest
+        selection = np.arange(len(manifest['filename']))
+        if self.filenames is not None:
+            # keep only the given files (that still exist), e.g. a fixed subset of the images for evaluation
+            selection = selection[np.isin(manifest['filename'], self.filenames)]
+        if self.shard is not None:
+            # keep only the contiguous rows of this shard, e.g. for one of several prediction processes
+            selection = selection[shard_slice(len(selection), *self.shard)]
+        if self.filenames is not None or self.shard is not None:
+            manifest = subset_manifest(manifest, selection)
+
+        # Match the files to the current images by filename, mtime and size
+        current = set()
+        if self.manifest is not None:
+            current = set(zip(self.manifest['filename'].tolist(), self.manifest['mtime'].tolist(),
+                              self.manifest['size'].tolist()))
+        n_kept = len(current.intersection(zip(manifest['filename'].tolist(), manifest['mtime'].tolist(),
+                                              manifest['size'].tolist())))
+        n_loaded = len(manifest['filename']) - n_kept
+        n_dropped = len(self.images) - n_kept
+        first_load = self.manifest is None
+
+        self.manifest = manifest
+        self.images = self.manifest['filename'].tolist()
+        self.annotations = [self.parse_annotation(k) for k in range(len(self.images))]  # same order as self.images
 
         # Store images sizes
-        self.sizes = []
-        for path in self.images:
-            image = Image.open(os.path.join(self.data_folder, path), mode='r').convert('RGB')
-            self.sizes.append(torch.FloatTensor([image.width, image.height, image.width, image.height]).unsqueeze(0))
+        self.sizes = [torch.FloatTensor([w, h, w, h]).unsqueeze(0)
+                      for w, h in zip(self.manifest['width'].tolist(), self.manifest['height'].tolist())]
+
+        if self.packed:
+            # Make sure the pack is up to date, images are sliced from the memmap. Pack the images of an in-memory
+            # store as they are (full decodes only, packs don't depend on reduced_decode)
+            read_image = self.store.get_image if not self.lazy and self.decode_size is None else None
+            # (always of the whole split: concurrent shards only read a pack that is up to date)
+            self.pack, pack_rows = load_pack(self.source, split_manifest, read_image=read_image)
+            self.pack_rows = pack_rows[selection]
+            self.pack_n_rows = len(self.pack)
+            mode = 'packed'
+        elif self.lazy:
+            # Images are decoded on demand in __getitem__
+            mode = 'lazy loading'
+        else:
+            # References to the images of the store
+            self.loaded_imgs = [self.load_single_img(k) for k in range(len(self.images))]  # in self.images order
+            mode = 'in memory'
+
+        if first_load:
+            print(f"Finished loading {self.split} set ({mode}) - total of {len(self.images)} images")
+        else:
+            print(f"Refreshed {self.split} set ({mode}) - loaded {n_loaded} and dropped {n_dropped} images, "
+                  f"total of {len(self.images)} images")
+
+        return n_loaded, n_dropped
+
+    def __getstate__(self):
+        # don't pickle the memmap (a full copy) to DataLoader workers started with spawn, they reopen it
+        state = self.__dict__.copy()
+        state['pack'] = None
+        return state
 
     def __getitem__(self, i):
+        if self.packed:
+            return self.get_packed_item(i)
+
         # MasksDataset mean
         mean = [0.5244, 0.4904, 0.4781]
 
         # MaskDataset train set mean and std
-        image_id, image, box, label = self.loaded_imgs[i]  # str, PIL, tensor, tensor
+        image_id, image, box, label = self.get_raw_item(i)  # str, PIL, tensor, tensor
 
         # Apply transformations and augmentations
-        image, box, label = image.copy(), box.clone(), label.clone()
-        if self.split == 'TRAIN':
-            if random.random() < 0.8:  # with probability of 80% try augmentations
-                # A series of photometric distortions in random order, each with 50% chance of occurrence, as in Caffe repo
-                if random.random() < 0.5:
-                    image = photometric_distort(image)
-
-                # Convert PIL image to Torch tensor
-                image = FT.to_tensor(image)
+        box, label = box.clone(), label.clone()
+        distortions = []
+        if self.split == 'TRAIN' and random.random() < 0.8:  # with probability of 80% try augmentations
+            # Augment and resize as a uint8 tensor (a copy of the PIL image), see augmentations.py
+            filler = [int(m * 255) for m in mean]  # the mean in [0, 255], truncated like to_pil_image() does
+            image, box, label, distortions = augment(FT.pil_to_tensor(image), box, label, filler,
+                                                     photometric_in_batch=self.photometric_in_batch,
+                                                     dims=(224, 224))  # uint8 tensor, non-fractional
+            image = image.float().div(255)
+        else:
+            # non-fractional for Fast-RCNN
+            image, box = resize(image, box, dims=(224, 224), return_percent_coords=False)  # PIL, tensor
+
+            # Convert PIL image to Torch tensor
+            image = FT.to_tensor(image)
+        box = box.clamp(0., 224.)
 
-                # Expand image (zoom out) with a 50% chance - helpful for training detection of small objects
-                # Fill surrounding space with the mean
-                if random.random() < 0.5:
-                    image, box = expand(image, box, filler=mean)
+        # No normalize for Fast-RCNN
 
-                # Randomly crop image (zoom in)
-                if random.random() < 0.5:
-                    image, box, label = random_crop(image, box, label)
+        target = self.make_target(image_id, box, label)
+        if self.photometric_in_batch:
+            target['photometric'] = encode_distortions(distortions)  # applied by augmentations.apply_batch_photometric
 
-                # Convert Torch tensor to PIL image
-                image = FT.to_pil_image(image)
+        return image, target  # image is a tensor in [0, 1] (aka pixels divided by 255)
 
-                # Flip image with a 50% chance
-                if random.random() < 0.5:
-                    image, box = flip(image, box)
+    def get_packed_item(self, i):
+        if self.pack is None:
+            self.pack = open_pack_images(self.source, self.pack_n_rows)
+        image_id, box, label = self.annotations[i]
 
-        # non-fractional for Fast-RCNN
-        image, box = resize(image, box, dims=(224, 224), return_percent_coords=False)  # PIL, tensor
+        # the packed image is already resized to 224x224, same as resize() + to_tensor() of the other paths
+        image = torch.from_numpy(np.array(self.pack[self.pack_rows[i]])).float().div(255)  # copy out of the memmap
+        box = resize_box(box, self.sizes[i], dims=(224, 224), return_percent_coords=False)
         box = box.clamp(0., 224.)
 
-        # Convert PIL image to Torch tensor
-        image = FT.to_tensor(image)
-
-        # No normalize for Fast-RCNN
+        return image, self.make_target(image_id, box, label)
 
+    @staticmethod
+    def make_target(image_id, box, label):
         area = (box[:, 3] - box[:, 1]) * (box[:, 2] - box[:, 0])
         area = torch.as_tensor(area, dtype=torch.float32)
 
@@ -102,15 +389,46 @@ class MasksDataset(Dataset):
                       image_id=torch.tensor([torch.tensor(int(image_id))]),
                       area=area,
                       iscrowd=torch.zeros_like(label, dtype=torch.int64))
-
-        return image, target  # image is a tensor in [0, 1] (aka pixels divided by 255)
+        return target
 
     def __len__(self):
         return len(self.images)
 
-    def load_single_img(self, path):
-        image_id, bbox, proper_mask = path.strip(".jpg").split("__")
-        x_min, y_min, w, h = json.loads(bbox)  # convert string bbox to list of integers
+    def get_raw_item(self, i):
+        """
+        Get the i-th image before any transformation.
+
+        :param i: index in the dataset
+        :return: image_id, image, box, label (str, PIL, tensor, tensor)
+        """
+        if not self.lazy:
+            return self.loaded_imgs[i]
+
+        image_id, box, label = self.annotations[i]
+        image = self.store.get_image(self.images[i])
+        return image_id, image, self.rescale_box(i, box, image), label
+
+    def rescale_box(self, i, box, image):
+        """
+        :return: box of the i-th image in the coordinates of its decoded image (that may be reduced, see decode_image())
+        """
+        width, height = int(self.manifest['width'][i]), int(self.manifest['height'][i])
+        if (image.width, image.height) == (width, height):
+            return box
+        return box * torch.FloatTensor([image.width / width, image.height / height,
+                                        image.width / width, image.height / height]).unsqueeze(0)
+
+    def load_single_img(self, i):
+        image_id, box, label = self.annotations[i]
+
+        # Read image
+        image = self.store.get_image(self.images[i])
+
+        return image_id, image, self.rescale_box(i, box, image), label  # str, PIL, tensor, tensor
+
+    def parse_annotation(self, i):
+        image_id = str(self.manifest['image_id'][i])
+        x_min, y_min, w, h = self.manifest['bbox'][i].tolist()
 
         # it is promised that test set will not include non-positive w,h
         # Note: this is here only for calculating the test loss (and not relevant for the inference phase
@@ -120,15 +438,12 @@ class MasksDataset(Dataset):
             h = 1 if h <= 0 else h
 
         bbox = [x_min, y_min, x_min + w, y_min + h]  # [x_min, y_min, x_max, y_max]
-        proper_mask = [1] if proper_mask.lower() == "true" else [2]
-
-        # Read image
-        image = Image.open(os.path.join(self.data_folder, path), mode='r').convert('RGB')
+        proper_mask = [1] if self.manifest['proper_mask'][i] else [2]
 
         box = torch.FloatTensor([bbox])  # (1, 4)
         label = torch.LongTensor(proper_mask)  # (1)
 
-        return image_id, image, box, label  # str, PIL, tensor, tensor
+        return image_id, box, label  # str, tensor, tensor
 
 
 if __name__ == '__main__':
@@ -1,15 +1,24 @@
+import argparse
 import gdown
 import tarfile
 import os
 
+parser = argparse.ArgumentParser(description='Download the train and test sets')
+parser.add_argument('--no-extract', action='store_true',
+                    help='keep only the .tar archives, MasksDataset can read them in place (pass the .tar path as '
+                         'data_folder)')
+args = parser.parse_args()
+
 url = 'https://drive.google.com/uc?id=1GsC6vtBm47kNUPrCU-8_hXU1Pi0BraE9'
 output = os.path.join(os.getcwd(), 'train.tar')
 gdown.download(url, output, quiet=False)
-tf = tarfile.open(output)
-tf.extractall(os.getcwd())
+if not args.no_extract:
+    tf = tarfile.open(output)
+    tf.extractall(os.getcwd())
 
 url = 'https://drive.google.com/uc?id=1JVCAqZOhKCs3_5KrlZakB-ZJZTcyZSS3'
 output = os.path.join(os.getcwd(), 'test.tar')
 gdown.download(url, output, quiet=False)
-tf = tarfile.open(output)
-tf.extractall(os.getcwd())
+if not args.no_extract:
+    tf = tarfile.open(output)
+    tf.extractall(os.getcwd())
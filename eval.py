@@ -1,77 +1,165 @@
+import csv
 import torch
-import json
 import numpy as np
-import pandas as pd
+import torchvision.transforms.functional as FT
 from utils import calc_iou
+from pipeline import run_pipeline, print_utilization
+from precision import autocast, to_channels_last, float_outputs
 import os
 
 
-def evaluate(loader, model, save_csv=False, verbose=False):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    all_images_boxes = list()
-    all_images_labels = list()
-    all_images_scores = list()
-
+def preprocess_image(image, dims=(224, 224)):
+    """
+    Prepare an image for the model, the same way MasksDataset does for the TEST split.
+
+    :param image: PIL image
+    :param dims: model input (height, width)
+    :return: image tensor of dimensions (3, dims[0], dims[1]) in [0, 1], original size as a tensor [[w, h, w, h]]
+    """
+    image = image.convert('RGB')
+    size = torch.FloatTensor([image.width, image.height, image.width, image.height]).unsqueeze(0)
+    return FT.to_tensor(FT.resize(image, dims)), size
+
+
+def parse_prediction(res, device=torch.device('cpu')):
+    """
+    :param res: output dict of the model for one image
+    :return: box [x_min, y_min, x_max, y_max] in the model input coordinates, label (0 if nothing was detected) and
+    score tensors
+    """
+    boxes = res.get("boxes", None)
+    labels = res.get("labels", None)
+    scores = res.get("scores", None)
+    if boxes is not None and labels is not None and scores is not None \
+            and torch.numel(boxes) != 0 and torch.numel(labels) != 0 and torch.numel(scores) != 0:
+        # [xmin, ymin, xmax, ymax] non-fractional
+        # Note: one box because our faster rcnn model defined with box_detections_per_img=1
+        return boxes[0].to(device), labels[0].to(device), scores[0].to(device)
+    return torch.FloatTensor([0., 0., 224., 224.]).to(device), torch.IntTensor([0]).to(device), \
+        torch.FloatTensor([0.]).to(device)
+
+
+def original_box(box, size, dims=(224, 224)):
+    """
+    :param box: [x_min, y_min, x_max, y_max] box in the model input coordinates (see parse_prediction())
+    :param size: original image size as a tensor [[w, h, w, h]] (see preprocess_image())
+    :return: [x_min, y_min, w, h] box in the original image coordinates, list of floats
+    """
+    box = box.cpu() * size / torch.FloatTensor([dims[1], dims[0], dims[1], dims[0]])
+    return torch.cat([box[0, :2], box[0, 2:] - box[0, :2]]).tolist()  # w, h computed in float32
+
+
+class StreamingMetrics(object):
+    """
+    Accumulates IoU and accuracy over the predictions of the images of a dataset, in order, batch by batch, and
+    writes (and flushes) their rows to a CSV as they come.
+    """
+
+    def __init__(self, dataset, save_csv=False):
+        """
+        :param dataset: MasksDataset
+        :param save_csv: path of a CSV to write the predictions to (filename, x, y, w, h, proper_mask)
+        """
+        self.dataset = dataset
+        self.n_images = 0
+        self.iou_sum = 0.
+        self.n_correct = 0
+
+        self.csv_file = None
+        if save_csv:
+            self.csv_file = open(save_csv, 'w', newline='')
+            self.writer = csv.writer(self.csv_file, lineterminator='\n')  # like pandas
+            self.writer.writerow(['filename', 'x', 'y', 'w', 'h', 'proper_mask'])
+
+    def add(self, res):
+        """
+        :param res: model outputs of the next batch of images of the dataset
+        """
+        manifest = self.dataset.manifest
+        for k in range(len(res)):
+            i = self.n_images + k  # index in the dataset
+            box, label, _ = parse_prediction(res[k])
+
+            # convert the box back to the original size, [x_min, y_min, w, h] format
+            predicted_box = original_box(box, self.dataset.sizes[i])
+            predicted_label = 'True' if label == 1 else 'False'
+
+            # compare with the true box and label from the manifest (parsed from the filenames)
+            true_label = 'True' if manifest['proper_mask'][i] else 'False'
+            self.iou_sum += calc_iou(manifest['bbox'][i].tolist(), predicted_box)
+            self.n_correct += predicted_label == true_label
+
+            if self.csv_file is not None:
+                self.writer.writerow([self.dataset.images[i]] + [np.float32(c) for c in predicted_box] +
+                                     [predicted_label])
+        self.n_images += len(res)
+
+        if self.csv_file is not None:
+            self.csv_file.flush()  # the rows so far survive a crash
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+
+    def mean_accuracy(self):
+        return self.n_correct / self.n_images if self.n_images else float('nan')
+
+    def mean_iou(self):
+        return self.iou_sum / self.n_images if self.n_images else float('nan')
+
+
+def evaluate(loader, model, save_csv=False, verbose=False, device=None, pipelined=False, precision='fp32',
+             channels_last=False):
+    """
+    Predict the images of an unshuffled loader of a MasksDataset, streaming: every batch is converted to boxes in the
+    original image sizes right away, IoU and accuracy are accumulated, and the rows of save_csv are written (and
+    flushed) batch by batch, so memory doesn't grow with the dataset and the rows written before a crash are kept.
+
+    :param loader: DataLoader of a MasksDataset, without shuffling
+    :param model: model
+    :param save_csv: path of a CSV to write the predictions to (filename, x, y, w, h, proper_mask)
+    :param verbose: print IoU and accuracy (and the pipeline stages utilization), and where save_csv was saved
+    :param device: device of the model, by default cuda when available
+    :param pipelined: overlap fetching, forward and post-processing of consecutive batches (see pipeline.py)
+    :param precision: 'fp32', or autocast the forward passes to 'bf16' or 'fp16' (see precision.py)
+    :param channels_last: switch the backbone of the model to channels_last first (in place, see precision.py)
+    :return: mean accuracy, mean IoU
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if channels_last:
+        to_channels_last(model)
+
+    metrics = StreamingMetrics(loader.dataset, save_csv)
+    add = metrics.add if precision == 'fp32' else lambda res: metrics.add(float_outputs(res))
     model.eval()
-    with torch.no_grad():
-        for i, (images, _) in enumerate(loader):
-            # Move to default device
-            images = [image.to(device) for image in images]
-
-            # Forward prop
-            res = model(images)
-
-            for k in range(len(images)):
-                boxes = res[k].get("boxes", None)
-                labels = res[k].get("labels", None)
-                scores = res[k].get("scores", None)
-                if boxes is not None and labels is not None and scores is not None \
-                        and torch.numel(boxes) != 0 and torch.numel(labels) != 0 and torch.numel(scores) != 0:
-                    # [xmin, ymin, xmax, ymax] non-fractional
-                    # Note: one box because our faster rcnn model defined with box_detections_per_img=1
-                    all_images_boxes.append(boxes[0].to(device))
-                    all_images_labels.append(labels[0].to(device))
-                    all_images_scores.append(scores[0].to(device))
-                else:
-                    all_images_boxes.append(torch.FloatTensor([0., 0., 224., 224.]).to(device))
-                    all_images_labels.append(torch.IntTensor([0]).to(device))
-                    all_images_scores.append(torch.FloatTensor([0.]).to(device))
-            del images, res, boxes, labels, scores
-
-    filenames = loader.dataset.images
-    imgs_orig_sizes = loader.dataset.sizes
-
-    # convert boxes back to their original sizes by the original width, height
-    predicted_boxes = [box * imgs_orig_sizes[i].to(device) / 224 for i, box in enumerate(all_images_boxes)]
-
-    # convert to [x_min, y_min, w, h] format
-    predicted_boxes = [[box[0][0], box[0][1], box[0][2] - box[0][0], box[0][3] - box[0][1]] for box in predicted_boxes]
-
-    predicted_labels = ['True' if label == 1 else 'False' for label in all_images_labels]
-
-    # take true boxes from the filenames with format [x_min, y_min, w, h]
-    true_boxes = [json.loads(filename.strip(".jpg").split("__")[1]) for filename in filenames]
-
-    true_labels = [filename.strip(".jpg").split("__")[2] for filename in filenames]
-    mean_accuracy = np.mean([pred == true for pred, true in zip(predicted_labels, true_labels)])
-
-    mean_iou = np.mean([calc_iou(true_box, torch.stack(pred_box).cpu().numpy())
-                        for true_box, pred_box in zip(true_boxes, predicted_boxes)])
+    try:
+        with torch.no_grad(), autocast(precision, device):  # the forward passes run in the calling thread
+            if pipelined:
+                stats = run_pipeline(loader, model, add, device)
+                if verbose:
+                    print_utilization(stats)
+            else:
+                for images, _ in loader:
+                    # Move to default device
+                    images = [image.to(device) for image in images]
+
+                    # Forward prop
+                    res = model(images)
+
+                    add(res)
+                    del images, res
+    finally:
+        metrics.close()
+
+    mean_accuracy, mean_iou = metrics.mean_accuracy(), metrics.mean_iou()
 
     if verbose:
         print(f'IoU = {round(float(mean_iou), 4)}, Accuracy = {round(float(mean_accuracy), 4)}')
 
-    if save_csv:
-        results = pd.DataFrame(columns=['filename', 'x', 'y', 'w', 'h', 'proper_mask'])
-        results.filename = filenames
-        predicted_boxes = [torch.stack(pred_box).cpu().numpy() for pred_box in predicted_boxes]
-        results.x, results.y, results.w, results.h = zip(*predicted_boxes)
-        results.proper_mask = predicted_labels
-        results.to_csv(save_csv, index=False, header=True)
+    if save_csv and verbose:
         print(f'saved results to {os.path.join(os.getcwd(), str(save_csv))}')
 
-    del predicted_boxes, all_images_boxes, all_images_labels, all_images_scores
     torch.cuda.empty_cache()
 
     return mean_accuracy, mean_iou
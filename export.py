@@ -0,0 +1,148 @@
+"""
+Export the model as a self-contained TorchScript artifact, that runs without this repo's model code and without
+rebuilding the model in Python.
+
+usage: python export.py [--weights PATH] [--output faster_rcnn.torchscript.pt] [--data-folder example_images]
+
+The artifact is loaded with load_artifact() (torch.jit.load()) and is called like the eager model: a list of image
+tensors of dimensions (3, h, w), float in [0, 1] or uint8, to a list of dicts of boxes ([x_min, y_min, x_max, y_max]
+in the input image coordinates), labels and scores. The normalization by the MasksDataset mean and std is part of
+the model. Images that are not 224x224 are resized to 224x224 inside the artifact (bilinear, without the
+antialiasing of PIL), so feed images resized like MasksDataset does (e.g. from a MasksDataset loader) to get the
+outputs of the eager model.
+
+After exporting, the outputs of the artifact are checked against the eager model on the images of --data-folder.
+See python benchmark.py torchscript for the latency comparison.
+"""
+import argparse
+import json
+import os
+import sys
+from typing import Dict, List
+import torch
+import torch.nn.functional as F
+import torchvision
+import constants
+from dataset import MasksDataset
+from model import get_fasterrcnn_resnet50_fpn
+from weights import get_weights_path, file_sha256
+
+
+class InferenceModule(torch.nn.Module):
+    """
+    The model with the resizing to its 224x224 input baked in, returning boxes in the input image coordinates.
+    """
+
+    def __init__(self, model, dims=(224, 224)):
+        super().__init__()
+        self.model = model
+        self.height = dims[0]
+        self.width = dims[1]
+
+    def forward(self, images: List[torch.Tensor]) -> List[Dict[str, torch.Tensor]]:
+        inputs: List[torch.Tensor] = []
+        sizes: List[List[int]] = []
+        for image in images:
+            if image.dtype == torch.uint8:
+                image = image.float().div(255)
+            height, width = image.shape[-2], image.shape[-1]
+            sizes.append([width, height])
+            if height != self.height or width != self.width:
+                image = F.interpolate(image.unsqueeze(0), size=[self.height, self.width], mode='bilinear',
+                                      align_corners=False).squeeze(0)
+            inputs.append(image)
+
+        if torch.jit.is_scripting():
+            detections = self.model(inputs)[1]  # scripted detection models return (losses, detections)
+        else:
+            detections = self.model(inputs)
+
+        for detection, size in zip(detections, sizes):
+            if size[0] != self.width or size[1] != self.height:
+                scale = torch.tensor([size[0] / self.width, size[1] / self.height,
+                                      size[0] / self.width, size[1] / self.height], device=detection['boxes'].device)
+                detection['boxes'] = detection['boxes'] * scale
+        return detections
+
+
+def export_torchscript(model, output_path, metadata=None):
+    """
+    :param model: eager model (see model.get_fasterrcnn_resnet50_fpn())
+    :param output_path: path of the artifact
+    :param metadata: dict saved as meta.json in the artifact
+    :return: the scripted module
+    """
+    scripted = torch.jit.script(InferenceModule(model).eval())
+    metadata = dict(metadata or {}, torch=torch.__version__, torchvision=torchvision.__version__)
+    torch.jit.save(scripted, output_path, _extra_files={'meta.json': json.dumps(metadata)})
+    return scripted
+
+
+def load_artifact(path, device=None):
+    """
+    :return: the TorchScript model of an exported artifact, in eval mode
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.jit.load(path, map_location=device).eval()
+
+
+def read_artifact_metadata(path):
+    extra_files = {'meta.json': ''}
+    torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    return json.loads(extra_files['meta.json'])
+
+
+def check_parity(eager_model, scripted_model, images, atol=1e-3):
+    """
+    Compare the outputs of the eager and scripted models.
+
+    :param images: image tensors of dimensions (3, 224, 224)
+    :return: whether all the labels match and the boxes and scores are within atol, max box and score differences
+    """
+    with torch.no_grad():
+        eager_outputs = eager_model.eval()(images)
+        scripted_outputs = scripted_model(images)
+
+    same_labels = True
+    box_difference, score_difference = 0., 0.
+    for eager, scripted in zip(eager_outputs, scripted_outputs):
+        if not torch.equal(eager['labels'].cpu(), scripted['labels'].cpu()):
+            same_labels = False
+            continue
+        if eager['boxes'].numel():
+            box_difference = max(box_difference, float((eager['boxes'] - scripted['boxes']).abs().max()))
+            score_difference = max(score_difference, float((eager['scores'] - scripted['scores']).abs().max()))
+    ok = same_labels and box_difference <= atol * 224 and score_difference <= atol
+    return ok, box_difference, score_difference
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the model as a TorchScript artifact')
+    parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH,
+                        help='model weights file (env FACEMASK_WEIGHTS), by default the cached download')
+    parser.add_argument('--offline', action='store_true', default=constants.OFFLINE,
+                        help='never download the model weights (env FACEMASK_OFFLINE=1)')
+    parser.add_argument('--output', type=str, default='faster_rcnn.torchscript.pt')
+    parser.add_argument('--data-folder', type=str, default=os.path.join(os.path.dirname(__file__), 'example_images'),
+                        help='images of the parity check')
+    parser.add_argument('--max-images', type=int, default=20, help='number of images of the parity check')
+    args = parser.parse_args()
+
+    weights_path = get_weights_path(args.weights, offline=args.offline)
+    model = get_fasterrcnn_resnet50_fpn(weights_path=weights_path).eval()
+    export_torchscript(model, args.output, metadata=dict(weights_sha256=file_sha256(weights_path)))
+    print(f'Exported TorchScript model to {args.output} ({os.path.getsize(args.output) / 2 ** 20:.1f} MB)')
+
+    dataset = MasksDataset(data_folder=args.data_folder, split='test', lazy=True)
+    device = next(model.parameters()).device
+    images = [dataset[i][0].to(device) for i in range(min(args.max_images, len(dataset)))]
+    ok, box_difference, score_difference = check_parity(model, load_artifact(args.output, device), images)
+    print(f'Parity with the eager model on {len(images)} images: {"OK" if ok else "FAILED"} (max box difference '
+          f'{box_difference:.5f} px, max score difference {score_difference:.6f})')
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
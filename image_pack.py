@@ -0,0 +1,151 @@
+"""
+Pre-resized image packs: all the images of a folder resized once to a fixed size and stored as rows of one raw uint8
+array of shape (n_rows, 3, height, width) under constants.CACHE_DIR, next to an .npz with the box and label arrays
+and the row of every file. The array is opened as a read-only memmap, so DataLoader workers share the page cache
+instead of holding their own decoded copies, and an epoch over a packed folder does no decoding at all.
+
+Packs are updated incrementally: the rows of new or changed files are appended, and rows of deleted files are only
+dropped (by compacting the array) once they are the majority.
+"""
+import hashlib
+import os
+import numpy as np
+from PIL import Image
+import torchvision.transforms.functional as FT
+import constants
+from image_sources import open_image_source
+
+PACK_META_COLUMNS = ('filename', 'mtime', 'size', 'bbox', 'proper_mask', 'row', 'n_rows')
+
+
+def pack_paths(data_folder, dims):
+    """
+    :param data_folder: images folder, tar archive(s) or image source (see image_sources.py)
+    :param dims: (height, width) of the packed images
+    :return: paths of the images array and of the meta data of the pack
+    """
+    key = hashlib.sha1(open_image_source(data_folder).key.encode()).hexdigest()[:16]
+    prefix = os.path.join(constants.CACHE_DIR, 'packs', f'{key}_{dims[0]}x{dims[1]}')
+    return f'{prefix}.u8', f'{prefix}.meta.npz'
+
+
+def read_pack_meta(meta_path):
+    try:
+        with np.load(meta_path, allow_pickle=False) as f:
+            return {column: f[column] for column in PACK_META_COLUMNS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_pack_meta(meta, meta_path):
+    tmp_meta_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_meta_path, 'wb') as f:
+        np.savez(f, **meta)
+    os.replace(tmp_meta_path, meta_path)  # atomic, concurrent readers see either the old or the new meta data
+
+
+def load_packable_image(source, filename, dims, read_image=None):
+    """
+    Read an image and resize it exactly like MasksDataset does before to_tensor().
+
+    :param source: image source (see image_sources.py)
+    :param read_image: function of filename that returns the already decoded (RGB, full size) image
+    :return: uint8 array of shape (3, height, width)
+    """
+    if read_image is not None:
+        image = read_image(filename)
+    else:
+        with source.open(filename) as f:  # PIL doesn't close the file objects it's given
+            image = Image.open(f, mode='r').convert('RGB')
+    image = FT.resize(image, dims)
+    return np.asarray(image).transpose(2, 0, 1)
+
+
+def open_pack_images(data_folder, n_rows, dims=(224, 224)):
+    """
+    :param data_folder: images folder, tar archive(s) or image source (see image_sources.py)
+    :param n_rows: number of rows of the pack
+    :param dims: (height, width) of the packed images
+    :return: read-only memmap of shape (n_rows, 3, height, width)
+    """
+    images_path, _ = pack_paths(data_folder, dims)
+    if n_rows == 0:  # empty files can't be mapped
+        return np.zeros((0, 3) + tuple(dims), dtype=np.uint8)
+    return np.memmap(images_path, dtype=np.uint8, mode='r', shape=(n_rows, 3) + tuple(dims))
+
+
+def compact_pack(images_path, rows, dims):
+    """
+    Rewrite the images array with only the given rows, in that order.
+
+    :return: new row of each of the given rows
+    """
+    row_bytes = 3 * dims[0] * dims[1]
+    tmp_images_path = f'{images_path}.{os.getpid()}.tmp'
+    with open(images_path, 'rb') as src, open(tmp_images_path, 'wb') as dst:
+        for row in rows:
+            src.seek(row * row_bytes)
+            dst.write(src.read(row_bytes))
+    os.replace(tmp_images_path, images_path)
+    return list(range(len(rows)))
+
+
+def load_pack(data_folder, manifest, dims=(224, 224), verbose=True, read_image=None):
+    """
+    Open the pack of data_folder, first packing the images of new or changed files.
+
+    :param data_folder: images folder, tar archive(s) or image source (see image_sources.py)
+    :param manifest: manifest of data_folder (see manifest.py), possibly a subset of its rows
+    :param dims: (height, width) of the packed images
+    :param verbose: print what was packed
+    :param read_image: function of filename that returns the decoded image (e.g. from a dataset.ImageStore), by
+    default the images are decoded from data_folder
+    :return: read-only memmap of shape (n_rows, 3, height, width), and the row of every manifest row in it
+    """
+    source = open_image_source(data_folder)
+    images_path, meta_path = pack_paths(source, dims)
+    row_bytes = 3 * dims[0] * dims[1]
+
+    meta = read_pack_meta(meta_path)
+    known = {}
+    n_rows = 0
+    if meta is not None and os.path.exists(images_path) \
+            and os.path.getsize(images_path) >= int(meta['n_rows']) * row_bytes:
+        n_rows = int(meta['n_rows'])
+        for filename, mtime, size, row in zip(meta['filename'].tolist(), meta['mtime'].tolist(),
+                                              meta['size'].tolist(), meta['row'].tolist()):
+            known[(filename, mtime, size)] = row
+
+    rows = [known.get(key) for key in zip(manifest['filename'].tolist(), manifest['mtime'].tolist(),
+                                          manifest['size'].tolist())]
+    missing = [k for k, row in enumerate(rows) if row is None]
+    if not missing and meta is not None and len(meta['filename']) == len(rows):
+        return open_pack_images(source, n_rows, dims), np.array(rows, dtype=np.int64)
+
+    os.makedirs(os.path.dirname(images_path), exist_ok=True)
+
+    # Drop the rows of deleted or changed files once they are the majority
+    live_rows = sorted(set(row for row in rows if row is not None))
+    if n_rows > 0 and len(live_rows) < n_rows / 2:
+        new_rows = dict(zip(live_rows, compact_pack(images_path, live_rows, dims)))
+        rows = [None if row is None else new_rows[row] for row in rows]
+        n_rows = len(live_rows)
+
+    # Append the new or changed files (dropping the bytes of a previously interrupted append)
+    with open(images_path, 'ab') as f:
+        f.truncate(n_rows * row_bytes)
+        for count, k in enumerate(missing):
+            f.write(load_packable_image(source, manifest['filename'][k], dims, read_image).tobytes())
+            rows[k] = n_rows
+            n_rows += 1
+            if verbose and (count + 1) % 1000 == 0:
+                print(f'Packed {count + 1}/{len(missing)} images')
+
+    meta = {column: manifest[column] for column in PACK_META_COLUMNS[:-2]}
+    meta['row'] = np.array(rows, dtype=np.int64)
+    meta['n_rows'] = np.array(n_rows, dtype=np.int64)
+    write_pack_meta(meta, meta_path)
+    if verbose:
+        print(f'Packed {len(missing)} new or changed images of {source.key} to {images_path}')
+
+    return open_pack_images(source, n_rows, dims), meta['row']
@@ -0,0 +1,168 @@
+"""
+Where MasksDataset reads its image files from: a folder of `id__[x, y, w, h]__label.jpg` files, or the same files
+packed in one or more uncompressed tar archives (e.g. train.tar and test.tar of download_data.py, or a set of shards).
+
+Tar archives are read in place: the offset of every member is indexed once (the index is saved under
+constants.CACHE_DIR) and files are read through an mmap of the archive, without extracting anything.
+"""
+import hashlib
+import io
+import mmap
+import os
+import tarfile
+import numpy as np
+import constants
+
+
+def source_key(data_folder):
+    """
+    :param data_folder: images folder, tar archive path, or list of tar archive paths
+    :return: a string identifying data_folder
+    """
+    if isinstance(data_folder, (list, tuple)):
+        return '|'.join(os.path.abspath(path) for path in data_folder)
+    return os.path.abspath(data_folder)
+
+
+def open_image_source(data_folder):
+    """
+    :param data_folder: images folder, tar archive path (.tar), list of tar archive paths, or an image source
+    :return: FolderImageSource or TarImageSource
+    """
+    if isinstance(data_folder, (FolderImageSource, TarImageSource)):
+        return data_folder
+    if isinstance(data_folder, (list, tuple)):
+        return TarImageSource(data_folder)
+    if data_folder.endswith('.tar') and os.path.isfile(data_folder):
+        return TarImageSource([data_folder])
+    return FolderImageSource(data_folder)
+
+
+class FolderImageSource(object):
+    """
+    Image files in a folder.
+    """
+
+    def __init__(self, data_folder):
+        self.data_folder = data_folder
+        self.key = source_key(data_folder)
+
+    def scan(self):
+        """
+        :return: sorted filenames, their mtimes (ns) and sizes (bytes)
+        """
+        filenames = sorted(os.listdir(self.data_folder))
+        stats = [os.stat(os.path.join(self.data_folder, filename)) for filename in filenames]
+        return filenames, [st.st_mtime_ns for st in stats], [st.st_size for st in stats]
+
+    def open(self, filename):
+        """
+        :return: a binary file object of filename
+        """
+        return open(os.path.join(self.data_folder, filename), 'rb')
+
+
+class TarImageSource(object):
+    """
+    Image files in uncompressed tar archives, addressed by their base filename.
+    """
+
+    def __init__(self, tar_paths):
+        self.tar_paths = [os.path.abspath(path) for path in tar_paths]
+        self.key = source_key(self.tar_paths)
+        self.index = load_tar_index(self.tar_paths)
+        self.rows = {filename: k for k, filename in enumerate(self.index['filename'].tolist())}
+        self.maps = None  # mmaps of the archives, opened on first use, once per DataLoader worker
+
+    def __getstate__(self):
+        # mmaps can't be pickled (DataLoader workers started with spawn), they are reopened
+        state = self.__dict__.copy()
+        state['maps'] = None
+        return state
+
+    def scan(self):
+        """
+        :return: sorted filenames, their mtimes (ns) and sizes (bytes), as stored in the archives
+        """
+        return self.index['filename'].tolist(), self.index['mtime'].tolist(), self.index['size'].tolist()
+
+    def open(self, filename):
+        """
+        :return: a binary file object of filename
+        """
+        if self.maps is None:
+            self.maps = []
+            for path in self.tar_paths:
+                with open(path, 'rb') as f:
+                    self.maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        k = self.rows[filename]
+        offset, size = int(self.index['offset'][k]), int(self.index['size'][k])
+        return io.BytesIO(self.maps[int(self.index['shard'][k])][offset:offset + size])
+
+
+TAR_INDEX_COLUMNS = ('filename', 'shard', 'offset', 'size', 'mtime', 'tar_mtime', 'tar_size')
+
+
+def tar_index_path(tar_paths):
+    key = hashlib.sha1(source_key(tar_paths).encode()).hexdigest()[:16]
+    return os.path.join(constants.CACHE_DIR, 'tar_indices', f'{key}.npz')
+
+
+def build_tar_index(tar_paths):
+    """
+    Index the regular files of tar archives by reading only the member headers.
+
+    :param tar_paths: tar archive paths (shards)
+    :return: index dict of columns, rows sorted by filename
+    """
+    rows = []
+    for shard, path in enumerate(tar_paths):
+        with tarfile.open(path, mode='r:') as tf:  # uncompressed only, compressed archives can't be mmap-ed
+            for member in tf:
+                filename = os.path.basename(member.name)
+                if not member.isfile() or filename.startswith('.'):
+                    continue
+                rows.append((filename, shard, member.offset_data, member.size, member.mtime * 10 ** 9))
+    rows.sort()
+    filenames = [row[0] for row in rows]
+    assert len(set(filenames)) == len(filenames), f'duplicate filenames in {tar_paths}'
+
+    columns = list(zip(*rows)) if rows else [[] for _ in range(5)]
+    stats = [os.stat(path) for path in tar_paths]
+    return dict(filename=np.array(columns[0], dtype=str),
+                shard=np.array(columns[1], dtype=np.int32),
+                offset=np.array(columns[2], dtype=np.int64),
+                size=np.array(columns[3], dtype=np.int64),
+                mtime=np.array(columns[4], dtype=np.int64),
+                tar_mtime=np.array([st.st_mtime_ns for st in stats], dtype=np.int64),
+                tar_size=np.array([st.st_size for st in stats], dtype=np.int64))
+
+
+def load_tar_index(tar_paths):
+    """
+    Load the index of tar archives, building and saving it if missing or if an archive changed.
+
+    :param tar_paths: tar archive paths (shards)
+    :return: index dict of columns
+    """
+    path = tar_index_path(tar_paths)
+    stats = [os.stat(tar_path) for tar_path in tar_paths]
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            index = {column: f[column] for column in TAR_INDEX_COLUMNS}
+        if index['tar_mtime'].tolist() == [st.st_mtime_ns for st in stats] \
+                and index['tar_size'].tolist() == [st.st_size for st in stats]:
+            return index
+    except (OSError, KeyError, ValueError):
+        pass
+
+    index = build_tar_index(tar_paths)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **index)
+        os.replace(tmp_path, path)
+    except OSError as e:  # e.g. a read-only cache directory, the index is rebuilt next time
+        print(f'Could not save tar index to {path}: {e}')
+    return index
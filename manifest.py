@@ -0,0 +1,171 @@
+"""
+Columnar manifest of an images folder (or tar archives, see image_sources.py): one row per
+`id__[x, y, w, h]__label.jpg` file with the parsed annotation and the image width and height (read from the JPEG
+header, no decode). The manifest is saved as an .npz file under
+constants.CACHE_DIR and only the rows of new or changed files (by mtime and size) are re-read on the next load.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from PIL import Image
+import constants
+from image_sources import open_image_source
+
+MANIFEST_COLUMNS = ('filename', 'image_id', 'bbox', 'proper_mask', 'width', 'height', 'mtime', 'size')
+
+
+def parse_filename(filename):
+    """
+    Parse the annotation encoded in an image filename.
+
+    :param filename: filename with a `id__[x, y, w, h]__label.jpg` format
+    :return: image_id (str), bbox [x_min, y_min, w, h] (list), proper_mask (bool)
+    """
+    image_id, bbox, proper_mask = filename.strip(".jpg").split("__")
+    bbox = json.loads(bbox)  # convert string bbox to list of integers
+    return image_id, bbox, proper_mask.lower() == "true"
+
+
+def manifest_path(data_folder):
+    """
+    :param data_folder: images folder, tar archive(s) or image source (see image_sources.py)
+    :return: path of the manifest file of data_folder in the cache directory
+    """
+    key = hashlib.sha1(open_image_source(data_folder).key.encode()).hexdigest()[:16]
+    return os.path.join(constants.CACHE_DIR, 'manifests', f'{key}.npz')
+
+
+def read_manifest(path):
+    """
+    :param path: manifest file path
+    :return: manifest dict of columns, or None if the file is missing or unreadable
+    """
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            return {column: f[column] for column in MANIFEST_COLUMNS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_manifest(manifest, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **manifest)
+    os.replace(tmp_path, path)  # atomic, concurrent readers see either the old or the new manifest
+
+
+def build_manifest(filenames, mtimes, sizes, read_size, previous=None):
+    """
+    Build a manifest, reusing the rows of previous whose file did not change.
+
+    :param filenames: sorted filenames
+    :param mtimes: mtime of each file
+    :param sizes: size in bytes of each file
+    :param read_size: function from a filename to its image (width, height)
+    :param previous: previous manifest of the same files, or None
+    :return: manifest dict of columns, number of rows that were (re)read
+    """
+    known = {}
+    if previous is not None:
+        for k, filename in enumerate(previous['filename']):
+            known[filename] = k
+
+    rows = []
+    n_read = 0
+    for filename, mtime, size in zip(filenames, mtimes, sizes):
+        k = known.get(filename)
+        if k is not None and previous['mtime'][k] == mtime and previous['size'][k] == size:
+            rows.append((filename, previous['image_id'][k], previous['bbox'][k], previous['proper_mask'][k],
+                         previous['width'][k], previous['height'][k], mtime, size))
+            continue
+        image_id, bbox, proper_mask = parse_filename(filename)
+        width, height = read_size(filename)
+        rows.append((filename, image_id, bbox, proper_mask, width, height, mtime, size))
+        n_read += 1
+
+    columns = list(zip(*rows)) if rows else [[] for _ in MANIFEST_COLUMNS]
+    manifest = dict(filename=np.array(columns[0], dtype=str),
+                    image_id=np.array(columns[1], dtype=str),
+                    bbox=np.array(columns[2], dtype=np.float32).reshape(-1, 4),  # [x_min, y_min, w, h]
+                    proper_mask=np.array(columns[3], dtype=bool),
+                    width=np.array(columns[4], dtype=np.int32),
+                    height=np.array(columns[5], dtype=np.int32),
+                    mtime=np.array(columns[6], dtype=np.int64),
+                    size=np.array(columns[7], dtype=np.int64))
+    return manifest, n_read
+
+
+def load_manifest(data_folder, verbose=False):
+    """
+    Load the manifest of data_folder, rebuilding (incrementally) and saving it if the folder changed.
+
+    :param data_folder: images folder, tar archive(s) or image source (see image_sources.py)
+    :param verbose: print how many rows were re-read
+    :return: manifest dict of columns, rows sorted by filename
+    """
+    source = open_image_source(data_folder)
+    path = manifest_path(source)
+    previous = read_manifest(path)
+    filenames, mtimes, sizes = source.scan()
+
+    if previous is not None and previous['filename'].tolist() == filenames \
+            and previous['mtime'].tolist() == mtimes and previous['size'].tolist() == sizes:
+        return previous
+
+    def read_size(filename):
+        with source.open(filename) as f, Image.open(f, mode='r') as image:  # reads only the header
+            return image.size
+
+    manifest, n_read = build_manifest(filenames, mtimes, sizes, read_size, previous)
+    try:
+        write_manifest(manifest, path)
+    except OSError as e:  # e.g. a read-only cache directory, the manifest is rebuilt next time
+        print(f'Could not save manifest to {path}: {e}')
+    if verbose:
+        print(f'Updated manifest of {source.key} - read {n_read} of {len(filenames)} images')
+    return manifest
+
+
+def subset_manifest(manifest, indices):
+    """
+    :param manifest: manifest dict of columns
+    :param indices: row indices (or boolean mask) to keep
+    :return: manifest with the selected rows only
+    """
+    return {column: values[indices] for column, values in manifest.items()}
+
+
+def shard_slice(n_rows, index, count, align=1):
+    """
+    :param n_rows: number of rows to split
+    :param index: index of the shard, in [0, count)
+    :param count: number of shards
+    :param align: the shards start at multiples of align rows (e.g. the batch size, so that every shard is made of
+    the same batches as the whole)
+    :return: slice of the rows of the shard, contiguous shards of about the same number of rows, in order
+    """
+    assert 0 <= index < count
+    n_blocks = -(-n_rows // align)
+    return slice(min(n_rows, index * n_blocks // count * align), min(n_rows, (index + 1) * n_blocks // count * align))
+
+
+def stratified_sample(manifest, n_images, seed=0):
+    """
+    :param manifest: manifest dict of columns
+    :param n_images: number of images of the sample
+    :param seed: seed of the sample, the same seed gives the same sample
+    :return: sorted filenames of n_images images, sampled in every proper_mask class in proportion to its size
+    """
+    filenames, labels = manifest['filename'], manifest['proper_mask']
+    n_images = min(n_images, len(filenames))
+    if n_images == 0:
+        return []
+    classes = np.unique(labels)
+    quotas = n_images * np.array([np.sum(labels == label) for label in classes]) / len(filenames)
+    sizes = np.floor(quotas).astype(int)
+    sizes[np.argsort(sizes - quotas)[:n_images - sizes.sum()]] += 1  # the largest remainders round up
+    rng = np.random.RandomState(seed)
+    sample = [rng.choice(np.flatnonzero(labels == label), size, replace=False) for label, size in zip(classes, sizes)]
+    return sorted(filenames[np.concatenate(sample)].tolist())
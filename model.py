@@ -1,16 +1,125 @@
+import contextlib
+import inspect
 import torch
+import torch.utils.checkpoint
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
-from torchvision.models import resnet
+from torchvision.models import resnet, mobilenet
 from torchvision.ops import misc as misc_nn_ops
 from torchvision.models.detection.backbone_utils import BackboneWithFPN
 from torchvision.models.detection.faster_rcnn import FasterRCNN
+from torchvision.models.detection.anchor_utils import AnchorGenerator
+from constants import PROPOSAL_PROFILES  # defined without torch, for the arguments parsing of predict.py
 
 
-def resnet_fpn_backbone(backbone_name, pretrained):
+def apply_proposal_profile(model, profile):
+    """
+    Set the inference proposal budgets of a built model in place.
+
+    :param model: FasterRCNN model
+    :param profile: name of a PROPOSAL_PROFILES profile
+    :return: model
+    """
+    budgets = PROPOSAL_PROFILES[profile]
+    model.rpn._pre_nms_top_n['testing'] = budgets['rpn_pre_nms_top_n_test']
+    model.rpn._post_nms_top_n['testing'] = budgets['rpn_post_nms_top_n_test']
+    return model
+
+
+# torch>=1.11: non-reentrant checkpoints also compute the gradients of the parameters of a stage whose input doesn't
+# require grad (e.g. layer1 when conv1 is frozen)
+REENTRANT_CHECKPOINT = 'use_reentrant' not in inspect.signature(torch.utils.checkpoint.checkpoint).parameters
+
+
+@contextlib.contextmanager
+def frozen_running_stats(module):
+    """
+    Don't update the running statistics of the batch norms of module in this context, num_batches_tracked included
+    (they still normalize with the batch statistics in training mode).
+    """
+    norms = [m for m in module.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+    momenta = [norm.momentum for norm in norms]
+    counts = [None if norm.num_batches_tracked is None else norm.num_batches_tracked.clone() for norm in norms]
+    try:
+        for norm in norms:
+            norm.momentum = 0.
+        yield
+    finally:
+        with torch.no_grad():
+            for norm, momentum, count in zip(norms, momenta, counts):
+                norm.momentum = momentum
+                if count is not None:
+                    norm.num_batches_tracked.copy_(count)
+
+
+class CheckpointedSequential(torch.nn.Sequential):
+    """
+    Sequential stage whose activations are not kept for the backward pass in training, but recomputed by it
+    (activation checkpointing): trades the memory of the activations of the stage for one more forward pass of it.
+    The batch norm running statistics are only updated by the first forward pass, not by the recomputation.
+    """
+
+    def forward(self, x):
+        if not (self.training and torch.is_grad_enabled()) or (REENTRANT_CHECKPOINT and not x.requires_grad):
+            return super().forward(x)
+        recomputing = []
+
+        def run(x):
+            if recomputing:
+                with frozen_running_stats(self):
+                    return torch.nn.Sequential.forward(self, x)
+            recomputing.append(True)
+            return torch.nn.Sequential.forward(self, x)
+
+        if REENTRANT_CHECKPOINT:
+            return torch.utils.checkpoint.checkpoint(run, x)
+        return torch.utils.checkpoint.checkpoint(run, x, use_reentrant=False)
+
+
+def freeze_batch_norms(module):
+    """
+    Replace the BatchNorm2d layers of a frozen module by FrozenBatchNorm2d layers with the same statistics and affine
+    parameters (in place), so that the running statistics of the frozen stages don't follow the training batches.
+
+    :return: module, or its FrozenBatchNorm2d replacement if it's a BatchNorm2d
+    """
+    if isinstance(module, torch.nn.BatchNorm2d):
+        frozen = misc_nn_ops.FrozenBatchNorm2d(module.num_features, eps=module.eps)
+        with torch.no_grad():
+            for key in ('weight', 'bias', 'running_mean', 'running_var'):
+                getattr(frozen, key).copy_(getattr(module, key))
+        return frozen
+    for name, child in module.named_children():
+        setattr(module, name, freeze_batch_norms(child))
+    return module
+
+
+def resnet_fpn_backbone(backbone_name, pretrained, trainable_layers=None, checkpoint_stages=0):
+    """
+    :param backbone_name: resnet18, resnet34, resnet50, ...
+    :param trainable_layers: number of trainable stages counted from layer4 (0 to 5), by default all. The batch norms
+    of the frozen stages are frozen too (FrozenBatchNorm2d)
+    :param checkpoint_stages: number of stages counted from layer1 (0 to 4) that recompute their activations in the
+    backward pass instead of keeping them (see CheckpointedSequential), layer1 has the largest activations
+    """
     backbone = resnet.__dict__[backbone_name](
         pretrained=pretrained,
         norm_layer=misc_nn_ops.BatchNorm2d)
 
+    if trainable_layers is not None:
+        layers_to_train = ['layer4', 'layer3', 'layer2', 'layer1', 'conv1'][:trainable_layers]
+        if trainable_layers == 5:
+            layers_to_train.append('bn1')
+        for name, parameter in backbone.named_parameters():
+            if all(not name.startswith(layer) for layer in layers_to_train):
+                parameter.requires_grad_(False)
+        for name in ['bn1', 'layer1', 'layer2', 'layer3', 'layer4']:
+            if name not in layers_to_train:
+                setattr(backbone, name, freeze_batch_norms(getattr(backbone, name)))
+
+    # same children, so the same state dict keys
+    for layer in ['layer1', 'layer2', 'layer3', 'layer4'][:checkpoint_stages]:
+        setattr(backbone, layer, CheckpointedSequential(*getattr(backbone, layer)))
+
     return_layers = {'layer1': '0', 'layer2': '1', 'layer3': '2', 'layer4': '3'}
 
     in_channels_stage2 = backbone.inplanes // 8
@@ -24,31 +133,144 @@ def resnet_fpn_backbone(backbone_name, pretrained):
     return BackboneWithFPN(backbone, return_layers, in_channels_list, out_channels)
 
 
-def fasterrcnn_resnet50_fpn(num_classes=91, pretrained_backbone=False, **kwargs):
-    backbone = resnet_fpn_backbone('resnet50', pretrained_backbone)
-    model = FasterRCNN(backbone, num_classes, **kwargs)
+def mobilenet_fpn_backbone(backbone_name, pretrained, trainable_layers=None, checkpoint_stages=0):
+    """
+    FPN over the last two stages of a MobileNet (as torchvision's fasterrcnn_mobilenet_v3_large_fpn).
+
+    :param backbone_name: mobilenet_v3_large or mobilenet_v3_small
+    :param trainable_layers: number of trainable stages counted from the last one, by default all. The batch norms of
+    the frozen stages are frozen too (FrozenBatchNorm2d)
+    :param checkpoint_stages: not supported, must be 0
+    """
+    if checkpoint_stages:
+        raise ValueError('activation checkpointing is only implemented for the ResNet backbones')
+    backbone = mobilenet.__dict__[backbone_name](
+        pretrained=pretrained,
+        norm_layer=misc_nn_ops.BatchNorm2d).features
+
+    # the first block and the blocks that reduce the resolution start a stage, the last block ends the last stage
+    stage_indices = [0] + [i for i, block in enumerate(backbone) if getattr(block, '_is_cn', False)] + \
+                    [len(backbone) - 1]
+    num_stages = len(stage_indices)
+
+    if trainable_layers is not None:
+        freeze_before = len(backbone) if trainable_layers == 0 else stage_indices[num_stages - trainable_layers]
+        for block in backbone[:freeze_before]:
+            for parameter in block.parameters():
+                parameter.requires_grad_(False)
+            freeze_batch_norms(block)
+
+    returned_layers = [num_stages - 2, num_stages - 1]
+    return_layers = {f'{stage_indices[k]}': str(v) for v, k in enumerate(returned_layers)}
+    in_channels_list = [backbone[stage_indices[k]].out_channels for k in returned_layers]
+    out_channels = 256
+    return BackboneWithFPN(backbone, return_layers, in_channels_list, out_channels)
+
+
+# backbone name -> (builder, anchor sizes of each feature map). The ResNets have 5 feature maps (4 stages + max pool)
+# with one anchor size each, the MobileNets 3 with all the sizes.
+BACKBONES = {
+    'resnet18': (resnet_fpn_backbone, ((32,), (64,), (128,), (256,), (512,))),
+    'resnet34': (resnet_fpn_backbone, ((32,), (64,), (128,), (256,), (512,))),
+    'resnet50': (resnet_fpn_backbone, ((32,), (64,), (128,), (256,), (512,))),
+    'mobilenet_v3_large': (mobilenet_fpn_backbone, ((32, 64, 128, 256, 512),) * 3),
+    'mobilenet_v3_small': (mobilenet_fpn_backbone, ((32, 64, 128, 256, 512),) * 3),
+}
+
+
+def fasterrcnn_fpn(backbone_name='resnet50', num_classes=91, pretrained_backbone=False, trainable_layers=None,
+                   checkpoint_stages=0, **kwargs):
+    builder, anchor_sizes = BACKBONES[backbone_name]
+    backbone = builder(backbone_name, pretrained_backbone, trainable_layers, checkpoint_stages)
+    anchor_generator = AnchorGenerator(anchor_sizes, ((0.5, 1.0, 2.0),) * len(anchor_sizes))
+    model = FasterRCNN(backbone, num_classes, rpn_anchor_generator=anchor_generator, **kwargs)
+    model.backbone_name = backbone_name  # saved in the checkpoints, see utils.save_checkpoint()
     return model
 
 
-def get_fasterrcnn_resnet50_fpn(weights_path=None):
+def fasterrcnn_resnet50_fpn(num_classes=91, pretrained_backbone=False, **kwargs):
+    return fasterrcnn_fpn('resnet50', num_classes, pretrained_backbone, **kwargs)
+
+
+@contextlib.contextmanager
+def no_init():
+    """
+    Skip the random initialization of the modules created in this context, their parameters are left uninitialized.
+    Only for models that get all their weights from a checkpoint right after (strict load_state_dict()).
+
+    The torchvision detection models can't be built on the meta device with torch 1.9, so instead the torch.nn.init
+    functions (used by the reset_parameters() of the torch modules and by the torchvision heads) are no-ops here.
+    """
+    names = [name for name in dir(torch.nn.init) if name.endswith('_') and not name.startswith('_')]
+    originals = {name: getattr(torch.nn.init, name) for name in names}
+    try:
+        for name in names:
+            setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(torch.nn.init, name, function)
+
+
+def load_checkpoint(weights_path):
+    """
+    Load a checkpoint (see utils.save_checkpoint() and checkpoints.py) to the CPU. With torch>=2.1 the checkpoint is
+    memory-mapped, the tensors are then paged in from the file instead of being read and copied up front.
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(weights_path, map_location='cpu', mmap=True)
+        except RuntimeError:  # legacy (non-zip) checkpoints can't be memory-mapped
+            pass
+    return torch.load(weights_path, map_location='cpu')
+
+
+def get_fasterrcnn_resnet50_fpn(weights_path=None, profile='default', backbone=None, trainable_layers=None,
+                                checkpoint_stages=0):
+    """
+    :param weights_path: checkpoint to load (see utils.save_checkpoint())
+    :param profile: inference proposal budgets, a PROPOSAL_PROFILES name
+    :param backbone: a BACKBONES name, by default the backbone of the checkpoint (resnet50 for older checkpoints or
+    without a checkpoint)
+    :param trainable_layers: number of trainable backbone stages, by default all. Without weights_path, the backbone
+    then starts from its ImageNet weights (downloaded once by torchvision): frozen random stages would be useless
+    :param checkpoint_stages: number of ResNet stages with activation checkpointing in training, see
+    resnet_fpn_backbone()
+    """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+    checkpoint = load_checkpoint(weights_path) if weights_path else {}
+    checkpoint_backbone = checkpoint.get('backbone', 'resnet50')
+    if backbone is None:
+        backbone = checkpoint_backbone
+    if weights_path and backbone != checkpoint_backbone:
+        raise ValueError(f'{weights_path} is a {checkpoint_backbone} checkpoint, not {backbone}')
+
     # MasksDataset mean and std
     mean = [0.5244, 0.4904, 0.4781]
     std = [0.2642, 0.2608, 0.2561]
 
-    # Initialize model
-    model = fasterrcnn_resnet50_fpn(pretrained_backbone=False,
-                                    image_mean=mean,
-                                    image_std=std,
-                                    min_size=224,
-                                    max_size=224,
-                                    box_detections_per_img=1)
-    in_features = model.roi_heads.box_predictor.cls_score.in_features
-    model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes=3)
+    # Initialize model, without a throwaway random initialization when the weights are loaded
+    with no_init() if weights_path else contextlib.nullcontext():
+        model = fasterrcnn_fpn(backbone,
+                               pretrained_backbone=trainable_layers is not None and not weights_path,
+                               trainable_layers=trainable_layers,
+                               checkpoint_stages=checkpoint_stages,
+                               image_mean=mean,
+                               image_std=std,
+                               min_size=224,
+                               max_size=224,
+                               box_detections_per_img=1,
+                               **PROPOSAL_PROFILES[profile])
+        in_features = model.roi_heads.box_predictor.cls_score.in_features
+        model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes=3)
 
     if weights_path:
-        model.load_state_dict(torch.load(weights_path)['state_dict'])
+        state_dict = checkpoint['state_dict']
+        if device.type == 'cpu' and 'assign' in inspect.signature(model.load_state_dict).parameters:
+            model.load_state_dict(state_dict, assign=True)  # use the (memory-mapped) tensors, no copy (torch>=2.1)
+        else:
+            model.load_state_dict(state_dict)
 
     return model.to(device)
 
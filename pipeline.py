@@ -0,0 +1,158 @@
+"""
+Pipelined inference loop: the batches of a DataLoader go through three stages that run concurrently, connected by
+bounded queues, so that fetching (decoding and preprocessing in the DataLoader workers, then stacking into one
+contiguous, pinned batch) of batch N+1 overlaps with the forward pass of batch N and with the post-processing of
+batch N-1:
+
+    fetch thread        next(loader), stack, pin_memory()
+    calling thread      host-to-device copy (non_blocking from pinned memory), model forward
+    postprocess thread  the given postprocess function (e.g. eval.StreamingMetrics.add)
+
+Every stage records its busy time, the stage with a utilization close to 100% is the bottleneck
+(see print_utilization()).
+"""
+import queue
+import threading
+import time
+import torch
+
+END = object()  # end of the batches
+
+
+class StageTimer(object):
+    """
+    Busy and waiting seconds of a pipeline stage.
+    """
+
+    def __init__(self):
+        self.busy = 0.
+        self.wait = 0.
+        self.batches = 0
+
+
+def stack_batch(images, pin_memory):
+    """
+    :param images: sequence of image tensors of the same size
+    :return: one contiguous tensor of dimensions (n_images, ...), in pinned memory if pin_memory
+    """
+    batch = torch.stack(list(images))
+    return batch.pin_memory() if pin_memory else batch
+
+
+def run_pipeline(loader, model, postprocess, device, prefetch=2):
+    """
+    Run the model on the batches of loader, pipelined.
+
+    :param loader: DataLoader of (images, targets) batches, the images of a batch of the same size
+    :param model: model, called on a list of images in the calling thread (e.g. under torch.no_grad())
+    :param postprocess: function called with the model outputs of every batch, in order, in a background thread
+    :param device: device of the model
+    :param prefetch: maximum number of batches waiting between two stages
+    :return: dict of the StageTimer of every stage, and the wall time in seconds
+    """
+    pin_memory = device.type == 'cuda'
+    fetched = queue.Queue(maxsize=prefetch)
+    outputs = queue.Queue(maxsize=prefetch)
+    timers = dict(fetch=StageTimer(), forward=StageTimer(), postprocess=StageTimer())
+    errors = []
+    stop = threading.Event()
+
+    def put(q, item, timer):
+        # blocking put that gives up when another stage failed
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        timer.wait += time.perf_counter() - start
+
+    def get(q, timer):
+        # blocking get that gives up (returns END) when another stage failed
+        start = time.perf_counter()
+        item = END
+        while not stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        timer.wait += time.perf_counter() - start
+        return item
+
+    def fetch():
+        timer = timers['fetch']
+        try:
+            iterator = iter(loader)
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    images, _ = next(iterator)
+                except StopIteration:
+                    break
+                batch = stack_batch(images, pin_memory)
+                timer.busy += time.perf_counter() - start
+                timer.batches += 1
+                put(fetched, batch, timer)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(fetched, END, timer)
+
+    def post():
+        timer = timers['postprocess']
+        try:
+            while True:
+                res = get(outputs, timer)
+                if res is END:
+                    break
+                start = time.perf_counter()
+                postprocess(res)
+                timer.busy += time.perf_counter() - start
+                timer.batches += 1
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=fetch, daemon=True), threading.Thread(target=post, daemon=True)]
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    timer = timers['forward']
+    try:
+        while True:
+            batch = get(fetched, timer)
+            if batch is END:
+                break
+            start = time.perf_counter()
+            images = list(batch.to(device, non_blocking=pin_memory).unbind(0))
+            res = model(images)
+            timer.busy += time.perf_counter() - start
+            timer.batches += 1
+            put(outputs, res, timer)
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        put(outputs, END, timer)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return dict(timers, wall=time.perf_counter() - wall_start)
+
+
+def print_utilization(stats):
+    """
+    Print the busy time and utilization (busy / wall time) of every stage of run_pipeline().
+    """
+    wall = stats['wall']
+    print(f'Pipeline stages over {wall:.2f} s:')
+    print(f'{"stage":<13}{"batches":>8}{"busy s":>9}{"wait s":>9}{"utilization":>13}')
+    for name in ('fetch', 'forward', 'postprocess'):
+        timer = stats[name]
+        print(f'{name:<13}{timer.batches:>8}{timer.busy:>9.2f}{timer.wait:>9.2f}{timer.busy / wall:>13.0%}')
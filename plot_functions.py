@@ -1,11 +1,11 @@
 import os
 import numpy as np
 import cv2
-import json
 import matplotlib.pyplot as plt
 import pandas as pd
 from matplotlib import patches
 from utils import calc_iou
+from manifest import load_manifest, parse_filename
 from matplotlib.ticker import StrMethodFormatter
 
 np.random.seed(42)
@@ -18,14 +18,9 @@ def parse_images_and_bboxes(image_dir):
     :param image_dir: Path to directory with images.
     :return: A list with (filename, image_id, bbox, proper_mask) for every image in the image_dir.
     """
-    example_filenames = os.listdir(image_dir)
-    data = []
-    for filename in example_filenames:
-        image_id, bbox, proper_mask = filename.strip(".jpg").split("__")
-        bbox = json.loads(bbox)
-        proper_mask = True if proper_mask.lower() == "true" else False
-        data.append((filename, image_id, bbox, proper_mask))
-    return data
+    manifest = load_manifest(image_dir)
+    return list(zip(manifest['filename'].tolist(), manifest['image_id'].tolist(), manifest['bbox'].tolist(),
+                    manifest['proper_mask'].tolist()))
 
 
 def show_images_and_bboxes(data, image_dir):
@@ -66,12 +61,12 @@ def show_images_and_bboxes_from_predictions_df(path):
     """
     Plot images with bounding boxes. Predicts random bounding boxes and computes IoU.
     :param path: path to final predictions.csv file, after evaluation of a modele
-    :param image_dir: Path to directory with images.
     :return: None
     """
     df = pd.read_csv(path)
-    df['true_box'] = df['filename'].apply(lambda x: [float(i) for i in x.split('__')[1][1:-1].split(',')])
-    df['true_label'] = df['filename'].apply(lambda x: x.split('__')[2][:-4])
+    # the ground truth is encoded in the filenames
+    df['true_box'] = df['filename'].apply(lambda x: [float(i) for i in parse_filename(x)[1]])
+    df['true_label'] = df['filename'].apply(lambda x: str(parse_filename(x)[2]))
     df['iou'] = df.apply(lambda sample: calc_iou(sample.true_box, (sample.x, sample.y, sample.w, sample.h)), axis=1)
     df = df.sort_values(by=['iou'])
 
@@ -155,15 +150,16 @@ def random_bbox_predict(bbox):
     return [x + np.random.randint(-15, 15) for x in bbox]
 
 
-def plot_one_metric(train_list, test_list, metric, mark_epoch=None):
+def plot_one_metric(train_list, test_list, metric, mark_epoch=None, epochs=None):
     """
     Plot graph with train and test results.
     :param train_list: train results values.
     :param test_list: test results values.
     :param metric: string of the metric name.
+    :param epochs: epochs (from 0) of the values, e.g. metrics['eval_epochs'], by default every epoch.
     :return: None.
     """
-    indices_list = [(1 + i) for i in range(len(train_list))]
+    indices_list = [(1 + i) for i in (range(len(train_list)) if epochs is None else epochs)]
     plt.figure(figsize=(12, 2))
     plt.plot(indices_list, train_list, '-', c="tab:blue", label=f'Train {metric}')
     plt.plot(indices_list, test_list, '-', c="tab:orange", label=f'Test {metric}')
@@ -173,10 +169,10 @@ def plot_one_metric(train_list, test_list, metric, mark_epoch=None):
 
     # Mark the chosen epoch
     if mark_epoch:
-        plt.plot([mark_epoch], train_list[mark_epoch - 1], 'o', color='tab:red', markersize=6)
-        plt.plot([mark_epoch], test_list[mark_epoch - 1], 'o', color='tab:red', markersize=6)
+        plt.plot([mark_epoch], train_list[indices_list.index(mark_epoch)], 'o', color='tab:red', markersize=6)
+        plt.plot([mark_epoch], test_list[indices_list.index(mark_epoch)], 'o', color='tab:red', markersize=6)
 
-    plt.xticks(np.arange(1, len(indices_list) + 1, step=1), fontsize=10, rotation=90)
+    plt.xticks(indices_list, fontsize=10, rotation=90)
     plt.grid(linewidth=1)
     plt.title(f'Train and test {metric} values along epochs')
     plt.xlabel("Epochs")
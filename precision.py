@@ -0,0 +1,91 @@
+"""
+Opt-in reduced precision for training and inference:
+
+    fp32  the default, no autocast
+    bf16  autocast of the forward pass (and losses) to bfloat16, on the CPU or on CUDA. bfloat16 has the range of
+          float32, no loss scaling is needed. Needs torch>=1.10 (torch.autocast), environment.yml pins torch 1.9.0:
+          bf16 is rejected there
+    fp16  autocast to float16 with dynamic loss scaling (GradScaler), CUDA only
+
+and channels_last: the convolution weights of the backbone (ResNet / MobileNet body + FPN) and its input in NHWC
+memory format, which the oneDNN (CPU) and cuDNN convolutions run faster, especially in bf16 / fp16.
+
+The gradients are unscaled (GradScaler.unscale_()) before the gradient clipping of train.train(), so that max_norm
+applies to the true gradients whatever the loss scale. See python benchmark.py precision for the A/B report.
+"""
+import contextlib
+import warnings
+import torch
+from constants import PRECISIONS
+
+DTYPES = dict(bf16=torch.bfloat16, fp16=torch.float16)
+
+
+def bf16_supported():
+    """
+    :return: whether the CPU has native bfloat16 instructions (e.g. AVX512-BF16, AMX), otherwise bf16 kernels are
+    emulated and slower than fp32
+    """
+    is_supported = getattr(torch.ops.mkldnn, '_is_mkldnn_bf16_supported', None)  # torch>=1.12
+    return bool(is_supported()) if is_supported is not None else False
+
+
+def check_precision(precision, device):
+    """
+    Raise a ValueError if precision can't be used on device, warn if it will be slow.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f'unknown precision {precision}, one of {PRECISIONS}')
+    if precision == 'fp16' and device.type != 'cuda':
+        raise ValueError('fp16 autocast needs a CUDA device, use bf16 on the CPU')
+    if precision == 'bf16':
+        # torch<1.10 has no bf16 autocast: its torch.cuda.amp.autocast() always runs in fp16
+        if not hasattr(torch, 'autocast'):
+            raise ValueError(f'bf16 autocast needs torch>=1.10, found {torch.__version__}')
+        if device.type == 'cpu' and not bf16_supported():
+            warnings.warn('this CPU has no native bfloat16 support, bf16 kernels are emulated (slower than fp32)')
+
+
+def autocast(precision, device):
+    """
+    :return: context manager running the ops of its block in precision on device (nothing to do for fp32)
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    check_precision(precision, device)
+    if hasattr(torch, 'autocast'):  # torch>=1.10
+        return torch.autocast(device.type, dtype=DTYPES[precision])
+    return torch.cuda.amp.autocast()  # fp16 on CUDA (checked above), the only autocast of torch 1.9
+
+
+def grad_scaler(precision, device):
+    """
+    :return: GradScaler, only enabled (dynamic loss scaling) for fp16. A disabled scaler passes the losses and the
+    optimizer steps through unchanged, so the training loop is the same for every precision
+    """
+    enabled = precision == 'fp16' and device.type == 'cuda'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):  # torch>=2.3, torch.cuda.amp.GradScaler deprecated
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def to_channels_last(model):
+    """
+    Switch the backbone of a detection model to channels_last: its 4D weights are converted in place, and its input
+    (the batched images of the model transform) is converted by a forward pre-hook. Calling it again is a no-op.
+    """
+    if getattr(model, 'channels_last', False):
+        return model
+    model.backbone.to(memory_format=torch.channels_last)
+    model.backbone.register_forward_pre_hook(
+        lambda module, inputs: tuple(x.contiguous(memory_format=torch.channels_last) for x in inputs))
+    model.channels_last = True
+    return model
+
+
+def float_outputs(outputs):
+    """
+    :param outputs: detections of the model, list of dicts of tensors
+    :return: the detections with the floating point tensors (boxes, scores) converted back to float32
+    """
+    return [{k: v.float() if v.is_floating_point() else v for k, v in output.items()} for output in outputs]
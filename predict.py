@@ -1,40 +1,111 @@
+import time
+
+start_time = time.perf_counter()
+
 import argparse
-import torch.utils.data
-from dataset import MasksDataset
-from model import get_fasterrcnn_resnet50_fpn
-from eval import evaluate
-import torch.backends.cudnn as cudnn
-from dataset import collate_fn
+import constants
+from constants import PROPOSAL_PROFILES, PRECISIONS
+from weights import get_weights_path
 import os
-import gdown
 import warnings
 
 warnings.filterwarnings("ignore")
-cudnn.benchmark = True
 
-# Parsing script arguments
-parser = argparse.ArgumentParser(description='Process input')
-parser.add_argument('input_folder', type=str, help='Input folder path, containing images')
-args = parser.parse_args()
 
-# Define device and checkpoint path
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+def main():
+    # Parsing script arguments
+    parser = argparse.ArgumentParser(description='Process input')
+    parser.add_argument('input_folder', type=str,
+                        help='Input folder path, containing images (or an uncompressed .tar of them)')
+    parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH,
+                        help='model weights file (env FACEMASK_WEIGHTS), by default downloaded once to the weights '
+                             'cache')
+    parser.add_argument('--offline', action='store_true', default=constants.OFFLINE,
+                        help='never download the model weights (env FACEMASK_OFFLINE=1)')
+    parser.add_argument('--verify-weights', action='store_true', help='re-hash the cached model weights')
+    parser.add_argument('--artifact', type=str, default=None,
+                        help='run an exported TorchScript model (see export.py) instead of the weights')
+    parser.add_argument('--profile', type=str, default='default', choices=list(PROPOSAL_PROFILES),
+                        help='inference proposal budgets, see model.PROPOSAL_PROFILES')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help='DataLoader workers decoding and preprocessing the images')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='split the images across this many prediction processes, each with its own model')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads per prediction process, by default the cores split between the '
+                             'processes')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='autocast precision of the forward passes, see precision.py')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='run the backbone in channels_last memory format')
+    parser.add_argument('--profile-startup', action='store_true', help='print a timing breakdown of the startup')
+    args = parser.parse_args()
+
+    # torch, torchvision and the model code once the arguments are parsed: --help and usage errors don't import them
+    import torch.utils.data
+    import torch.backends.cudnn as cudnn
+    from dataset import MasksDataset, collate_fn
+    from eval import evaluate
+    from export import load_artifact
+    from model import get_fasterrcnn_resnet50_fpn
+    from sharded_predict import predict_sharded
+    cudnn.benchmark = True
+
+    stage_times = [('imports', time.perf_counter() - start_time)]
+
+    def end_stage(name):
+        stage_times.append((name, time.perf_counter() - start_time - sum(seconds for _, seconds in stage_times)))
+
+    # Define device and checkpoint path
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if args.processes > 1:
+        weights_path = None
+        if not args.artifact:
+            print('Getting model weights ...')
+            weights_path = get_weights_path(args.weights, offline=args.offline, verify=args.verify_weights)
+            end_stage('weights')
+
+        # every process loads the model and predicts a contiguous shard of the images, see sharded_predict.py
+        print(f"Evaluating data from path {args.input_folder} in {args.processes} processes")
+        _, _, shard_stats = predict_sharded(args.input_folder, "prediction.csv", args.processes, threads=args.threads,
+                                            weights_path=weights_path, artifact=args.artifact, profile=args.profile,
+                                            precision=args.precision, channels_last=args.channels_last, verbose=True)
+        n_images = sum(stats['images'] for stats in shard_stats)
+        end_stage('evaluate')
+    else:
+        if args.artifact:
+            print('Loading TorchScript model ...')
+            model = load_artifact(args.artifact, device)
+            end_stage('model')
+        else:
+            print('Getting model weights ...')
+            weights_path = get_weights_path(args.weights, offline=args.offline, verify=args.verify_weights)
+            end_stage('weights')
+
+            print('Loading model ...')
+            model = get_fasterrcnn_resnet50_fpn(weights_path=weights_path, profile=args.profile)
+            end_stage('model')
 
-print('Downloading model weights ...')
-module_path = os.path.dirname(os.path.realpath(__file__))
-gdrive_file_id = '19wM9Bm16SnTvjsxVU6uOdZQrdWIUd4LS'
+        print('Loading data ...')
+        dataset = MasksDataset(data_folder=args.input_folder, split='test', packed=True)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=20, shuffle=False, num_workers=args.workers,
+                                                 collate_fn=collate_fn)
+        end_stage('data')
 
-url = f'https://drive.google.com/uc?id={gdrive_file_id}'
-weights_path = os.path.join(module_path, 'faster_rcnn.pth.tar')
-gdown.download(url, weights_path, quiet=False)
+        # Evaluate model on given data
+        print(f"Evaluating data from path {args.input_folder}")
+        evaluate(dataloader, model, save_csv="prediction.csv", verbose=True, pipelined=True, precision=args.precision,
+                 channels_last=args.channels_last)
+        n_images = len(dataset)
+        end_stage('evaluate')
 
-print('Loading model ...')
-model = get_fasterrcnn_resnet50_fpn(weights_path=weights_path)
+    if args.profile_startup:
+        print('Startup timing breakdown:')
+        for name, seconds in stage_times:
+            print(f'{name:<10}{seconds:>8.3f} s')
+        print(f'{"total":<10}{time.perf_counter() - start_time:>8.3f} s for {n_images} images')
 
-print('Loading data ...')
-dataset = MasksDataset(data_folder=args.input_folder, split='test')
-dataloader = torch.utils.data.DataLoader(dataset, batch_size=20, shuffle=False, collate_fn=collate_fn)
 
-# Evaluate model on given data
-print(f"Evaluating data from path {args.input_folder}")
-evaluate(dataloader, model, save_csv="prediction.csv", verbose=True)
+if __name__ == '__main__':  # the workers of --processes are spawned, they import this module
+    main()
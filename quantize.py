@@ -0,0 +1,95 @@
+"""
+INT8 CPU inference: post-training static quantization (FX graph mode) of the ResNet-50 FPN backbone, calibrated on
+images of a MasksDataset, and dynamic quantization of the Linear layers of the box head. The RPN head, the box
+predictor and the box decoding stay in fp32.
+
+usage: python quantize.py [--weights PATH] [--calibration-folder TRAIN_IMG_PATH] [--calibration-images 200]
+                          [--output faster_rcnn.int8.torchscript.pt]
+
+The quantized model is saved as a TorchScript artifact (see export.py) and loaded with export.load_artifact(), e.g.
+python predict.py <folder> --artifact faster_rcnn.int8.torchscript.pt. Quantized kernels run on the CPU only.
+See python benchmark.py quantization for the accuracy, latency, memory and size report against fp32.
+"""
+import argparse
+import copy
+import inspect
+import torch
+import torch.utils.data
+from torch.quantization import get_default_qconfig, quantize_dynamic
+from torch.quantization import quantize_fx
+import constants
+from dataset import MasksDataset, collate_fn
+from export import export_torchscript
+from model import get_fasterrcnn_resnet50_fpn
+from weights import get_weights_path, file_sha256
+
+
+def calibration_loader(data_folder, n_images, batch_size=10):
+    """
+    :return: DataLoader of n_images evenly spaced images of data_folder, without augmentations
+    """
+    dataset = MasksDataset(data_folder=data_folder, split='test', lazy=True)
+    step = max(1, len(dataset) // n_images)
+    subset = torch.utils.data.Subset(dataset, list(range(0, len(dataset), step))[:n_images])
+    return torch.utils.data.DataLoader(subset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+
+
+def quantize_model(model, loader, engine=None):
+    """
+    Quantize a copy of the model for CPU inference.
+
+    :param model: fp32 model (see model.get_fasterrcnn_resnet50_fpn()), on the CPU
+    :param loader: calibration DataLoader of (images, targets) batches
+    :param engine: quantized engine ('fbgemm' on x86, 'qnnpack' on ARM), by default torch's current one
+    :return: quantized model, in eval mode
+    """
+    if engine is None:
+        engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).cpu().eval()
+
+    # static: insert observers in the backbone + FPN (convs, batch norms and ReLUs are fused first)
+    qconfig_dict = {'': get_default_qconfig(engine)}
+    kwargs = {}
+    if 'example_inputs' in inspect.signature(quantize_fx.prepare_fx).parameters:  # required by torch>=1.13
+        kwargs['example_inputs'] = (torch.rand(1, 3, 224, 224),)
+    model.backbone = quantize_fx.prepare_fx(model.backbone, qconfig_dict, **kwargs)
+
+    # calibrate the observers on the inputs the backbone sees (normalized by the model transform)
+    with torch.no_grad():
+        for images, _ in loader:
+            model([image.cpu() for image in images])
+    model.backbone = quantize_fx.convert_fx(model.backbone)
+
+    # dynamic: int8 weights, activations quantized on the fly
+    model.roi_heads.box_head = quantize_dynamic(model.roi_heads.box_head, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='INT8 quantization for CPU inference')
+    parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH,
+                        help='model weights file (env FACEMASK_WEIGHTS), by default the cached download')
+    parser.add_argument('--offline', action='store_true', default=constants.OFFLINE,
+                        help='never download the model weights (env FACEMASK_OFFLINE=1)')
+    parser.add_argument('--calibration-folder', type=str, default=constants.TRAIN_IMG_PATH)
+    parser.add_argument('--calibration-images', type=int, default=200)
+    parser.add_argument('--engine', type=str, default=None, help='quantized engine, e.g. fbgemm or qnnpack')
+    parser.add_argument('--output', type=str, default='faster_rcnn.int8.torchscript.pt')
+    args = parser.parse_args()
+
+    weights_path = get_weights_path(args.weights, offline=args.offline)
+    model = get_fasterrcnn_resnet50_fpn(weights_path=weights_path).cpu().eval()
+    loader = calibration_loader(args.calibration_folder, args.calibration_images)
+    print(f'Calibrating on {len(loader.dataset)} images of {args.calibration_folder} ...')
+    quantized = quantize_model(model, loader, engine=args.engine)
+
+    export_torchscript(quantized, args.output, metadata=dict(weights_sha256=file_sha256(weights_path),
+                                                             quantization='int8',
+                                                             engine=torch.backends.quantized.engine,
+                                                             calibration_images=len(loader.dataset)))
+    print(f'Saved the quantized model to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
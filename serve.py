@@ -0,0 +1,220 @@
+"""
+Local inference server: loads the model once and serves predictions over HTTP, on a TCP port or a unix socket.
+Concurrent requests are coalesced into micro-batches of at most --max-batch-size images, a batch is run as soon as
+it is full or --max-wait-ms after its first image arrived.
+
+usage: python serve.py [--port 8000 | --unix-socket PATH] [--max-batch-size 16] [--max-wait-ms 10] [--weights PATH]
+
+POST /predict   body: one image file (any format PIL reads)
+                -> {"box": [x, y, w, h], "proper_mask": true, "score": 0.98}, the box in the image coordinates
+                or body: {"images": [base64 image file, ...]} with Content-Type: application/json
+                -> {"predictions": [{"box": ..., "proper_mask": ..., "score": ...}, ...]}
+GET /health     -> {"status": "ok", "batches": ..., "images": ..., "mean_batch_size": ...}
+
+See python benchmark.py serve-load for a load generator.
+"""
+import argparse
+import base64
+import concurrent.futures
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+from PIL import Image
+import constants
+from eval import preprocess_image, parse_prediction, original_box
+from model import get_fasterrcnn_resnet50_fpn, PROPOSAL_PROFILES
+from weights import get_weights_path
+
+
+class MicroBatcher(object):
+    """
+    Runs the model on micro-batches of the images submitted by concurrent threads, in a background thread.
+    """
+
+    def __init__(self, model, max_batch_size=16, max_wait=0.01):
+        """
+        :param model: model in eval mode
+        :param max_batch_size: maximum number of images per model call
+        :param max_wait: maximum seconds to wait for a batch to fill up after its first image arrived
+        """
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.n_batches = 0
+        self.n_images = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """
+        :param image: image tensor of dimensions (3, 224, 224), see eval.preprocess_image()
+        :return: future of the (box, label, score) prediction, see eval.parse_prediction()
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((image, future))
+        return future
+
+    def next_batch(self):
+        batch = [self.requests.get()]  # wait for the first image
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            images, futures = zip(*batch)
+            try:
+                with torch.no_grad():
+                    res = self.model([image.to(self.device) for image in images])
+                predictions = [parse_prediction(r) for r in res]
+            except Exception as e:  # fail the requests of this batch, keep serving
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.n_batches += 1
+            self.n_images += len(batch)
+            for future, prediction in zip(futures, predictions):
+                future.set_result(prediction)
+
+    def stats(self):
+        return dict(batches=self.n_batches, images=self.n_images,
+                    mean_batch_size=self.n_images / self.n_batches if self.n_batches else 0.)
+
+
+def decode_image_files(files):
+    """
+    :param files: image files contents (bytes)
+    :return: list of (image tensor, original size), see eval.preprocess_image()
+    """
+    return [preprocess_image(Image.open(io.BytesIO(data))) for data in files]
+
+
+def predict_images(batcher, inputs):
+    """
+    :param batcher: MicroBatcher
+    :param inputs: list of (image tensor, original size), see decode_image_files()
+    :return: list of {"box": [x, y, w, h], "proper_mask": bool, "score": float}
+    """
+    # all the images of the request are batched together (up to max_batch_size)
+    futures = [batcher.submit(image) for image, _ in inputs]
+    predictions = []
+    for (_, size), future in zip(inputs, futures):
+        box, label, score = future.result()
+        predictions.append(dict(box=original_box(box, size), proper_mask=bool(int(label) == 1),
+                                score=float(score)))
+    return predictions
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive connections
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, dict(error=f'unknown path {self.path}'))
+        self.send_json(200, dict(status='ok', **self.server.batcher.stats()))
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.send_json(404, dict(error=f'unknown path {self.path}'))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        is_json = self.headers.get('Content-Type', '').startswith('application/json')
+        try:
+            # decode in the request thread
+            files = [base64.b64decode(image) for image in json.loads(body)['images']] if is_json else [body]
+            inputs = decode_image_files(files)
+        except (OSError, ValueError, KeyError, TypeError) as e:  # not an image, bad JSON
+            return self.send_json(400, dict(error=f'{type(e).__name__}: {e}'))
+        try:
+            predictions = predict_images(self.server.batcher, inputs)
+        except Exception as e:  # failed model call (e.g. CUDA out of memory), set by the MicroBatcher
+            return self.send_json(500, dict(error=f'{type(e).__name__}: {e}'))
+        self.send_json(200, dict(predictions=predictions) if is_json else predictions[0])
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)  # HTTPServer.server_bind expects a (host, port) address
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(batcher, host='127.0.0.1', port=8000, unix_socket=None, verbose=False):
+    """
+    :return: HTTP server (not started, call serve_forever()) answering with the predictions of batcher
+    """
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.batcher = batcher
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local inference server with dynamic micro-batching')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', type=str, default=None, help='listen on this unix socket instead of a port')
+    parser.add_argument('--max-batch-size', type=int, default=16, help='maximum number of images per model call')
+    parser.add_argument('--max-wait-ms', type=float, default=10., help='maximum wait for a batch to fill up')
+    parser.add_argument('--weights', type=str, default=constants.WEIGHTS_PATH,
+                        help='model weights file (env FACEMASK_WEIGHTS), by default the cached download')
+    parser.add_argument('--offline', action='store_true', default=constants.OFFLINE,
+                        help='never download the model weights (env FACEMASK_OFFLINE=1)')
+    parser.add_argument('--profile', type=str, default='default', choices=list(PROPOSAL_PROFILES),
+                        help='inference proposal budgets, see model.PROPOSAL_PROFILES')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    model = get_fasterrcnn_resnet50_fpn(weights_path=get_weights_path(args.weights, offline=args.offline),
+                                        profile=args.profile).eval()
+    batcher = MicroBatcher(model, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    server = make_server(batcher, args.host, args.port, args.unix_socket, verbose=args.verbose)
+    print(f'Serving on {args.unix_socket or f"http://{args.host}:{args.port}"} (max batch size '
+          f'{args.max_batch_size}, max wait {args.max_wait_ms} ms)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Sharded batch prediction across CPU cores: the (sorted) images of a folder are split into contiguous shards, each
+predicted by its own worker process that loads the model once and runs torch with its own share of the cores
+(torch.set_num_threads()), so that the forward passes, the post-processing (GIL bound in a single process) and the
+data loading of the shards run in parallel. The partial CSVs of the workers are then merged into one CSV, in the
+original filename order, and their IoU and accuracy into the totals. The shards are made of whole batches, the
+merged CSV is the same as the one of a single process.
+
+Used by python predict.py <folder> --processes N. See python benchmark.py sharded-predict for the scaling report. The
+workers are spawned processes that import the main module of the calling script: guard it by
+if __name__ == '__main__'.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import torch
+import torch.utils.data
+from dataset import MasksDataset, collate_fn
+from eval import evaluate
+from export import load_artifact
+from model import get_fasterrcnn_resnet50_fpn
+
+
+def default_threads(processes):
+    """
+    :return: intra-op threads per worker process, the cores split evenly between the processes
+    """
+    return max(1, (os.cpu_count() or 1) // processes)
+
+
+def predict_shard(job):
+    """
+    Worker process: predict one shard of the images.
+
+    :param job: dict of data_folder, shard ((index, count, align), see MasksDataset), csv_path, weights_path, artifact,
+    profile, threads, batch_size, precision and channels_last
+    :return: dict of the number of images, of correct labels, the IoU sum, and the model loading and prediction seconds
+    """
+    start = time.perf_counter()
+    torch.set_num_threads(job['threads'])
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if job['artifact']:
+        model = load_artifact(job['artifact'], device)
+    else:
+        model = get_fasterrcnn_resnet50_fpn(weights_path=job['weights_path'], profile=job['profile'])
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dataset = MasksDataset(data_folder=job['data_folder'], split='test', packed=True, shard=job['shard'])
+    loader = torch.utils.data.DataLoader(dataset, batch_size=job['batch_size'], shuffle=False, collate_fn=collate_fn)
+    mean_accuracy, mean_iou = evaluate(loader, model, save_csv=job['csv_path'], device=device,
+                                       precision=job['precision'], channels_last=job['channels_last'])
+    return dict(images=len(dataset), correct=mean_accuracy * len(dataset), iou_sum=mean_iou * len(dataset),
+                load=load_seconds, predict=time.perf_counter() - start)
+
+
+def merge_csvs(csv_paths, save_csv):
+    """
+    Concatenate the CSVs, in order, into save_csv, keeping the header of the first one only.
+    """
+    with open(save_csv, 'w', newline='') as merged:
+        for k, path in enumerate(csv_paths):
+            with open(path, newline='') as part:
+                header = part.readline()
+                if k == 0:
+                    merged.write(header)
+                shutil.copyfileobj(part, merged)
+
+
+def predict_sharded(data_folder, save_csv, processes, threads=None, weights_path=None, artifact=None,
+                    profile='default', batch_size=20, precision='fp32', channels_last=False, verbose=False):
+    """
+    :param data_folder: images folder (or tar archive(s), see image_sources.py)
+    :param save_csv: path of the merged CSV of the predictions (filename, x, y, w, h, proper_mask)
+    :param processes: number of worker processes (shards), at most the number of batches
+    :param threads: intra-op threads per worker, by default the cores split evenly between the workers
+    :param weights_path: model weights file (see model.get_fasterrcnn_resnet50_fpn())
+    :param artifact: TorchScript artifact (see export.py) to run instead of the weights
+    :param profile: inference proposal budgets, see model.PROPOSAL_PROFILES
+    :param precision: autocast precision of the forward passes, see precision.py
+    :param channels_last: run the backbone in channels_last memory format
+    :param verbose: print IoU, accuracy and the timings of every worker
+    :return: mean accuracy, mean IoU, list of the stats of every worker (see predict_shard())
+    """
+    # pack the images once, up front, the workers only read the pack
+    n_images = len(MasksDataset(data_folder=data_folder, split='test', packed=True))
+    processes = max(1, min(processes, -(-n_images // batch_size)))
+    if threads is None:
+        threads = default_threads(processes)
+
+    tmp_dir = tempfile.mkdtemp(prefix='facemask_shards_')
+    try:
+        jobs = [dict(data_folder=data_folder, shard=(k, processes, batch_size),
+                     csv_path=os.path.join(tmp_dir, f'{k}.csv'), weights_path=weights_path, artifact=artifact,
+                     profile=profile, threads=threads, batch_size=batch_size, precision=precision,
+                     channels_last=channels_last) for k in range(processes)]
+        # spawned, like the evaluator of background_eval.py: the parent already ran torch ops (packing the images),
+        # a forked worker would inherit its thread pool and CUDA state
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            stats = pool.map(predict_shard, jobs, chunksize=1)
+        merge_csvs([job['csv_path'] for job in jobs], save_csv)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    mean_accuracy = sum(s['correct'] for s in stats) / n_images if n_images else float('nan')
+    mean_iou = sum(s['iou_sum'] for s in stats) / n_images if n_images else float('nan')
+
+    if verbose:
+        print(f'{processes} workers x {threads} threads:')
+        print(f'{"worker":<8}{"images":>8}{"load s":>9}{"predict s":>11}{"images/s":>10}')
+        for k, s in enumerate(stats):
+            print(f'{k:<8}{s["images"]:>8}{s["load"]:>9.2f}{s["predict"]:>11.2f}{s["images"] / s["predict"]:>10.1f}')
+        print(f'IoU = {round(float(mean_iou), 4)}, Accuracy = {round(float(mean_accuracy), 4)}')
+        print(f'saved results to {os.path.join(os.getcwd(), str(save_csv))}')
+
+    return mean_accuracy, mean_iou, stats
@@ -0,0 +1,182 @@
+"""
+Per-step training telemetry: the seconds of every stage of a training step (data wait, host-to-device copy, forward,
+backward, gradient clipping, optimizer step), every loss of the model's loss_dict, the gradient norm, the throughput
+and the RSS of the process, streamed one record per step to a JSONL or CSV file (flushed every step, so a running
+or killed job can be inspected).
+
+A torch.profiler capture of a window of global steps [start, stop) can be added, the trace (chrome://tracing or
+Perfetto, with the stages as ranges) and a table of the top ops are written to the profiler directory.
+
+usage: python train.py --telemetry telemetry.jsonl [--profiler-steps 20:25] [--profiler-dir profiler]
+
+Without a telemetry file or profiler window, the stages are not timed (no CUDA synchronization).
+"""
+import contextlib
+import csv
+import json
+import os
+import time
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def rss_bytes():
+    """
+    :return: resident set size of the process (the peak RSS where /proc isn't available)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on Linux
+
+
+def parse_step_range(text):
+    """
+    :param text: 'start:stop' global steps, stop excluded
+    :return: (start, stop)
+    """
+    start, stop = (int(step) for step in text.split(':'))
+    if not 0 <= start < stop:
+        raise ValueError(f'bad step range {text}, expected start:stop with 0 <= start < stop')
+    return start, stop
+
+
+class Telemetry(object):
+    """
+    call example (see train.train()):
+        telemetry = Telemetry('telemetry.jsonl', profiler_steps=(20, 25))
+        for i, (images, targets) in enumerate(loader):
+            telemetry.start_step(epoch, i, len(images), data_wait)
+            with telemetry.stage('forward'):
+                loss_dict = model(images, targets)
+            telemetry.add_losses(loss_dict)
+            ...
+            telemetry.end_step()
+        telemetry.close()
+    """
+
+    def __init__(self, path=None, profiler_steps=None, profiler_dir='profiler', device=torch.device('cpu')):
+        """
+        :param path: .jsonl or .csv file of the step records, None for no records
+        :param profiler_steps: (start, stop) global steps of the torch.profiler capture, None for no capture
+        :param profiler_dir: directory of the profiler trace and table
+        :param device: training device, CUDA is synchronized at the end of every stage for the timings
+        """
+        self.path = path
+        self.profiler_steps = profiler_steps
+        self.profiler_dir = profiler_dir
+        self.enabled = path is not None or profiler_steps is not None
+        self.synchronize = self.enabled and device.type == 'cuda'
+        self.global_step = 0
+        self.record = None
+        self.step_start = None
+        self.profiler = None
+
+        self.file = None
+        self.writer = None
+        if path is not None:
+            if os.path.splitext(path)[1] not in ('.jsonl', '.csv'):
+                raise ValueError(f'telemetry file {path} should be a .jsonl or a .csv')
+            self.file = open(path, 'w', newline='')
+
+    def start_step(self, epoch, batch, batch_size, data_wait):
+        """
+        :param epoch: epoch number
+        :param batch: batch number in the epoch
+        :param batch_size: number of images of the step
+        :param data_wait: seconds waited for the batch
+        """
+        if not self.enabled:
+            return
+        if self.profiler_steps is not None and self.global_step == self.profiler_steps[0]:
+            self.start_profiler()
+        self.record = dict(epoch=epoch, batch=batch, step=self.global_step, batch_size=batch_size,
+                           data_wait=data_wait, h2d=0., forward=0., backward=0., clip=0., optimizer_step=0.)
+        self.step_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the block as stage name of the current step (accumulated over the micro-batches).
+        """
+        if not self.enabled:
+            yield
+            return
+        with torch.profiler.record_function(name) if self.profiler is not None else contextlib.nullcontext():
+            start = time.perf_counter()
+            yield
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.record[name] += time.perf_counter() - start
+
+    def add_losses(self, loss_dict, weight=1.):
+        """
+        :param loss_dict: losses of the model
+        :param weight: weight of the losses in the step (the share of the batch of a micro-batch)
+        """
+        if not self.enabled:
+            return
+        for name, loss in loss_dict.items():
+            self.record[name] = self.record.get(name, 0.) + loss.item() * weight
+
+    def end_step(self, grad_norm=None):
+        """
+        :param grad_norm: gradient norm before clipping
+        """
+        if not self.enabled:
+            return
+        compute = time.perf_counter() - self.step_start
+        step_time = self.record['data_wait'] + compute
+        self.record.update(grad_norm=None if grad_norm is None else float(grad_norm), step_time=step_time,
+                           images_per_s=self.record['batch_size'] / step_time, rss_mb=rss_bytes() / 2 ** 20)
+        self.write(self.record)
+
+        if self.profiler is not None:
+            self.profiler.step()
+            if self.global_step + 1 == self.profiler_steps[1]:
+                self.stop_profiler()
+        self.global_step += 1
+
+    def write(self, record):
+        if self.file is None:
+            return
+        if self.path.endswith('.jsonl'):
+            self.file.write(json.dumps(record) + '\n')
+        else:
+            if self.writer is None:  # the columns of the first step (the loss names don't change)
+                self.writer = csv.DictWriter(self.file, fieldnames=list(record), lineterminator='\n')
+                self.writer.writeheader()
+            self.writer.writerow(record)
+        self.file.flush()
+
+    def start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.profiler.start()
+
+    def stop_profiler(self):
+        self.profiler.stop()
+        os.makedirs(self.profiler_dir, exist_ok=True)
+        name = f'steps_{self.profiler_steps[0]}-{self.profiler_steps[1]}'
+        trace_path = os.path.join(self.profiler_dir, f'{name}.trace.json')
+        self.profiler.export_chrome_trace(trace_path)
+        sort_by = 'cuda_time_total' if torch.cuda.is_available() else 'cpu_time_total'
+        with open(os.path.join(self.profiler_dir, f'{name}.txt'), 'w') as f:
+            f.write(self.profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+        print(f'Saved the profile of steps {self.profiler_steps[0]} to {self.profiler_steps[1] - 1} to {trace_path}')
+        self.profiler = None
+
+    def close(self):
+        if self.profiler is not None:  # the training ended inside the window
+            self.stop_profiler()
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,23 @@
+import pytest
+import constants
+from tests.synthetic import write_images
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """
+    Manifests, packs and tar indices of every test in its own cache directory, in spawned processes too.
+    """
+    monkeypatch.setattr(constants, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('FACEMASK_CACHE_DIR', constants.CACHE_DIR)
+    return constants.CACHE_DIR
+
+
+@pytest.fixture
+def image_folder(tmp_path):
+    """
+    Folder of 8 synthetic images.
+    """
+    folder = str(tmp_path / 'images')
+    write_images(folder, range(8))
+    return folder
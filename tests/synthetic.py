@@ -0,0 +1,33 @@
+"""
+Synthetic face mask images: JPEGs of a bright box (the "face") on a dark, smooth background, named like the dataset
+images, <image id>__[x, y, w, h]__<proper mask>.jpg.
+"""
+import os
+import numpy as np
+from PIL import Image
+
+
+def write_images(folder, image_ids, seed=0, min_size=60, max_size=400):
+    """
+    :param folder: folder to write the images to, created if needed
+    :param image_ids: integer ids of the images
+    :param seed: seed of the image sizes, boxes, labels and backgrounds
+    :param min_size: minimum width and height
+    :param max_size: maximum width and height
+    :return: filenames of the written images
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    filenames = []
+    for image_id in image_ids:
+        width, height = rng.randint(min_size, max_size + 1, size=2)
+        w, h = rng.randint(width // 4, width // 2 + 1), rng.randint(height // 4, height // 2 + 1)
+        x, y = rng.randint(0, width - w + 1), rng.randint(0, height - h + 1)
+        background = Image.fromarray(rng.randint(0, 80, size=(6, 6, 3)).astype(np.uint8)).resize((width, height),
+                                                                                                   Image.BILINEAR)
+        pixels = np.array(background)
+        pixels[y:y + h, x:x + w] = rng.randint(200, 256, size=3)
+        filename = f'{image_id:06d}__[{x}, {y}, {w}, {h}]__{bool(rng.randint(2))}.jpg'
+        Image.fromarray(pixels).save(os.path.join(folder, filename), quality=90)
+        filenames.append(filename)
+    return filenames
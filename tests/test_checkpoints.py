@@ -0,0 +1,108 @@
+"""
+CheckpointManager: the rotation, the best checkpoint and resume().
+"""
+import os
+import random
+import numpy as np
+import pytest
+import torch
+from checkpoints import CheckpointManager
+
+
+def epochs_on_disk(manager):
+    return sorted(manager.epoch_paths())
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return torch.nn.Linear(4, 2)
+
+
+def test_keep_last(model, tmp_path):
+    manager = CheckpointManager(str(tmp_path), keep_last=2)
+    for epoch in range(5):
+        manager.save(epoch, model)
+    manager.close()
+    assert epochs_on_disk(manager) == [3, 4]
+    with pytest.raises(ValueError):
+        CheckpointManager(str(tmp_path), keep_last=0)
+
+
+def test_checkpoints_of_another_run_are_left_alone(model, tmp_path):
+    for epoch in (49, 50, 51):  # checkpoint_fasterrcnn_epoch={50,51,52}.pth.tar of an earlier, longer run
+        torch.save({}, os.path.join(str(tmp_path), f'checkpoint_fasterrcnn_epoch={epoch + 1}.pth.tar'))
+    manager = CheckpointManager(str(tmp_path), keep_last=3)
+    manager.save(0, model)
+    manager.close()
+    assert epochs_on_disk(manager) == [0, 49, 50, 51]
+
+
+def test_protect_release(model, tmp_path):
+    written = []
+    manager = CheckpointManager(str(tmp_path), keep_last=1)
+    manager.save(0, model, on_written=lambda epoch, path: written.append((epoch, path)))
+    for epoch in (1, 2):
+        manager.save(epoch, model)
+    manager.wait()
+    assert written == [(0, manager.epoch_path(0))]
+    assert epochs_on_disk(manager) == [0, 2]  # protected
+
+    manager.release(0)
+    manager.wait()
+    assert epochs_on_disk(manager) == [0, 2]  # until the next checkpoint is written
+    manager.save(3, model)
+    manager.wait()
+    assert epochs_on_disk(manager) == [3]
+
+    manager.protect(3)
+    manager.save(4, model)
+    manager.release(3)
+    manager.close()  # rotates the released ones
+    assert epochs_on_disk(manager) == [4]
+
+
+def test_best_checkpoint_survives_the_rotation(model, tmp_path):
+    manager = CheckpointManager(str(tmp_path), keep_last=1)
+    manager.save(0, model, metrics={'test_iou': [.5]})
+    manager.wait()
+    if os.stat(manager.best_path).st_nlink > 1:  # hard link, not on every filesystem
+        assert os.path.samefile(manager.best_path, manager.epoch_path(0))
+    manager.save(1, model, metrics={'test_iou': [.5, .4]})
+    manager.close()
+    assert epochs_on_disk(manager) == [1]
+    assert torch.load(manager.best_path)['epoch'] == 0
+
+
+def test_resume(model, tmp_path):
+    optimizer = torch.optim.SGD(model.parameters(), lr=.1, momentum=.9)
+    model(torch.rand(8, 4)).sum().backward()
+    optimizer.step()
+    metrics = {'test_iou': [.1, .2, .3]}
+
+    manager = CheckpointManager(str(tmp_path), keep_last=3)
+    for epoch in range(3):
+        manager.save(epoch, model, optimizer, metrics)
+        expected_draws = torch.rand(3), random.random(), np.random.rand()
+    manager.close()
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    momentum = {k: v.clone() for k, v in optimizer.state_dict()['state'][0].items()}
+
+    torch.manual_seed(1)
+    other_model = torch.nn.Linear(4, 2)
+    other_optimizer = torch.optim.SGD(other_model.parameters(), lr=.1, momentum=.9)
+    random.seed(1)
+    np.random.seed(1)
+    resumed = CheckpointManager(str(tmp_path), keep_last=1)
+    assert resumed.resume(other_model, other_optimizer) == (3, metrics)
+    for key, value in other_model.state_dict().items():
+        assert torch.equal(value, state_dict[key]), key
+    for key, value in other_optimizer.state_dict()['state'][0].items():
+        assert torch.equal(value, momentum[key]), key
+    draws = torch.rand(3), random.random(), np.random.rand()
+    assert torch.equal(draws[0], expected_draws[0]) and draws[1:] == expected_draws[1:]
+
+    # the checkpoints up to the resumed epoch belong to the run
+    resumed.save(3, other_model, other_optimizer, metrics)
+    resumed.close()
+    assert epochs_on_disk(resumed) == [3]
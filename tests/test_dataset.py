@@ -0,0 +1,108 @@
+"""
+MasksDataset: the packed and lazy views against the in-memory one, refresh() against a fresh load, and the tensor
+TRAIN augmentations (augmentations.py).
+"""
+import gc
+import math
+import os
+import random
+import warnings
+import pytest
+import torch
+from PIL import Image
+import augmentations
+from augmentations import augment, photometric_distort_batch
+from dataset import MasksDataset
+from utils import photometric_distort, sample_photometric_distortions
+from tests.synthetic import write_images
+
+
+def assert_same_items(dataset, expected):
+    assert dataset.images == expected.images
+    for i in range(len(expected)):
+        image, target = dataset[i]
+        expected_image, expected_target = expected[i]
+        assert torch.equal(image, expected_image), dataset.images[i]
+        for key, value in expected_target.items():
+            assert torch.equal(target[key], value), (dataset.images[i], key)
+
+
+@pytest.mark.parametrize('mode', ['packed', 'lazy'])
+def test_test_split_matches_in_memory(image_folder, mode):
+    dataset = MasksDataset(data_folder=image_folder, split='test', **{mode: True})
+    assert_same_items(dataset, MasksDataset(data_folder=image_folder, split='test'))
+
+
+@pytest.mark.parametrize('mode', ['in_memory', 'packed', 'lazy'])
+def test_refresh_matches_fresh_load(image_folder, mode):
+    options = {} if mode == 'in_memory' else {mode: True}
+    dataset = MasksDataset(data_folder=image_folder, split='test', **options)
+
+    filenames = sorted(os.listdir(image_folder))
+    os.remove(os.path.join(image_folder, filenames[0]))
+    changed = os.path.join(image_folder, filenames[3])
+    Image.open(changed).transpose(Image.FLIP_LEFT_RIGHT).save(changed, quality=70)
+    mtime = os.path.getmtime(changed) + 10  # a change even on filesystems with a coarse mtime
+    os.utime(changed, (mtime, mtime))
+    write_images(image_folder, range(100, 103), seed=1)
+
+    assert dataset.refresh() == (4, 2)  # loaded the 3 new and the changed image, dropped the deleted and changed one
+    assert_same_items(dataset, MasksDataset(data_folder=image_folder, split='test'))
+
+
+def test_batch_photometric_matches_per_image():
+    random.seed(0)
+    torch.manual_seed(0)
+    images = torch.rand(32, 3, 16, 16)
+    distortions = [sample_photometric_distortions() for _ in images]
+    expected = torch.stack([photometric_distort(image, d) for image, d in zip(images, distortions)])
+    assert torch.allclose(photometric_distort_batch(images, distortions), expected, atol=1e-5)
+
+
+def test_augment_boxes_stay_on_their_pixels(monkeypatch):
+    # without photometric distortions, the pixels of the (white) box stay white and the others stay dark or filler
+    monkeypatch.setattr(augmentations, 'sample_photometric_distortions', lambda: [])
+    random.seed(0)
+    torch.manual_seed(0)
+    filler = [133, 125, 121]
+    checked = 0
+    for _ in range(200):
+        height, width = random.randint(300, 600), random.randint(300, 600)
+        w, h = random.randint(width // 4, width // 2), random.randint(height // 4, height // 2)
+        x, y = random.randint(0, width - w), random.randint(0, height - h)
+        image = torch.zeros((3, height, width), dtype=torch.uint8)
+        image[:, y:y + h, x:x + w] = 255
+
+        new_image, box, label, _ = augment(image, torch.FloatTensor([[x, y, x + w, y + h]]), torch.LongTensor([1]),
+                                           filler)
+        assert new_image.shape == (3, 224, 224) and new_image.dtype == torch.uint8
+        assert box.shape == (1, 4) and label.tolist() == [1]
+        x_min, y_min, x_max, y_max = box[0].clamp(0., 224.).tolist()  # clamped like in MasksDataset.__getitem__
+        assert x_min < x_max and y_min < y_max
+
+        # away from the edges, blurred by the resize. A flipped box is one pixel (of the crop, at most 2.5 pixels of
+        # the output here) to the left of its pixels, flip_boxes() keeps the width - x - 1 of the original flip()
+        margin_x, margin_y = 5, 2
+        inside = new_image[:, math.ceil(y_min) + margin_y:math.floor(y_max) - margin_y,
+                           math.ceil(x_min) + margin_x:math.floor(x_max) - margin_x]
+        if inside.numel():
+            assert inside.min() >= 200
+            checked += 1
+        outside = new_image.clone()
+        outside[:, max(0, math.floor(y_min) - margin_y):math.ceil(y_max) + margin_y,
+                max(0, math.floor(x_min) - margin_x):math.ceil(x_max) + margin_x] = 0
+        assert outside.max() <= max(filler) + 2
+    assert checked > 150
+
+
+@pytest.mark.parametrize('mode', ['in_memory', 'packed', 'lazy'])
+def test_image_files_are_closed(image_folder, mode):
+    options = {} if mode == 'in_memory' else {mode: True}
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', ResourceWarning)
+        dataset = MasksDataset(data_folder=image_folder, split='test', **options)
+        for i in range(len(dataset)):
+            dataset[i]
+        del dataset
+        gc.collect()
+    assert not [warning for warning in caught if issubclass(warning.category, ResourceWarning)]
@@ -0,0 +1,23 @@
+"""
+Reduced (DCT-domain) JPEG decoding of dataset.decode_image() against the full decode.
+"""
+import os
+import numpy as np
+from benchmark import decode_fidelity
+from dataset import decode_image
+from manifest import parse_filename
+from tests.synthetic import write_images
+
+
+def test_reduced_decode_fidelity(tmp_path):
+    folder = str(tmp_path)
+    psnrs = []
+    for filename in write_images(folder, range(10), min_size=500, max_size=1200):
+        path = os.path.join(folder, filename)
+        full, reduced = decode_image(path), decode_image(path, draft_size=(224, 224))
+        assert reduced.width < full.width and reduced.height < full.height
+        assert reduced.width >= 224 and reduced.height >= 224
+        psnr, _, box_difference = decode_fidelity(full, reduced, parse_filename(filename)[1])
+        assert box_difference <= .5, filename
+        psnrs.append(psnr)
+    assert np.median(psnrs) >= 27. and min(psnrs) >= 22., psnrs
@@ -0,0 +1,51 @@
+"""
+Parity of the exported TorchScript artifacts (export.py, quantize.py) with the eager models they were exported from, on
+a small randomly initialized model.
+"""
+import pytest
+import torch
+from dataset import MasksDataset
+from export import export_torchscript, load_artifact, read_artifact_metadata, check_parity
+from model import get_fasterrcnn_resnet50_fpn
+from quantize import calibration_loader, quantize_model
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    return get_fasterrcnn_resnet50_fpn(backbone='resnet18').cpu().eval()
+
+
+@pytest.fixture
+def images(image_folder):
+    dataset = MasksDataset(data_folder=image_folder, split='test')
+    return [dataset[i][0] for i in range(len(dataset))]
+
+
+def assert_parity(eager_model, path, images):
+    artifact = load_artifact(path, torch.device('cpu'))
+    ok, box_difference, score_difference = check_parity(eager_model, artifact, images)
+    assert ok, (box_difference, score_difference)
+
+    # resized inside the artifact, boxes back in the input image coordinates
+    with torch.no_grad():
+        detections = artifact([torch.nn.functional.interpolate(images[0].unsqueeze(0), size=[448, 336],
+                                                               mode='bilinear', align_corners=False).squeeze(0)])
+    assert detections[0]['boxes'].shape[-1] == 4
+    if detections[0]['boxes'].numel():
+        assert float(detections[0]['boxes'][:, 2].max()) <= 336 + 1e-3
+        assert float(detections[0]['boxes'][:, 3].max()) <= 448 + 1e-3
+
+
+def test_torchscript_matches_eager(model, images, tmp_path):
+    path = str(tmp_path / 'model.torchscript.pt')
+    export_torchscript(model, path, metadata=dict(weights_sha256='0' * 64))
+    assert read_artifact_metadata(path)['weights_sha256'] == '0' * 64
+    assert_parity(model, path, images)
+
+
+def test_int8_artifact_matches_quantized_model(model, images, image_folder, tmp_path):
+    quantized = quantize_model(model, calibration_loader(image_folder, 8, batch_size=4))
+    path = str(tmp_path / 'model.int8.torchscript.pt')
+    export_torchscript(quantized, path, metadata=dict(quantization='int8'))
+    assert_parity(quantized, path, images)
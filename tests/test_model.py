@@ -0,0 +1,121 @@
+"""
+The backbones of model.BACKBONES: checkpoints record their backbone and load back into the same model, frozen stages,
+and activation checkpointing against the unwrapped model.
+"""
+import pytest
+import torch
+from torchvision.models import resnet, mobilenet
+from torchvision.ops.misc import FrozenBatchNorm2d
+import model as model_module
+from model import BACKBONES, CheckpointedSequential, get_fasterrcnn_resnet50_fpn
+from utils import save_checkpoint
+
+
+@pytest.mark.parametrize('backbone', ['resnet18', 'mobilenet_v3_small'])
+def test_checkpoint_round_trip(backbone, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    torch.manual_seed(0)
+    model = get_fasterrcnn_resnet50_fpn(backbone=backbone).cpu().eval()
+    save_checkpoint(0, model)
+    path = str(tmp_path / 'checkpoint_fasterrcnn_epoch=1.pth.tar')
+    assert torch.load(path, map_location='cpu')['backbone'] == backbone
+
+    loaded = get_fasterrcnn_resnet50_fpn(weights_path=path).cpu().eval()
+    assert loaded.backbone_name == backbone
+    images = [torch.rand(3, 224, 224) for _ in range(2)]
+    with torch.no_grad():
+        for expected, output in zip(model(images), loaded(images)):
+            for key, value in expected.items():
+                assert torch.equal(output[key], value), key
+
+    other = 'resnet18' if backbone != 'resnet18' else 'mobilenet_v3_small'
+    with pytest.raises(ValueError):
+        get_fasterrcnn_resnet50_fpn(weights_path=path, backbone=other)
+
+
+@pytest.fixture
+def pretrained_requests(monkeypatch):
+    """
+    The torchvision backbone constructors, randomly initialized (no download), recording the pretrained argument.
+    """
+    requests = []
+    for module, names in [(resnet, ['resnet18', 'resnet34', 'resnet50']),
+                          (mobilenet, ['mobilenet_v3_large', 'mobilenet_v3_small'])]:
+        for name in names:
+            def constructor(pretrained=False, original=getattr(module, name), **kwargs):
+                requests.append(pretrained)
+                return original(pretrained=False, **kwargs)
+            monkeypatch.setitem(module.__dict__, name, constructor)
+    return requests
+
+
+def training_step(model):
+    model.train()
+    images = [torch.rand(3, 224, 224) for _ in range(2)]
+    targets = [dict(boxes=torch.FloatTensor([[20, 30, 120, 150]]), labels=torch.LongTensor([1]))] * 2
+    losses = model(images, targets)
+    sum(losses.values()).backward()
+
+
+@pytest.mark.parametrize('backbone', sorted(BACKBONES))
+def test_trainable_layers(backbone, pretrained_requests):
+    torch.manual_seed(0)
+    model = get_fasterrcnn_resnet50_fpn(backbone=backbone, trainable_layers=0).cpu()
+    assert pretrained_requests == [True]
+    body = model.backbone.body
+    assert not any(parameter.requires_grad for parameter in body.parameters())
+    assert not any(isinstance(module, torch.nn.BatchNorm2d) for module in body.modules())
+    state_dict = {k: v.clone() for k, v in body.state_dict().items()}
+    training_step(model)
+    for key, value in body.state_dict().items():
+        assert torch.equal(value, state_dict[key]), key
+
+    partly = get_fasterrcnn_resnet50_fpn(backbone=backbone, trainable_layers=2).backbone.body
+    trainable = [parameter.requires_grad for parameter in partly.parameters()]
+    assert any(trainable) and not all(trainable)
+    norms = [type(module) for module in partly.modules() if isinstance(module, (torch.nn.BatchNorm2d,
+                                                                                 FrozenBatchNorm2d))]
+    assert torch.nn.BatchNorm2d in norms and FrozenBatchNorm2d in norms
+
+    assert get_fasterrcnn_resnet50_fpn(backbone=backbone).backbone_name == backbone
+    assert pretrained_requests == [True, True, False]  # from scratch without trainable_layers
+
+
+def test_frozen_checkpoints_load_both_ways(pretrained_requests, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / 'checkpoint_fasterrcnn_epoch=1.pth.tar')
+    for trainable_layers, loaded_trainable_layers in [(2, None), (None, 2)]:
+        torch.manual_seed(0)
+        model = get_fasterrcnn_resnet50_fpn(backbone='resnet18', trainable_layers=trainable_layers).cpu().eval()
+        save_checkpoint(0, model)
+        loaded = get_fasterrcnn_resnet50_fpn(weights_path=path, trainable_layers=loaded_trainable_layers).cpu().eval()
+        images = [torch.rand(3, 224, 224)]
+        with torch.no_grad():
+            assert torch.equal(model(images)[0]['scores'], loaded(images)[0]['scores'])
+    assert pretrained_requests == [True, False, False, False]  # the checkpoints have the weights
+
+
+@pytest.mark.parametrize('reentrant', [False, True])
+def test_activation_checkpointing_matches_unwrapped(reentrant, monkeypatch):
+    monkeypatch.setattr(model_module, 'REENTRANT_CHECKPOINT', reentrant)
+    models = []
+    for checkpoint_stages in (0, 4):
+        torch.manual_seed(0)
+        models.append(get_fasterrcnn_resnet50_fpn(backbone='resnet18', checkpoint_stages=checkpoint_stages).cpu())
+    assert isinstance(models[1].backbone.body.layer1, CheckpointedSequential)
+    for model in models:
+        torch.manual_seed(1)  # same proposals sampling
+        training_step(model)
+
+    # bit-identical gradients without reentrant checkpoints. The reentrant backward of a stage is a separate backward
+    # pass, the gradients of its parameters are then accumulated in another order (float rounding differences)
+    expected, checkpointed = [dict(model.named_parameters()) for model in models]
+    for name, parameter in expected.items():
+        if parameter.grad is not None:
+            if reentrant:
+                assert torch.allclose(checkpointed[name].grad, parameter.grad, rtol=1e-5, atol=1e-6), name
+            else:
+                assert torch.equal(checkpointed[name].grad, parameter.grad), name
+    expected_state = models[0].state_dict()
+    for key, value in models[1].state_dict().items():  # running stats updated once, num_batches_tracked included
+        assert torch.equal(value, expected_state[key]), key
@@ -0,0 +1,35 @@
+"""
+predict_sharded() (predict.py --processes N) against a single process.
+"""
+import torch
+import torch.utils.data
+from dataset import MasksDataset, collate_fn
+from eval import evaluate
+from model import get_fasterrcnn_resnet50_fpn
+from sharded_predict import predict_sharded
+from utils import save_checkpoint
+
+
+def test_sharded_csv_matches_single_process(image_folder, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    torch.manual_seed(0)
+    model = get_fasterrcnn_resnet50_fpn(backbone='resnet18').cpu().eval()
+    save_checkpoint(0, model)
+    weights_path = str(tmp_path / 'checkpoint_fasterrcnn_epoch=1.pth.tar')
+
+    threads = torch.get_num_threads()
+    torch.set_num_threads(1)  # like the workers
+    try:
+        dataset = MasksDataset(data_folder=image_folder, split='test', packed=True)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=3, shuffle=False, collate_fn=collate_fn)
+        accuracy, iou = evaluate(loader, get_fasterrcnn_resnet50_fpn(weights_path=weights_path),
+                                 save_csv=str(tmp_path / 'single.csv'), device=torch.device('cpu'))
+    finally:
+        torch.set_num_threads(threads)
+
+    sharded_accuracy, sharded_iou, stats = predict_sharded(image_folder, str(tmp_path / 'sharded.csv'), 2, threads=1,
+                                                           weights_path=weights_path, batch_size=3)
+    assert sum(s['images'] for s in stats) == 8 and stats[0]['images'] % 3 == 0  # whole batches
+    with open(tmp_path / 'single.csv') as single, open(tmp_path / 'sharded.csv') as sharded:
+        assert sharded.read() == single.read()
+    assert abs(sharded_accuracy - accuracy) < 1e-9 and abs(sharded_iou - iou) < 1e-9
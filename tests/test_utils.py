@@ -0,0 +1,50 @@
+"""
+The vectorized and fused augmentations of utils.py against the implementations they replace, kept in benchmark.py.
+"""
+import random
+import torch
+from benchmark import make_synthetic_samples, loop_random_crop, crop_statistics, compare_crop_distributions, \
+    make_smooth_samples, sample_expand_crop, unfused_expand_crop_resize, fused_expand_crop_resize, \
+    expand_crop_resize_differences
+from utils import random_crop
+
+
+def crop_outputs(crop_function, samples, repeats=10):
+    random.seed(0)
+    torch.manual_seed(0)
+    return crop_statistics(crop_function, samples, repeats)[1]
+
+
+def test_random_crop_distribution_matches_loop():
+    samples = make_synthetic_samples(100)
+    statistics, critical_value = compare_crop_distributions(
+        [crop_outputs(loop_random_crop, samples), crop_outputs(random_crop, samples)], alpha=0.01)
+    assert max(statistics) <= critical_value, statistics
+
+
+def test_random_crop_distribution_check_detects_a_difference():
+    def crop_more_often(image, boxes, labels):  # up to 10 draws until the image is cropped
+        for _ in range(10):
+            new_image, new_boxes, new_labels = random_crop(image, boxes, labels)
+            if new_image.shape != image.shape:
+                break
+        return new_image, new_boxes, new_labels
+
+    samples = make_synthetic_samples(100)
+    statistics, critical_value = compare_crop_distributions(
+        [crop_outputs(random_crop, samples), crop_outputs(crop_more_often, samples)], alpha=0.01)
+    assert max(statistics) > critical_value, statistics
+
+
+def test_expand_crop_resize_matches_unfused():
+    random.seed(0)
+    filler = [133, 125, 121]
+    samples = make_smooth_samples(30)
+    params = sample_expand_crop(samples)
+    outputs = [[function(image, filler, expand_params, region)[0]
+                for (image, _, _), (expand_params, region) in zip(samples, params)]
+               for function in (unfused_expand_crop_resize, fused_expand_crop_resize)]
+    for unfused, fused in zip(*outputs):
+        assert fused.shape == unfused.shape and fused.dtype == unfused.dtype
+    differences = expand_crop_resize_differences(*outputs)
+    assert differences.mean() <= 1. and differences.max() <= 2., differences
@@ -1,14 +1,21 @@
+import argparse
 import time
 import torch.optim
 import torch.utils.data
 import torch.backends.cudnn as cudnn
-from dataset import MasksDataset
-from utils import AverageMeter, save_checkpoint
+from dataset import MasksDataset, ImageStore
+from utils import AverageMeter
 import constants
 import pickle
 from eval import evaluate
-from model import get_fasterrcnn_resnet50_fpn
+from model import get_fasterrcnn_resnet50_fpn, BACKBONES
 from dataset import collate_fn
+from augmentations import batch_photometric_collate_fn
+from precision import PRECISIONS, autocast, check_precision, grad_scaler, to_channels_last
+from checkpoints import CheckpointManager
+from telemetry import Telemetry, parse_step_range
+from manifest import stratified_sample
+from background_eval import BackgroundEvaluator
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -17,63 +24,162 @@ batch_size = 42  # batch size (We trained with 42)
 workers = 4  # number of workers for loading data in the DataLoader
 print_freq = 10  # print training status every __ batches
 lr = 1e-3  # learning rate
+photometric_in_batch = False  # apply the photometric distortions on whole batches in the DataLoader workers
 
 cudnn.benchmark = True
 
 
-def main():
+def main(backbone='resnet50', trainable_layers=None, precision='fp32', channels_last=False, micro_batch_size=None,
+         checkpoint_stages=0, keep_checkpoints=3, resume=None, telemetry_path=None, profiler_steps=None,
+         profiler_dir='profiler', eval_every=1, train_eval_images=None, background_eval=False, eval_threads=None):
     """
     Training.
+
+    :param backbone: backbone of the model, a model.BACKBONES name
+    :param trainable_layers: number of trainable backbone stages, by default all. The backbone then starts from its
+    ImageNet weights, see model.get_fasterrcnn_resnet50_fpn()
+    :param precision: 'fp32', or autocast to 'bf16' (CPU or CUDA, torch>=1.10) or 'fp16' (CUDA), see precision.py
+    :param channels_last: run the backbone in channels_last memory format
+    :param micro_batch_size: forward and backward every batch in micro-batches of this size (gradient accumulation,
+    the optimization stays the one of batch_size), by default the whole batch at once
+    :param checkpoint_stages: number of ResNet stages recomputed in the backward pass instead of keeping their
+    activations, see model.resnet_fpn_backbone()
+    :param keep_checkpoints: number of epoch checkpoints to keep (at least 1), besides the best one (see checkpoints.py)
+    :param resume: checkpoint to continue training from, 'latest' for the one of the last epoch
+    :param telemetry_path: .jsonl or .csv file of per-step timings, losses, throughput and RSS (see telemetry.py)
+    :param profiler_steps: (start, stop) global steps of a torch.profiler capture, written to profiler_dir
+    :param eval_every: evaluate the train and test sets every eval_every epochs (metrics['eval_epochs'] are the
+    evaluated epochs), the last model is always fully evaluated at the end (metrics['final'])
+    :param train_eval_images: evaluate the train set on a fixed sample of this many images (stratified by
+    proper_mask, see manifest.stratified_sample()) instead of all of them
+    :param background_eval: evaluate the saved checkpoints in a background process while training goes on, the
+    results are merged into the metrics as they come (see background_eval.py)
+    :param eval_threads: intra-op threads of the background evaluator, see BackgroundEvaluator
     """
     global device
+    check_precision(precision, device)
 
     # Initialize model
-    model = get_fasterrcnn_resnet50_fpn()
+    model = get_fasterrcnn_resnet50_fpn(backbone=backbone, trainable_layers=trainable_layers,
+                                        checkpoint_stages=checkpoint_stages)
+    if channels_last:
+        to_channels_last(model)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    scaler = grad_scaler(precision, device)
 
     # Custom dataloaders
-    train_dataset = MasksDataset(data_folder=constants.TRAIN_IMG_PATH, split='train')
+    # the train images are decoded once, for both the train and the unshuffled train datasets
+    train_store = ImageStore(data_folder=constants.TRAIN_IMG_PATH)
+    train_dataset = MasksDataset(data_folder=constants.TRAIN_IMG_PATH, split='train',
+                                 photometric_in_batch=photometric_in_batch, store=train_store)
     train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True,
-                                               num_workers=workers, pin_memory=True, collate_fn=collate_fn)
-    test_dataset = MasksDataset(data_folder=constants.TEST_IMG_PATH, split='test')
+                                               num_workers=workers, pin_memory=True,
+                                               collate_fn=batch_photometric_collate_fn if photometric_in_batch
+                                               else collate_fn)
+    test_dataset = MasksDataset(data_folder=constants.TEST_IMG_PATH, split='test', packed=True)
     test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False,
                                               num_workers=workers, pin_memory=True, collate_fn=collate_fn)
 
     # set split = test to avoid augmentations
-    unshuffled_train_dataset = MasksDataset(data_folder=constants.TRAIN_IMG_PATH, split='test')
+    # (the periodic train evaluations can run on a fixed stratified sample of the images only)
+    train_eval_filenames = None
+    if train_eval_images is not None:
+        train_eval_filenames = stratified_sample(train_store.manifest, train_eval_images)
+    unshuffled_train_dataset = MasksDataset(data_folder=constants.TRAIN_IMG_PATH, split='test', packed=True,
+                                            store=train_store, filenames=train_eval_filenames)
     unshuffled_train_loader = torch.utils.data.DataLoader(unshuffled_train_dataset, batch_size=batch_size,
                                                           shuffle=False, num_workers=workers, pin_memory=True,
                                                           collate_fn=collate_fn)
 
     epochs = 100
     metrics = dict(train_loss=[], train_iou=[], train_accuracy=[],
-                   test_iou=[], test_accuracy=[])
+                   test_iou=[], test_accuracy=[], eval_epochs=[])
+
+    telemetry = Telemetry(telemetry_path, profiler_steps, profiler_dir, device)
+
+    # Continue a previous run: model, optimizer, loss scaler and RNG states, and metrics
+    checkpoints = CheckpointManager(keep_last=keep_checkpoints)
+    start_epoch = 0
+    if resume:
+        start_epoch, resumed_metrics = checkpoints.resume(model, optimizer, scaler, path=resume)
+        metrics = resumed_metrics or metrics
+        metrics.setdefault('eval_epochs', list(range(len(metrics['test_iou']))))  # every epoch, before eval_every
+
+    evaluator = None
+    if background_eval:
+        evaluator = BackgroundEvaluator(constants.TRAIN_IMG_PATH, constants.TEST_IMG_PATH, train_eval_filenames,
+                                        batch_size=batch_size, threads=eval_threads, precision=precision)
+
+    def add_evaluation(epoch, results):
+        for key, value in results.items():
+            metrics[key].append(value)
+        metrics['eval_epochs'].append(epoch)
+        return metrics['test_iou'][-1] >= max(metrics['test_iou'])
+
+    def merge_evaluations(evaluations):
+        # results of the background evaluator, their checkpoints were kept until now
+        for evaluated_epoch, results in evaluations:
+            print(f'Epoch {evaluated_epoch} evaluation: '
+                  f'Train IoU = {round(results["train_iou"], 4)}, Accuracy = {round(results["train_accuracy"], 4)}, '
+                  f'Test IoU = {round(results["test_iou"], 4)}, Accuracy = {round(results["test_accuracy"], 4)}')
+            if add_evaluation(evaluated_epoch, results):
+                checkpoints.mark_best(evaluated_epoch)
+            checkpoints.release(evaluated_epoch)
+
+    # Resumed run: the background evaluations still pending when the checkpoint was saved are missing from its
+    # metrics, their checkpoints were kept (see checkpoints.py), evaluate them again
+    for pending_epoch, path in sorted(checkpoints.epoch_paths().items()):
+        if pending_epoch >= start_epoch or (pending_epoch + 1) % eval_every or pending_epoch in metrics['eval_epochs']:
+            continue
+        checkpoints.protect(pending_epoch)
+        if evaluator is not None:
+            evaluator.submit(pending_epoch, path)
+            continue
+        pending_model = get_fasterrcnn_resnet50_fpn(weights_path=path)
+        train_mean_accuracy, train_mean_iou = evaluate(unshuffled_train_loader, pending_model, precision=precision)
+        test_mean_accuracy, test_mean_iou = evaluate(test_loader, pending_model, precision=precision)
+        del pending_model
+        results = dict(train_iou=float(train_mean_iou), train_accuracy=float(train_mean_accuracy),
+                       test_iou=float(test_mean_iou), test_accuracy=float(test_mean_accuracy))
+        merge_evaluations([(pending_epoch, results)])
+
     # Epochs
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
         # One epoch's training
         train_loss = train(train_loader=train_loader,
                            model=model,
                            optimizer=optimizer,
-                           epoch=epoch)
-
-        # Save checkpoint
-        save_checkpoint(epoch, model)
-
-        # Evaluate train set
-        train_mean_accuracy, train_mean_iou = evaluate(unshuffled_train_loader, model)
-        print(f'Train IoU = {round(float(train_mean_iou), 4)}, Accuracy = {round(float(train_mean_accuracy), 4)}')
-
-        # Evaluate test set
-        test_mean_accuracy, test_mean_iou = evaluate(test_loader, model)
-        print(f'Test IoU = {round(float(test_mean_iou), 4)}, Accuracy = {round(float(test_mean_accuracy), 4)}')
+                           epoch=epoch,
+                           precision=precision,
+                           scaler=scaler,
+                           micro_batch_size=micro_batch_size,
+                           telemetry=telemetry)
 
-        # Populate dict
         metrics['train_loss'].append(train_loss)
-        metrics['train_iou'].append(train_mean_iou)
-        metrics['train_accuracy'].append(train_mean_accuracy)
-        metrics['test_iou'].append(test_mean_iou)
-        metrics['test_accuracy'].append(test_mean_accuracy)
+        scheduled = (epoch + 1) % eval_every == 0
+
+        is_best = False
+        if scheduled and evaluator is None:
+            # Evaluate train set
+            train_mean_accuracy, train_mean_iou = evaluate(unshuffled_train_loader, model, precision=precision)
+            print(f'Train IoU = {round(float(train_mean_iou), 4)}, Accuracy = {round(float(train_mean_accuracy), 4)}')
+
+            # Evaluate test set
+            test_mean_accuracy, test_mean_iou = evaluate(test_loader, model, precision=precision)
+            print(f'Test IoU = {round(float(test_mean_iou), 4)}, Accuracy = {round(float(test_mean_accuracy), 4)}')
+
+            # Populate dict
+            is_best = add_evaluation(epoch, dict(train_iou=train_mean_iou, train_accuracy=train_mean_accuracy,
+                                                 test_iou=test_mean_iou, test_accuracy=test_mean_accuracy))
+
+        # Save checkpoint, with the metrics so far (snapshot only, written while the next epoch trains). A scheduled
+        # checkpoint is then evaluated by the background evaluator, if any
+        on_written = evaluator.submit if scheduled and evaluator is not None else None
+        stall = checkpoints.save(epoch, model, optimizer, metrics, scaler, is_best=is_best, on_written=on_written)
+        print(f'Checkpoint snapshot {stall:.3f} s')
+        if evaluator is not None:
+            merge_evaluations(evaluator.poll())
 
         # Save all the losses to pickled list
         with open('metrics.pkl', 'wb') as f:
@@ -81,8 +187,35 @@ def main():
 
         torch.cuda.empty_cache()
 
-
-def train(train_loader, model, optimizer, epoch):
+    if evaluator is not None:
+        checkpoints.wait()  # the last checkpoint is submitted once written
+        merge_evaluations(evaluator.close())
+    checkpoints.close()  # wait for the last checkpoint to be written
+    telemetry.close()
+
+    # Final full evaluation of the last model, unless its last periodic evaluation was one
+    last_epoch = epochs - 1
+    fully_evaluated = evaluator is None and train_eval_filenames is None and (last_epoch + 1) % eval_every == 0
+    if start_epoch < epochs and not fully_evaluated:
+        if train_eval_filenames is not None:
+            unshuffled_train_dataset = MasksDataset(data_folder=constants.TRAIN_IMG_PATH, split='test', packed=True,
+                                                    store=train_store)
+            unshuffled_train_loader = torch.utils.data.DataLoader(unshuffled_train_dataset, batch_size=batch_size,
+                                                                  shuffle=False, num_workers=workers,
+                                                                  pin_memory=True, collate_fn=collate_fn)
+        train_mean_accuracy, train_mean_iou = evaluate(unshuffled_train_loader, model, precision=precision)
+        test_mean_accuracy, test_mean_iou = evaluate(test_loader, model, precision=precision)
+        metrics['final'] = dict(epoch=last_epoch, train_iou=train_mean_iou, train_accuracy=train_mean_accuracy,
+                                test_iou=test_mean_iou, test_accuracy=test_mean_accuracy)
+        print(f'Final train IoU = {round(float(train_mean_iou), 4)}, Accuracy = {round(float(train_mean_accuracy), 4)}')
+        print(f'Final test IoU = {round(float(test_mean_iou), 4)}, Accuracy = {round(float(test_mean_accuracy), 4)}')
+
+    with open('metrics.pkl', 'wb') as f:
+        pickle.dump(metrics, f)
+
+
+def train(train_loader, model, optimizer, epoch, precision='fp32', scaler=None, micro_batch_size=None,
+          telemetry=None):
     """
     One epoch's training.
 
@@ -90,7 +223,15 @@ def train(train_loader, model, optimizer, epoch):
     :param model: model
     :param optimizer: optimizer
     :param epoch: epoch number
+    :param precision: autocast precision of the forward prop. and losses, see precision.py
+    :param scaler: GradScaler of the loss (see precision.grad_scaler()), by default the one of precision
+    :param micro_batch_size: accumulate the gradients of micro-batches of this size, by default the whole batch
+    :param telemetry: Telemetry recording the timings of the stages of every step, by default none
     """
+    if scaler is None:
+        scaler = grad_scaler(precision, device)
+    if telemetry is None:
+        telemetry = Telemetry()
     model.train()  # training mode enables dropout
 
     batch_time = AverageMeter()  # forward prop. + back prop. time
@@ -102,23 +243,38 @@ def train(train_loader, model, optimizer, epoch):
     # Batches
     for i, (images, targets) in enumerate(train_loader):
         data_time.update(time.time() - start)
-        # Move to default device
-        images = [image.to(device) for image in images]
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-        # Forward prop
-        loss_dict = model(images, targets)
-
-        # Loss
-        losses = sum(loss for loss in loss_dict.values())
-        loss_value = losses.item()
-
-        # Backward prop.
+        telemetry.start_step(epoch, i, len(images), data_time.val)
         optimizer.zero_grad()
-        losses.backward()
 
-        # Clipping
-        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1, norm_type=2)
+        # Forward and backward prop. of every micro-batch, the gradients accumulate. Every micro-batch loss is weighted
+        # by its share of the batch, so the gradients are the ones of the (mean) loss of the whole batch. Note that the
+        # batch norms of the backbone see the statistics of the micro-batches
+        micro_size = micro_batch_size or len(images)
+        loss_value = 0.
+        for k in range(0, len(images), micro_size):
+            # Move to default device
+            with telemetry.stage('h2d'):
+                micro_images = [image.to(device) for image in images[k:k + micro_size]]
+                micro_targets = [{key: v.to(device) for key, v in t.items()} for t in targets[k:k + micro_size]]
+
+            # Forward prop
+            with telemetry.stage('forward'), autocast(precision, device):
+                loss_dict = model(micro_images, micro_targets)
+
+                # Loss
+                losses = sum(loss for loss in loss_dict.values()) * (len(micro_images) / len(images))
+            telemetry.add_losses(loss_dict, weight=len(micro_images) / len(images))
+            loss_value += losses.item()
+
+            # Backward prop. (of the scaled loss with fp16, see precision.py)
+            with telemetry.stage('backward'):
+                scaler.scale(losses).backward()
+            del loss_dict, losses, micro_images, micro_targets  # free the graph before the next micro-batch
+
+        # Clipping (of the unscaled gradients)
+        with telemetry.stage('clip'):
+            scaler.unscale_(optimizer)
+            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1, norm_type=2)
 
         # Print gradients norms to know what max_norm to give
         # max_norm = 0
@@ -129,8 +285,11 @@ def train(train_loader, model, optimizer, epoch):
         #         max_norm = norm
         # print(f'MAX NORM = {max_norm}')
 
-        # Update model
-        optimizer.step()
+        # Update model (skipped by the scaler when the fp16 gradients overflowed)
+        with telemetry.stage('optimizer_step'):
+            scaler.step(optimizer)
+            scaler.update()
+        telemetry.end_step(grad_norm)
 
         losses_meter.update(loss_value, len(images))
         batch_time.update(time.time() - start)
@@ -144,10 +303,46 @@ def train(train_loader, model, optimizer, epoch):
                   'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(epoch, i, len(train_loader),
                                                                   batch_time=batch_time,
                                                                   data_time=data_time, loss=losses_meter))
-        del loss_dict, losses, images, targets  # free some memory since their histories may be stored
+        del images, targets
     torch.cuda.empty_cache()
     return losses_meter.avg
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Train the face mask detector')
+    parser.add_argument('--backbone', type=str, default='resnet50', choices=list(BACKBONES))
+    parser.add_argument('--trainable-layers', type=int, default=None,
+                        help='number of trainable backbone stages counted from the last one, the backbone then '
+                             'starts from its ImageNet weights (default: all, from scratch)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='autocast precision of the forward passes, see precision.py')
+    parser.add_argument('--channels-last', action='store_true', help='run the backbone in channels_last memory format')
+    parser.add_argument('--micro-batch-size', type=int, default=None,
+                        help=f'accumulate the gradients of micro-batches of this size over every batch of {batch_size}')
+    parser.add_argument('--checkpoint-stages', type=int, default=0, choices=range(5),
+                        help='number of ResNet stages (from layer1) recomputing their activations in the backward pass')
+    parser.add_argument('--keep-checkpoints', type=int, default=3,
+                        help='number of epoch checkpoints to keep (at least 1), besides the best one')
+    parser.add_argument('--resume', type=str, nargs='?', const='latest', default=None,
+                        help='continue training from a checkpoint, by default the one of the last epoch')
+    parser.add_argument('--telemetry', type=str, default=None,
+                        help='.jsonl or .csv file of per-step stage timings, losses, throughput and RSS')
+    parser.add_argument('--profiler-steps', type=parse_step_range, default=None,
+                        help='start:stop global steps of a torch.profiler capture (stop excluded)')
+    parser.add_argument('--profiler-dir', type=str, default='profiler',
+                        help='directory of the profiler trace and table')
+    parser.add_argument('--eval-every', type=int, default=1,
+                        help='evaluate the train and test sets every N epochs (the last model is always evaluated)')
+    parser.add_argument('--train-eval-images', type=int, default=None,
+                        help='evaluate the train set on a fixed stratified sample of N images (default: all)')
+    parser.add_argument('--background-eval', action='store_true',
+                        help='evaluate the saved checkpoints in a background process while training goes on')
+    parser.add_argument('--eval-threads', type=int, default=None,
+                        help='intra-op threads of the background evaluator (default: a quarter of the cores)')
+    args = parser.parse_args()
+    main(backbone=args.backbone, trainable_layers=args.trainable_layers, precision=args.precision,
+         channels_last=args.channels_last, micro_batch_size=args.micro_batch_size,
+         checkpoint_stages=args.checkpoint_stages, keep_checkpoints=args.keep_checkpoints, resume=args.resume,
+         telemetry_path=args.telemetry, profiler_steps=args.profiler_steps, profiler_dir=args.profiler_dir,
+         eval_every=args.eval_every, train_eval_images=args.train_eval_images, background_eval=args.background_eval,
+         eval_threads=args.eval_threads)
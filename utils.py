@@ -63,33 +63,52 @@ def find_intersection(set_1, set_2):
     return intersection_dims[:, :, 0] * intersection_dims[:, :, 1]  # (n1, n2)
 
 
-def photometric_distort(image):
-    """
-    Distort brightness, contrast, saturation, and hue, each with a 50% chance, in random order.
+PHOTOMETRIC_DISTORTIONS = {'adjust_brightness': FT.adjust_brightness,
+                           'adjust_contrast': FT.adjust_contrast,
+                           'adjust_saturation': FT.adjust_saturation,
+                           'adjust_hue': FT.adjust_hue}
 
-    :param image: image, a PIL Image
-    :return: distorted image
+
+def sample_photometric_distortions():
     """
-    new_image = image
+    Draw which distortions photometric_distort() applies, in which order and with which factors.
 
-    distortions = [FT.adjust_brightness,
-                   FT.adjust_contrast,
-                   FT.adjust_saturation,
-                   FT.adjust_hue]
+    :return: list of (distortion name, adjust factor)
+    """
+    distortions = list(PHOTOMETRIC_DISTORTIONS)
 
     random.shuffle(distortions)
 
+    sampled = []
     for d in distortions:
         if random.random() < 0.5:
-            if d.__name__ is 'adjust_hue':
+            if d == 'adjust_hue':
                 # Caffe repo uses a 'hue_delta' of 18 - we divide by 255 because PyTorch needs a normalized value
                 adjust_factor = random.uniform(-18 / 255., 18 / 255.)
             else:
                 # Caffe repo uses 'lower' and 'upper' values of 0.5 and 1.5 for brightness, contrast, and saturation
                 adjust_factor = random.uniform(0.5, 1.5)
+            sampled.append((d, adjust_factor))
+
+    return sampled
+
+
+def photometric_distort(image, distortions=None):
+    """
+    Distort brightness, contrast, saturation, and hue, each with a 50% chance, in random order.
 
-            # Apply this distortion
-            new_image = d(new_image, adjust_factor)
+    :param image: image, a PIL Image or a tensor of dimensions (3, h, w)
+    :param distortions: distortions to apply (see sample_photometric_distortions()), sampled if None
+    :return: distorted image
+    """
+    new_image = image
+
+    if distortions is None:
+        distortions = sample_photometric_distortions()
+
+    for d, adjust_factor in distortions:
+        # Apply this distortion
+        new_image = PHOTOMETRIC_DISTORTIONS[d](new_image, adjust_factor)
 
     return new_image
 
@@ -102,27 +121,22 @@ def expand(image, boxes, filler):
 
     :param image: image, a tensor of dimensions (3, original_h, original_w)
     :param boxes: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
-    :param filler: RBG values of the filler material, a list like [R, G, B]
+    :param filler: RBG values of the filler material, a list like [R, G, B], in the value range of image's dtype
     :return: expanded image, updated bounding box coordinates
     """
-    # Calculate dimensions of proposed expanded (zoomed-out) image
+    # Calculate dimensions of proposed expanded (zoomed-out) image, and where to place the original image in it
     original_h = image.size(1)
     original_w = image.size(2)
-    max_scale = 4
-    scale = random.uniform(1, max_scale)
-    new_h = int(scale * original_h)
-    new_w = int(scale * original_w)
+    new_h, new_w, left, top = sample_expand(original_h, original_w)
 
     # Create such an image with the filler
-    filler = torch.FloatTensor(filler)  # (3)
-    new_image = torch.ones((3, new_h, new_w), dtype=torch.float) * filler.unsqueeze(1).unsqueeze(1)  # (3, new_h, new_w)
+    filler = torch.tensor(filler, dtype=image.dtype)  # (3)
+    new_image = torch.ones((3, new_h, new_w), dtype=image.dtype) * filler.unsqueeze(1).unsqueeze(1)  # (3, new_h, new_w)
     # Note - do not use expand() like new_image = filler.unsqueeze(1).unsqueeze(1).expand(3, new_h, new_w)
     # because all expanded values will share the same memory, so changing one pixel will change all
 
-    # Place the original image at random coordinates in this new image (origin at top-left of image)
-    left = random.randint(0, new_w - original_w)
+    # Place the original image at the sampled coordinates in this new image (origin at top-left of image)
     right = left + original_w
-    top = random.randint(0, new_h - original_h)
     bottom = top + original_h
     new_image[:, top:bottom, left:right] = image
 
@@ -133,6 +147,26 @@ def expand(image, boxes, filler):
     return new_image, new_boxes
 
 
+def sample_expand(original_h, original_w, max_scale=4):
+    """
+    Draw the parameters of expand().
+
+    :param original_h: image height
+    :param original_w: image width
+    :param max_scale: maximum zoom out
+    :return: expanded image height and width, and left, top coordinates of the original image in it
+    """
+    scale = random.uniform(1, max_scale)
+    new_h = int(scale * original_h)
+    new_w = int(scale * original_w)
+
+    # Random coordinates of the original image in the new image (origin at top-left of image)
+    left = random.randint(0, new_w - original_w)
+    top = random.randint(0, new_h - original_h)
+
+    return new_h, new_w, left, top
+
+
 def random_crop(image, boxes, labels):
     """
     Performs a random crop in the manner stated in the paper. Helps to learn to detect larger and partial objects.
@@ -148,6 +182,31 @@ def random_crop(image, boxes, labels):
     """
     original_h = image.size(1)
     original_w = image.size(2)
+    crop, centers_in_crop = sample_random_crop(original_h, original_w, boxes)
+
+    # If not cropping
+    if crop is None:
+        return image, boxes, labels
+
+    # Crop image
+    left, top, right, bottom = [int(c) for c in crop.tolist()]
+    new_image = image[:, top:bottom, left:right]  # (3, new_h, new_w)
+
+    new_boxes, new_labels = crop_boxes(boxes, labels, crop, centers_in_crop)
+
+    return new_image, new_boxes, new_labels
+
+
+def sample_random_crop(original_h, original_w, boxes):
+    """
+    Draw the crop of random_crop().
+
+    :param original_h: image height
+    :param original_w: image width
+    :param boxes: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
+    :return: crop [left, top, right, bottom] and a mask of the bounding boxes whose centers are in it (see
+    sample_crop()), or None, None for no cropping
+    """
     # Keep choosing a minimum overlap until a successful crop is made
     while True:
         # Randomly draw the value for minimum overlap
@@ -155,73 +214,91 @@ def random_crop(image, boxes, labels):
 
         # If not cropping
         if min_overlap is None:
-            return image, boxes, labels
-
-        # Try up to 50 times for this choice of minimum overlap
-        # This isn't mentioned in the paper, of course, but 50 is chosen in paper authors' original Caffe repo
-        max_trials = 50
-        for _ in range(max_trials):
-            # Crop dimensions must be in [0.3, 1] of original dimensions
-            # Note - it's [0.1, 1] in the paper, but actually [0.3, 1] in the authors' repo
-            min_scale = 0.3
-            scale_h = random.uniform(min_scale, 1)
-            scale_w = random.uniform(min_scale, 1)
-            new_h = int(scale_h * original_h)
-            new_w = int(scale_w * original_w)
-
-            # Aspect ratio has to be in [0.5, 2]
-            aspect_ratio = new_h / new_w
-            if not 0.5 < aspect_ratio < 2:
-                continue
-
-            # Crop coordinates (origin at top-left of image)
-            left = random.randint(0, original_w - new_w)
-            right = left + new_w
-            top = random.randint(0, original_h - new_h)
-            bottom = top + new_h
-            crop = torch.FloatTensor([left, top, right, bottom])  # (4)
-
-            # Calculate Jaccard overlap between the crop and the bounding boxes
-            overlap = find_jaccard_overlap(crop.unsqueeze(0),
-                                           boxes)  # (1, n_objects), n_objects is the no. of objects in this image
-            overlap = overlap.squeeze(0)  # (n_objects)
-
-            # If not a single bounding box has a Jaccard overlap of greater than the minimum, try again
-            if overlap.max().item() < min_overlap:
-                continue
-
-            # Crop image
-            new_image = image[:, top:bottom, left:right]  # (3, new_h, new_w)
-
-            # Find centers of original bounding boxes
-            bb_centers = (boxes[:, :2] + boxes[:, 2:]) / 2.  # (n_objects, 2)
-
-            # Find bounding boxes whose centers are in the crop
-            centers_in_crop = (bb_centers[:, 0] > left) * (bb_centers[:, 0] < right) * (bb_centers[:, 1] > top) * (
-                    bb_centers[:, 1] < bottom)  # (n_objects), a Torch uInt8/Byte tensor, can be used as a boolean index
-
-            # If not a single bounding box has its center in the crop, try again
-            if not centers_in_crop.any():
-                continue
-
-            # Discard bounding boxes that don't meet this criterion
-            new_boxes = boxes[centers_in_crop, :]
-            new_labels = labels[centers_in_crop]
-
-            # Calculate bounding boxes' new coordinates in the crop
-            new_boxes[:, :2] = torch.max(new_boxes[:, :2], crop[:2])  # crop[:2] is [left, top]
-            new_boxes[:, :2] -= crop[:2]
-            new_boxes[:, 2:] = torch.min(new_boxes[:, 2:], crop[2:])  # crop[2:] is [right, bottom]
-            new_boxes[:, 2:] -= crop[:2]
-
-            return new_image, new_boxes, new_labels
+            return None, None
+
+        crop, centers_in_crop = sample_crop(original_h, original_w, boxes, min_overlap)
+        if crop is not None:
+            return crop, centers_in_crop
+
+
+def crop_boxes(boxes, labels, crop, centers_in_crop):
+    """
+    Update bounding boxes and labels to a crop.
+
+    :param boxes: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
+    :param labels: labels of objects, a tensor of dimensions (n_objects)
+    :param crop: crop [left, top, right, bottom], a tensor of dimensions (4)
+    :param centers_in_crop: mask of the bounding boxes whose centers are in the crop
+    :return: bounding boxes in the crop coordinates, labels
+    """
+    # Discard bounding boxes whose centers are not in the crop
+    new_boxes = boxes[centers_in_crop, :]
+    new_labels = labels[centers_in_crop]
+
+    # Calculate bounding boxes' new coordinates in the crop
+    new_boxes[:, :2] = torch.max(new_boxes[:, :2], crop[:2])  # crop[:2] is [left, top]
+    new_boxes[:, :2] -= crop[:2]
+    new_boxes[:, 2:] = torch.min(new_boxes[:, 2:], crop[2:])  # crop[2:] is [right, bottom]
+    new_boxes[:, 2:] -= crop[:2]
+
+    return new_boxes, new_labels
+
+
+def sample_crop(original_h, original_w, boxes, min_overlap, max_trials=50, min_scale=0.3):
+    """
+    Draw all the trials of random_crop() for one choice of minimum overlap at once, and return the first valid one.
+
+    A trial is valid if its aspect ratio is in (0.5, 2), some bounding box has a Jaccard overlap of at least
+    min_overlap with it and some bounding box has its center in it. Taking the first valid of the i.i.d. trials gives
+    the same distribution as trying them one by one.
+
+    :param original_h: image height
+    :param original_w: image width
+    :param boxes: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
+    :param min_overlap: minimum Jaccard overlap
+    :param max_trials: number of trials (50 in the authors' original Caffe repo)
+    :param min_scale: minimum crop dimensions scale (0.3 in the authors' repo, [0.1, 1] in the paper)
+    :return: crop [left, top, right, bottom] (a float tensor of dimensions (4)) and a mask of the bounding boxes
+    whose centers are in the crop, or None, None if all the trials failed
+    """
+    # Crop dimensions must be in [min_scale, 1] of original dimensions
+    scales = torch.empty((max_trials, 2), dtype=torch.float64).uniform_(min_scale, 1)  # (max_trials, 2)
+    new_h = (scales[:, 0] * original_h).long()
+    new_w = (scales[:, 1] * original_w).long()
+
+    # Aspect ratio has to be in [0.5, 2]
+    aspect_ratio = new_h.double() / new_w.double()
+    valid = (aspect_ratio > 0.5) * (aspect_ratio < 2)  # (max_trials)
+
+    # Crop coordinates (origin at top-left of image), uniform integers like random.randint(0, original - new)
+    left = (torch.rand(max_trials, dtype=torch.float64) * (original_w - new_w + 1)).long()
+    left = torch.min(left, original_w - new_w)
+    top = (torch.rand(max_trials, dtype=torch.float64) * (original_h - new_h + 1)).long()
+    top = torch.min(top, original_h - new_h)
+    crops = torch.stack([left, top, left + new_w, top + new_h], dim=1).float()  # (max_trials, 4)
+
+    # Calculate Jaccard overlap between the crops and the bounding boxes
+    overlap = find_jaccard_overlap(crops, boxes)  # (max_trials, n_objects), n_objects is the no. of objects
+    valid *= overlap.max(dim=1)[0] >= min_overlap
+
+    # Find bounding boxes whose centers are in the crops
+    bb_centers = (boxes[:, :2] + boxes[:, 2:]) / 2.  # (n_objects, 2)
+    bb_centers_x, bb_centers_y = bb_centers[:, 0].unsqueeze(0), bb_centers[:, 1].unsqueeze(0)  # (1, n_objects)
+    centers_in_crop = (bb_centers_x > crops[:, 0:1]) * (bb_centers_x < crops[:, 2:3]) * (bb_centers_y > crops[:, 1:2]) \
+        * (bb_centers_y < crops[:, 3:4])  # (max_trials, n_objects)
+    valid *= centers_in_crop.any(dim=1)  # (max_trials)
+
+    if not valid.any():
+        return None, None
+    first = int(valid.nonzero()[0])
+    return crops[first], centers_in_crop[first]
 
 
 def flip(image, boxes):
     """
     Flip image horizontally.
 
-    :param image: image, a PIL Image
+    :param image: image, a PIL Image or a tensor of dimensions (3, h, w)
     :param boxes: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
     :return: flipped image, updated bounding box coordinates
     """
@@ -229,27 +306,101 @@ def flip(image, boxes):
     new_image = FT.hflip(image)
 
     # Flip boxes
+    width = image.size(-1) if torch.is_tensor(image) else image.width
+    new_boxes = flip_boxes(boxes, width)
+
+    return new_image, new_boxes
+
+
+def flip_boxes(boxes, width):
+    """
+    Flip bounding boxes horizontally (in place).
+
+    :param boxes: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
+    :param width: image width
+    :return: updated bounding box coordinates
+    """
     new_boxes = boxes
-    new_boxes[:, 0] = image.width - boxes[:, 0] - 1
-    new_boxes[:, 2] = image.width - boxes[:, 2] - 1
+    new_boxes[:, 0] = width - boxes[:, 0] - 1
+    new_boxes[:, 2] = width - boxes[:, 2] - 1
     new_boxes = new_boxes[:, [2, 1, 0, 3]]
 
-    return new_image, new_boxes
+    return new_boxes
+
+
+def expand_crop_resize(image, filler, position, region, dims=(224, 224)):
+    """
+    Fused expand() -> crop -> resize(): compute the resized crop of the expanded image without creating the
+    expanded image. Only the part of the output that the original image covers is resized from it, the rest is filler.
+
+    :param image: image, a tensor of dimensions (3, original_h, original_w)
+    :param filler: RBG values of the filler material, a list like [R, G, B], in the value range of image's dtype
+    :param position: (left, top) of the original image in the expanded image
+    :param region: crop [left, top, right, bottom] in the expanded image coordinates
+    :param dims: output (height, width)
+    :return: resized crop, a tensor of dimensions (3, dims[0], dims[1])
+    """
+    original_h, original_w = image.shape[-2:]
+    left, top = position
+    crop_left, crop_top, crop_right, crop_bottom = region
+    scale_x = dims[1] / (crop_right - crop_left)
+    scale_y = dims[0] / (crop_bottom - crop_top)
+
+    new_image = torch.empty((3,) + tuple(dims), dtype=image.dtype)
+    new_image[:] = torch.tensor(filler, dtype=image.dtype).view(3, 1, 1)
+
+    # Intersection of the original image and the crop, in the expanded image coordinates
+    x_min, x_max = max(crop_left, left), min(crop_right, left + original_w)
+    y_min, y_max = max(crop_top, top), min(crop_bottom, top + original_h)
+    if x_max <= x_min or y_max <= y_min:
+        return new_image
+
+    # Where the intersection lands in the output
+    out_x_min, out_x_max = round((x_min - crop_left) * scale_x), round((x_max - crop_left) * scale_x)
+    out_y_min, out_y_max = round((y_min - crop_top) * scale_y), round((y_max - crop_top) * scale_y)
+    if out_x_max <= out_x_min or out_y_max <= out_y_min:
+        return new_image
+
+    patch = image[:, y_min - top:y_max - top, x_min - left:x_max - left]
+    new_image[:, out_y_min:out_y_max, out_x_min:out_x_max] = FT.resize(patch, [out_y_max - out_y_min,
+                                                                               out_x_max - out_x_min], antialias=True)
+
+    return new_image
 
 
 def resize(image, box, dims=(224, 224), return_percent_coords=True):
     # Resize image
-    new_image = FT.resize(image, dims)
+    if torch.is_tensor(image):
+        new_image = FT.resize(image, dims, antialias=True)  # antialias like PIL does
+        height, width = image.shape[-2:]
+    else:
+        new_image = FT.resize(image, dims)
+        width, height = image.width, image.height
 
     # Resize bounding boxes
-    old_dims = torch.FloatTensor([image.width, image.height, image.width, image.height]).unsqueeze(0)
+    old_dims = torch.FloatTensor([width, height, width, height]).unsqueeze(0)
+    new_box = resize_box(box, old_dims, dims, return_percent_coords)
+
+    return new_image, new_box
+
+
+def resize_box(box, old_dims, dims=(224, 224), return_percent_coords=True):
+    """
+    Resize bounding boxes the same way resize() does, without the image.
+
+    :param box: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
+    :param old_dims: original image dimensions, a tensor [[width, height, width, height]]
+    :param dims: new (height, width)
+    :param return_percent_coords: return fractional coordinates
+    :return: resized bounding boxes
+    """
     new_box = box / old_dims  # percent coordinates
 
     if not return_percent_coords:
         new_dims = torch.FloatTensor([dims[1], dims[0], dims[1], dims[0]]).unsqueeze(0)
         new_box = new_box * new_dims
 
-    return new_image, new_box
+    return new_box
 
 
 def save_checkpoint(epoch, model):
@@ -260,7 +411,7 @@ def save_checkpoint(epoch, model):
     :param model: model
     """
     filename = f'checkpoint_fasterrcnn_epoch={epoch + 1}.pth.tar'
-    torch.save({'state_dict': model.state_dict()}, filename)
+    torch.save({'state_dict': model.state_dict(), 'backbone': getattr(model, 'backbone_name', 'resnet50')}, filename)
 
 
 class AverageMeter(object):
@@ -0,0 +1,130 @@
+"""
+Local cache of the model weights, so that predict.py downloads faster_rcnn.pth.tar once instead of on every run.
+
+Files are stored content-addressed under constants.CACHE_DIR/weights, as blobs/<sha256>, and a named ref
+(refs/faster_rcnn.pth.tar) records the digest, size and mtime of the downloaded file. A blob is hashed when it is
+downloaded and hashed again only if its size or mtime changed since (or with verify=True), a blob that doesn't match
+its digest anymore is dropped and downloaded again.
+
+In offline mode (constants.OFFLINE, env FACEMASK_OFFLINE=1) nothing is downloaded, the weights must be in the cache
+or given as a path.
+"""
+import hashlib
+import json
+import os
+import constants
+
+WEIGHTS_NAME = 'faster_rcnn.pth.tar'
+WEIGHTS_URL = 'https://drive.google.com/uc?id=19wM9Bm16SnTvjsxVU6uOdZQrdWIUd4LS'
+
+
+def file_sha256(path, chunk_bytes=2 ** 20):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def blob_path(digest):
+    return os.path.join(constants.CACHE_DIR, 'weights', 'blobs', digest)
+
+
+def ref_path(name):
+    return os.path.join(constants.CACHE_DIR, 'weights', 'refs', name)
+
+
+def read_ref(name):
+    """
+    :return: dict with the sha256, size and mtime_ns of the cached file, or None if name is not cached
+    """
+    try:
+        with open(ref_path(name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_ref(name, digest, url):
+    st = os.stat(blob_path(digest))
+    path = ref_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(sha256=digest, size=st.st_size, mtime_ns=st.st_mtime_ns, url=url), f)
+    os.replace(tmp_path, path)
+
+
+def check_blob(ref, verify=False):
+    """
+    :param ref: ref of a cached file (see read_ref())
+    :param verify: re-hash the blob even if its size and mtime didn't change
+    :return: whether the blob exists and matches its digest
+    """
+    try:
+        st = os.stat(blob_path(ref['sha256']))
+    except OSError:
+        return False
+    if not verify and (st.st_size, st.st_mtime_ns) == (ref['size'], ref['mtime_ns']):
+        return True
+    return file_sha256(blob_path(ref['sha256'])) == ref['sha256']
+
+
+def download_weights(url=WEIGHTS_URL, name=WEIGHTS_NAME, expected_sha256=None):
+    """
+    Download a weights file to the cache.
+
+    :param expected_sha256: if given, the downloaded file must have this digest
+    :return: path of the cached file
+    """
+    import gdown  # only needed when downloading
+
+    tmp_path = os.path.join(constants.CACHE_DIR, 'weights', f'{name}.{os.getpid()}.download')
+    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+    print(f'Downloading model weights from {url} ...')
+    gdown.download(url, tmp_path, quiet=False)
+
+    digest = file_sha256(tmp_path)
+    if expected_sha256 is not None and digest != expected_sha256.lower():
+        os.remove(tmp_path)
+        raise ValueError(f'sha256 of the downloaded {name} is {digest}, expected {expected_sha256}')
+    os.makedirs(os.path.dirname(blob_path(digest)), exist_ok=True)
+    os.replace(tmp_path, blob_path(digest))
+    write_ref(name, digest, url)
+    return blob_path(digest)
+
+
+def get_weights_path(weights_path=constants.WEIGHTS_PATH, offline=constants.OFFLINE,
+                     expected_sha256=constants.WEIGHTS_SHA256, verify=False, url=WEIGHTS_URL, name=WEIGHTS_NAME):
+    """
+    Find the model weights to load with model.get_fasterrcnn_resnet50_fpn(weights_path=...).
+
+    :param weights_path: an explicit weights file, used as is (env FACEMASK_WEIGHTS), otherwise the cached download
+    :param offline: never download, fail if the weights are not cached (env FACEMASK_OFFLINE)
+    :param expected_sha256: the weights must have this digest (env FACEMASK_WEIGHTS_SHA256), otherwise the first
+    download is trusted
+    :param verify: re-hash the cached file even if it looks unchanged
+    :return: path of the weights file
+    """
+    if weights_path:
+        if expected_sha256 is not None and file_sha256(weights_path) != expected_sha256.lower():
+            raise ValueError(f'sha256 of {weights_path} is not {expected_sha256}')
+        return weights_path
+
+    ref = read_ref(name)
+    if ref is not None and (expected_sha256 is None or ref['sha256'] == expected_sha256.lower()):
+        if check_blob(ref, verify=verify):
+            return blob_path(ref['sha256'])
+        if os.path.exists(blob_path(ref['sha256'])):
+            print(f'Cached {name} is corrupted, dropping it')
+            os.remove(blob_path(ref['sha256']))
+
+    if offline:
+        raise FileNotFoundError(f'{name} is not in the weights cache {os.path.dirname(ref_path(name))} and offline '
+                                f'mode is on, run once online or pass a weights path')
+    return download_weights(url, name, expected_sha256)
+
+
+if __name__ == '__main__':
+    # download the weights to the cache (if needed) and print their path
+    print(get_weights_path())